@@ -0,0 +1,752 @@
+#!/usr/bin/env python3
+
+# Author: Gavin Hungaski
+# Purpose: Microbenchmarks for the protocol layer shared by the client and the server.
+
+from library import *
+from fileclient import FileClient
+import multiprocessing
+import subprocess
+import contextlib
+import argparse
+import tempfile
+import resource
+import signal
+import fnmatch
+import shutil
+import socket
+import sys
+import io
+import threading
+import time
+
+
+class CountingSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.syscalls = 0
+
+    def recv(self, size):
+        self.syscalls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, view):
+        self.syscalls += 1
+        return self.sock.recv_into(view)
+
+    def sendall(self, data):
+        self.syscalls += 1
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.syscalls += 1
+        return self.sock.sendmsg(buffers)
+
+    def sendfile(self, file, offset=0, count=None):
+        self.syscalls += 1
+        return self.sock.sendfile(file, offset, count)
+
+    def setsockopt(self, *args):
+        return self.sock.setsockopt(*args)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+def legacy_really_recv(client, length):
+    # the original sentinel reader, kept here only as the baseline
+    data = bytearray()
+    while len(data) < length:
+        chunk = client.recv(1)
+        if not chunk or chunk == b'~':
+            break
+        data.extend(chunk)
+    return bytes(data)
+
+
+def report(name, messages, payload_bytes, syscalls, elapsed):
+    rate = payload_bytes / elapsed / 1e6
+    print(f"{name:<8} {messages} msgs  {syscalls:>8} recv syscalls  "
+          f"{syscalls / messages:6.1f}/msg  {rate:8.2f} MB/s")
+
+
+def bench_framing(messages, size):
+    payload = "x" * size
+    total = messages * size
+
+    a, b = socket.socketpair()
+    legacy = b"".join(f"{len(payload)}~{payload}~".encode() for _ in range(messages))
+    sender = threading.Thread(target=a.sendall, args=(legacy,))
+    reader = CountingSocket(b)
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(messages):
+        length = legacy_really_recv(reader, 1024).decode()
+        legacy_really_recv(reader, int(length) + 1)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    report("before", messages, total, reader.syscalls, elapsed)
+    a.close()
+    b.close()
+
+    a, b = socket.socketpair()
+    framed = FramedSocket(a)
+    reader = CountingSocket(b)
+    receiver = FramedSocket(reader)
+    sender = threading.Thread(target=lambda: [framed.send_msg(payload) for _ in range(messages)])
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(messages):
+        receiver.recv_msg()
+    elapsed = time.perf_counter() - start
+    sender.join()
+    report("after", messages, total, reader.syscalls, elapsed)
+    a.close()
+    b.close()
+
+
+def legacy_send_directory(s, dir_path):
+    # the per-file protocol used before manifests: key, path and size frames, then a sendfile
+    contents_list = listDirectory(dir_path)
+    s.send_msg(dir_path)
+    s.send_msg(f"{len(contents_list)}")
+    for item in contents_list:
+        item_path = os.path.join(dir_path, item)
+        if os.path.isfile(item_path):
+            s.send_msg("f")
+            s.send_msg(item_path)
+            s.send_msg(f"{os.path.getsize(item_path)}")
+            with open(item_path, "rb") as file:
+                s.sendfile(file)
+        elif os.path.isdir(item_path):
+            s.send_msg("d")
+            legacy_send_directory(s, item_path)
+
+
+def legacy_receive_dir(s, base_dir):
+    dir_path = os.path.join(base_dir, os.path.basename(s.recv_msg()))
+    os.mkdir(dir_path)
+    for _ in range(int(s.recv_msg())):
+        if s.recv_msg() == 'f':
+            file_path = os.path.join(dir_path, os.path.basename(s.recv_msg()))
+            receive_to_file(s, file_path, int(s.recv_msg()))
+        else:
+            legacy_receive_dir(s, dir_path)
+
+
+def tcp_pair():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        b, _ = listener.accept()
+    return FramedSocket(a), FramedSocket(b)
+
+
+def make_tree(root, files, size, per_dir=500):
+    for i in range(files):
+        dir_path = os.path.join(root, f"dir{i // per_dir}")
+        if i % per_dir == 0:
+            os.makedirs(dir_path)
+        with open(os.path.join(dir_path, f"file{i}.txt"), "wb") as file:
+            file.write(os.urandom(size))
+
+
+def bench_tree(files, size):
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = os.path.join(work_dir, "tree")
+        make_tree(root, files, size)
+        def send_tree(s):
+            manifest = build_manifest(root)
+            s.send_msg(json.dumps(manifest))
+            send_bodies(s, root, manifest)
+
+        runs = [
+            ("before", lambda s: legacy_send_directory(s, root), legacy_receive_dir),
+            ("after", send_tree, receive_tree),
+        ]
+        for name, send, receive in runs:
+            out_dir = os.path.join(work_dir, name)
+            os.mkdir(out_dir)
+            a, b = tcp_pair()
+            counter = CountingSocket(a.sock)
+            a.sock = counter
+            start = time.perf_counter()
+            sender = threading.Thread(target=send, args=(a,))
+            sender.start()
+            receive(b, out_dir)
+            sender.join()
+            elapsed = time.perf_counter() - start
+            a.close()
+            b.close()
+            print(f"{name:<8} {files} files  {counter.syscalls:>6} send syscalls  {elapsed:6.2f}s  "
+                  f"{files / elapsed:9.0f} files/s  {files * size / elapsed / 1e6:7.2f} MB/s")
+
+
+def bench_sync(files, size, changed):
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = os.path.join(work_dir, "tree")
+        make_tree(root, files, size)
+        stale_dir = os.path.join(work_dir, "stale")
+        shutil.copytree(root, os.path.join(stale_dir, "tree"))
+        step = max(1, round(100 / changed)) if changed else files + 1
+        for i in range(0, files, step):
+            with open(os.path.join(root, f"dir{i // 500}", f"file{i}.txt"), "r+b") as file:
+                file.seek(size // 2)
+                file.write(b"changed")
+        total = files * size
+
+        out_dir = os.path.join(work_dir, "full")
+        os.mkdir(out_dir)
+        a, b = tcp_pair()
+        start = time.perf_counter()
+        def send_tree(s):
+            manifest = build_manifest(root)
+            s.send_msg(json.dumps(manifest))
+            send_bodies(s, root, manifest)
+        sender = threading.Thread(target=send_tree, args=(a,))
+        sender.start()
+        receive_tree(b, out_dir)
+        sender.join()
+        elapsed = time.perf_counter() - start
+        a.close()
+        b.close()
+        print(f"put -r   {files} files  {total:>12} bytes sent  {elapsed:6.2f}s")
+
+        a, b = tcp_pair()
+        start = time.perf_counter()
+        sender = threading.Thread(target=sync_send, args=(a, root))
+        sender.start()
+        stats = sync_receive(b, stale_dir)
+        sender.join()
+        elapsed = time.perf_counter() - start
+        a.close()
+        b.close()
+        print(f"sync     {files} files  {stats['sent']:>12} bytes sent  {elapsed:6.2f}s  "
+              f"{stats['changed']} changed, {100 * (1 - stats['sent'] / total):.2f}% saved")
+
+
+def bench_listing(files, rounds):
+    with tempfile.TemporaryDirectory() as work_dir:
+        make_tree(work_dir, files, 16, per_dir=files)
+        dir_path = os.path.join(work_dir, "dir0")
+        os.utime(dir_path, ns=(0, 0))
+        cache = ListingCache()
+
+        def legacy():
+            names = listDirectory(dir_path)
+            return pack_frames("success", f"{len(names)}", *names)
+
+        def first_batch():
+            return take(iter_listing(dir_path), LS_BATCH)
+
+        def streamed():
+            entries = iter_listing(dir_path)
+            while take(entries, LS_BATCH):
+                pass
+
+        runs = [
+            ("before", legacy),
+            ("first", first_batch),
+            ("stream", streamed),
+            ("page", lambda: list_page(iter_listing(dir_path), limit=100)),
+            ("cached", lambda: list(cache.iter(dir_path))),
+        ]
+        for name, run in runs:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                run()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name:<8} {files} entries  {elapsed / rounds * 1e3:8.3f} ms per ls  {peak / 1e6:7.2f} MB peak")
+
+
+def walk_find(root, pattern):
+    return [os.path.join(dir_path, name) for dir_path, dirs, files in os.walk(root)
+            for name in dirs + files if fnmatch.fnmatchcase(name, pattern)]
+
+
+def walk_du(root):
+    return sum(os.path.getsize(os.path.join(dir_path, name)) for dir_path, _, files in os.walk(root) for name in files)
+
+
+def bench_index(files, rounds):
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = os.path.join(work_dir, "tree")
+        make_tree(root, files, 16, per_dir=1000)
+        index = MetadataIndex(root, os.path.join(work_dir, "index.sqlite"))
+        start = time.perf_counter()
+        index.update(full=True)
+        print(f"build    {files} files  {time.perf_counter() - start:8.3f}s")
+        start = time.perf_counter()
+        index.update()
+        print(f"update   {files} files  {time.perf_counter() - start:8.3f}s  (nothing changed)")
+        queries = [
+            ("find", lambda: walk_find(root, "file4242*"), lambda: index.find("file4242*")),
+            ("du", lambda: walk_du(root), lambda: index.du()),
+        ]
+        for name, walk, lookup in queries:
+            for method, run in (("walk", walk), ("index", lookup)):
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    run()
+                elapsed = time.perf_counter() - start
+                print(f"{name:<4} {method:<5} {files} files  {elapsed / rounds * 1e3:10.2f} ms per query")
+
+
+def send_source(port, path):
+    with socket.create_connection(("127.0.0.1", port)) as sock, open(path, "rb") as file:
+        sock.sendfile(file)
+
+
+def bench_receive(size_mb, rounds):
+    with tempfile.TemporaryDirectory() as work_dir:
+        source = os.path.join(work_dir, "source.bin")
+        with open(source, "wb") as file:
+            for _ in range(size_mb):
+                file.write(os.urandom(1 << 20))
+        size = size_mb << 20
+        context = multiprocessing.get_context("fork")
+        for name, zero_copy in (("recv_into", False), ("splice", SPLICE)):
+            cpu = wall = 0
+            for _ in range(rounds):
+                with socket.create_server(("127.0.0.1", 0)) as listener:
+                    sender = context.Process(target=send_source, args=(listener.getsockname()[1], source))
+                    sender.start()
+                    conn = FramedSocket(listener.accept()[0])
+                conn.zero_copy = zero_copy
+                before, start = resource.getrusage(resource.RUSAGE_SELF), time.perf_counter()
+                receive_to_file(conn, os.path.join(work_dir, "dest.bin"), size)
+                after = resource.getrusage(resource.RUSAGE_SELF)
+                wall += time.perf_counter() - start
+                cpu += (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+                conn.close()
+                sender.join()
+            gigabytes = size * rounds / (1 << 30)
+            print(f"{name:<10} {size_mb} MB x {rounds}  {cpu / gigabytes:6.2f} CPU s/GB  {size * rounds / wall / 1e6:8.1f} MB/s")
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(serve_dir, *args):
+    port = free_port()
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fileserver.py")
+    proc = subprocess.Popen([sys.executable, server, "-p", str(port), "-d", serve_dir, *args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proc, port
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+
+def stop_server(proc):
+    # SIGINT lets the server stop its indexer and exporter too; kill only one that hangs
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def connect(port):
+    return FramedSocket(socket.create_connection(("127.0.0.1", port)))
+
+
+def get_worker(port, name, rounds):
+    with tempfile.TemporaryDirectory() as out_dir:
+        os.chdir(out_dir)
+        client = FileClient("127.0.0.1", port)
+        s = connect(port)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(rounds):
+                client.handle_get(s, f"get {name}")
+            client.handle_exit(s)
+        s.close()
+
+
+def bench_concurrency(levels, size_mb, rounds):
+    with tempfile.TemporaryDirectory() as serve_dir:
+        with open(os.path.join(serve_dir, "big.bin"), "wb") as file:
+            file.write(os.urandom(size_mb * 1024 * 1024))
+        proc, port = start_server(serve_dir, "-m", str(max(levels)))
+        try:
+            context = multiprocessing.get_context("fork")
+            for clients in levels:
+                start = time.perf_counter()
+                workers = [context.Process(target=get_worker, args=(port, "big.bin", rounds))
+                           for _ in range(clients)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.perf_counter() - start
+                total = clients * rounds * size_mb
+                print(f"{clients:>3} clients  {total:>6} MB in {elapsed:6.2f}s  {total / elapsed:8.1f} MB/s aggregate")
+        finally:
+            stop_server(proc)
+
+
+def make_dataset(root, huge_mb, small_files, depth):
+    # one huge file, a flat directory of small files and a deep tree; returns each scenario's script
+    with open(os.path.join(root, "huge.bin"), "wb") as file:
+        for _ in range(huge_mb):
+            file.write(os.urandom(1 << 20))
+    os.mkdir(os.path.join(root, "small"))
+    for i in range(small_files):
+        with open(os.path.join(root, "small", f"f{i}.bin"), "wb") as file:
+            file.write(os.urandom(4096))
+    deep_files = 0
+    stack = [(os.path.join(root, "deep"), 0)]
+    while stack:
+        dir_path, level = stack.pop()
+        os.mkdir(dir_path)
+        for i in range(4):
+            with open(os.path.join(dir_path, f"f{i}.bin"), "wb") as file:
+                file.write(os.urandom(4096))
+        deep_files += 4
+        if level < depth:
+            stack.extend((os.path.join(dir_path, f"d{i}"), level + 1) for i in range(3))
+    # (command, bytes it moves, files it moves)
+    return {
+        "huge": [("get huge.bin", huge_mb << 20, 1)],
+        "small": [(f"get small/f{i}.bin", 4096, 1) for i in range(small_files)],
+        "deep": [("get -r deep", deep_files * 4096, deep_files)],
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))] if ordered else 0
+
+
+def scripted_client(port, script, rounds, barrier, results):
+    # one FileClient replaying the script; socket syscalls are counted, so the client never splices
+    with tempfile.TemporaryDirectory() as out_dir:
+        os.chdir(out_dir)
+        client = FileClient("127.0.0.1", port)
+        counter = CountingSocket(socket.create_connection(("127.0.0.1", port)))
+        s = FramedSocket(counter)
+        latencies, moved, files = [], 0, 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.negotiate(s)
+            barrier.wait()
+            start = time.monotonic()
+            for _ in range(rounds):
+                for command, size, count in script:
+                    began = time.perf_counter()
+                    response = client.handle_get(s, command)
+                    latencies.append(time.perf_counter() - began)
+                    if response and response.startswith("Error"):
+                        raise RuntimeError(f"{command}: {response}")
+                    moved += size
+                    files += count
+                shutil.rmtree("deep", ignore_errors=True)
+            end = time.monotonic()
+            client.handle_exit(s)
+        s.close()
+        results.put({"start": start, "end": end, "latencies": latencies, "bytes": moved, "files": files,
+                     "syscalls": counter.syscalls, "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def run_scenario(serve_dir, engine, name, script, clients, rounds):
+    proc, port = start_server(serve_dir, "--engine", engine, "-m", str(clients), "--no-index")
+    context = multiprocessing.get_context("fork")
+    barrier, results = context.Barrier(clients), context.Queue()
+    try:
+        workers = [context.Process(target=scripted_client, args=(port, script, rounds, barrier, results))
+                   for _ in range(clients)]
+        for worker in workers:
+            worker.start()
+        reports = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        # a clean shutdown, so the server's rusage covers the workers it has reaped
+        proc.send_signal(signal.SIGINT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = max(r["end"] for r in reports) - min(r["start"] for r in reports)
+    latencies = [latency for r in reports for latency in r["latencies"]]
+    moved = sum(r["bytes"] for r in reports)
+    files = sum(r["files"] for r in reports)
+    return {
+        "engine": engine, "scenario": name, "clients": clients, "rounds": rounds,
+        "seconds": round(elapsed, 4),
+        "bytes": moved, "files": files, "commands": len(latencies),
+        "mb_per_s": round(moved / elapsed / 1e6, 2),
+        "files_per_s": round(files / elapsed, 1),
+        "latency_ms": {"p50": round(percentile(latencies, 0.5) * 1000, 3),
+                       "p99": round(percentile(latencies, 0.99) * 1000, 3)},
+        "client_syscalls": sum(r["syscalls"] for r in reports),
+        "client_peak_rss_kb": max(r["rss_kb"] for r in reports),
+        "server_cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+        "server_peak_rss_kb": usage.ru_maxrss,
+    }
+
+
+def bench_suite(engines, scenarios, clients, rounds, huge_mb, small_files, depth, json_path):
+    with tempfile.TemporaryDirectory() as serve_dir, tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["XDG_CACHE_HOME"] = cache_dir
+        scripts = make_dataset(serve_dir, huge_mb, small_files, depth)
+        results = []
+        for engine in engines:
+            for name in scenarios:
+                result = run_scenario(serve_dir, engine, name, scripts[name], clients, rounds)
+                results.append(result)
+                print(f"{engine:<8} {name:<6} {clients:>3} clients  {result['mb_per_s']:8.1f} MB/s  "
+                      f"{result['files_per_s']:9.1f} files/s  p50 {result['latency_ms']['p50']:8.2f} ms  "
+                      f"p99 {result['latency_ms']['p99']:8.2f} ms  {result['client_syscalls']:>8} syscalls  "
+                      f"server {result['server_cpu_s']:6.2f} CPU s {result['server_peak_rss_kb'] // 1024:>4} MB RSS",
+                      file=sys.stderr if json_path == "-" else sys.stdout)
+    if json_path == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif json_path:
+        with open(json_path, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+class ThrottledProxy(threading.Thread):
+    # forwards a local port to the server, pacing each direction to a fixed byte rate
+    def __init__(self, target_port, rate):
+        super().__init__(daemon=True)
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.target_port = target_port
+        self.rate = rate
+
+    def run(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                break
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            for src, dst in ((client, upstream), (upstream, client)):
+                threading.Thread(target=self.pump, args=(src, dst), daemon=True).start()
+
+    def pump(self, src, dst):
+        ready = time.perf_counter()
+        try:
+            while data := src.recv(16384):
+                ready = max(ready, time.perf_counter()) + len(data) / self.rate
+                time.sleep(max(0, ready - time.perf_counter()))
+                dst.sendall(data)
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.listener.close()
+
+
+def make_log(path, size):
+    with open(path, "w") as file:
+        i = 0
+        while file.tell() < size:
+            file.write(f"2024-01-01 12:{i // 60 % 60:02}:{i % 60:02} INFO worker {i % 7} served /api/item/{i * 7919 % 100000} "
+                       f"in {i * 31 % 997} ms status {200 if i % 13 else 404}\n")
+            i += 1
+
+
+def bench_checksum(size_mb, rounds):
+    # the first verified get hashes while sending, later ones send the cached digest after sendfile
+    with tempfile.TemporaryDirectory() as serve_dir, tempfile.TemporaryDirectory() as out_dir:
+        path = os.path.join(serve_dir, "big.bin")
+        with open(path, "wb") as file:
+            for _ in range(size_mb):
+                file.write(os.urandom(1 << 20))
+        os.utime(path, (time.time() - 60, time.time() - 60))
+        os.environ["XDG_CACHE_HOME"] = os.path.join(out_dir, "cache")
+        proc, port = start_server(serve_dir, "--no-index")
+        os.chdir(out_dir)
+        try:
+            for checksum in [None, *CHECKSUMS]:
+                client = FileClient("127.0.0.1", port, None, checksum)
+                s = connect(port)
+                times = []
+                with contextlib.redirect_stdout(io.StringIO()):
+                    client.negotiate(s)
+                    for _ in range(rounds):
+                        start = time.perf_counter()
+                        client.handle_get(s, "get big.bin")
+                        times.append(time.perf_counter() - start)
+                    client.handle_exit(s)
+                s.close()
+                repeat = sum(times[1:]) / max(1, len(times) - 1)
+                print(f"{checksum or 'none':<8} {size_mb} MB  first {times[0]:6.3f}s  repeated {repeat:6.3f}s")
+        finally:
+            stop_server(proc)
+
+
+def timed_connects(client, count, resume):
+    start = time.perf_counter()
+    for _ in range(count):
+        if not resume:
+            client.tls_session = None
+        s = client.open()
+        client.handle_exit(s)
+        s.close()
+    return (time.perf_counter() - start) / count
+
+
+def bench_tls(engine, size_mb, small_files, rounds, connects):
+    # the same workload over plain TCP and over TLS, with full and resumed handshakes
+    with tempfile.TemporaryDirectory() as serve_dir, tempfile.TemporaryDirectory() as out_dir:
+        with open(os.path.join(serve_dir, "big.bin"), "wb") as file:
+            for _ in range(size_mb):
+                file.write(os.urandom(1 << 20))
+        os.mkdir(os.path.join(serve_dir, "small"))
+        for i in range(small_files):
+            with open(os.path.join(serve_dir, "small", f"f{i}.txt"), "wb") as file:
+                file.write(os.urandom(4096))
+        cert, key = os.path.join(out_dir, "cert.pem"), os.path.join(out_dir, "key.pem")
+        self_signed(cert, key)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(out_dir, "cache")
+        os.chdir(out_dir)
+        for tls in (None, client_tls(cert)):
+            args = ["--engine", engine, "--no-index"] + (["--tls-cert", cert, "--tls-key", key] if tls else [])
+            proc, port = start_server(serve_dir, *args)
+            try:
+                client = FileClient("127.0.0.1", port, None, None, tls)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    s = client.open()
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        client.handle_get(s, "get big.bin")
+                    large = size_mb * rounds / (time.perf_counter() - start)
+                    start = time.perf_counter()
+                    for i in range(small_files):
+                        client.handle_get(s, f"get small/f{i}.txt")
+                    small = small_files / (time.perf_counter() - start)
+                    client.handle_exit(s)
+                    s.close()
+                    full = timed_connects(client, connects, False)
+                    resumed = timed_connects(client, connects, True) if tls else full
+            finally:
+                stop_server(proc)
+            print(f"{'tls' if tls else 'plain':<6} {engine:<8} {large:8.1f} MB/s large  {small:8.0f} files/s small  "
+                  f"connect {full * 1000:6.2f} ms full, {resumed * 1000:6.2f} ms resumed")
+
+
+def bench_compression(rates, size_mb, codecs):
+    with tempfile.TemporaryDirectory() as serve_dir, tempfile.TemporaryDirectory() as out_dir:
+        make_log(os.path.join(serve_dir, "app.log"), size_mb * 1024 * 1024)
+        proc, port = start_server(serve_dir)
+        os.chdir(out_dir)
+        try:
+            for rate in rates:
+                proxy = ThrottledProxy(port, rate * 1e6 / 8)
+                proxy.start()
+                for codec in [None] + codecs:
+                    client = FileClient("127.0.0.1", proxy.port, codec, None)
+                    s = connect(proxy.port)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        if codec:
+                            client.negotiate(s)
+                        start = time.perf_counter()
+                        client.handle_get(s, "get app.log")
+                        elapsed = time.perf_counter() - start
+                        client.handle_exit(s)
+                    s.close()
+                    print(f"{rate:>6g} Mbit/s  {codec or 'raw':<5} {size_mb} MB log in {elapsed:7.2f}s")
+                proxy.close()
+        finally:
+            stop_server(proc)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(add_help=True)
+    sub = parser.add_subparsers(dest='bench', required=True)
+    framing = sub.add_parser('framing', help='Frame reader syscalls and throughput')
+    framing.add_argument('-n', type=int, default=20000, help='Number of messages')
+    framing.add_argument('-s', type=int, default=64, help='Payload size in bytes')
+    concurrency = sub.add_parser('concurrency', help='Aggregate throughput of parallel get clients')
+    concurrency.add_argument('-c', default='1,2,4,8', help='Comma separated client counts')
+    concurrency.add_argument('-s', type=int, default=64, help='File size in MB')
+    concurrency.add_argument('-r', type=int, default=4, help='Gets per client')
+    tree = sub.add_parser('tree', help='Directory tree transfer of many small files')
+    tree.add_argument('-n', type=int, default=10000, help='Number of files')
+    tree.add_argument('-s', type=int, default=2048, help='File size in bytes')
+    sync = sub.add_parser('sync', help='Delta sync of a tree against a stale copy')
+    sync.add_argument('-n', type=int, default=1000, help='Number of files')
+    sync.add_argument('-s', type=int, default=262144, help='File size in bytes')
+    sync.add_argument('-c', type=float, default=5, help='Percentage of files changed')
+    listing = sub.add_parser('listing', help='ls of a large directory with and without the listing cache')
+    listing.add_argument('-n', type=int, default=10000, help='Number of entries')
+    listing.add_argument('-r', type=int, default=5, help='Listings per run')
+    index = sub.add_parser('index', help='find and du from the metadata index against walking the tree')
+    index.add_argument('-n', type=int, default=100000, help='Number of files')
+    index.add_argument('-r', type=int, default=3, help='Queries per run')
+    receive = sub.add_parser('receive', help='CPU per GB received with and without splice')
+    receive.add_argument('-s', type=int, default=512, help='Body size in MB')
+    receive.add_argument('-r', type=int, default=3, help='Transfers per mode')
+    checksum = sub.add_parser('checksum', help='Verified gets of one large file, hashed once and then cached')
+    checksum.add_argument('-s', type=int, default=256, help='File size in MB')
+    checksum.add_argument('-r', type=int, default=4, help='Gets per checksum')
+    suite = sub.add_parser('suite', help='Scripted concurrent clients against a live server, per engine and dataset')
+    suite.add_argument('-e', default='fork,asyncio', help='Comma separated server engines')
+    suite.add_argument('-t', default='huge,small,deep', help='Comma separated scenarios: huge, small, deep')
+    suite.add_argument('-k', type=int, default=4, help='Concurrent clients')
+    suite.add_argument('-r', type=int, default=2, help='Times each client replays its script')
+    suite.add_argument('--huge', type=int, default=256, help='Size of the huge file in MB')
+    suite.add_argument('--small', type=int, default=1000, help='Number of small files')
+    suite.add_argument('--depth', type=int, default=5, help='Depth of the deep tree')
+    suite.add_argument('--json', help='Write the results as JSON to this file, - for stdout')
+    tls = sub.add_parser('tls', help='Large and small gets and connection setup over TLS against plain TCP')
+    tls.add_argument('-e', default='fork', choices=['fork', 'asyncio'], help='Server engine')
+    tls.add_argument('-s', type=int, default=256, help='Large file size in MB')
+    tls.add_argument('-n', type=int, default=2000, help='Number of small files')
+    tls.add_argument('-r', type=int, default=3, help='Gets of the large file')
+    tls.add_argument('-c', type=int, default=200, help='Connections opened per handshake kind')
+    compression = sub.add_parser('compression', help='Compressed gets through a bandwidth limited proxy')
+    compression.add_argument('-b', default='10,100,1000', help='Comma separated bandwidths in Mbit/s')
+    compression.add_argument('-s', type=int, default=8, help='Log file size in MB')
+    compression.add_argument('-z', default=','.join(CODECS), help='Comma separated codecs to compare with raw')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.bench == 'framing':
+        bench_framing(args.n, args.s)
+    elif args.bench == 'concurrency':
+        bench_concurrency([int(c) for c in args.c.split(',')], args.s, args.r)
+    elif args.bench == 'tree':
+        bench_tree(args.n, args.s)
+    elif args.bench == 'sync':
+        bench_sync(args.n, args.s, args.c)
+    elif args.bench == 'listing':
+        bench_listing(args.n, args.r)
+    elif args.bench == 'index':
+        bench_index(args.n, args.r)
+    elif args.bench == 'receive':
+        bench_receive(args.s, args.r)
+    elif args.bench == 'checksum':
+        bench_checksum(args.s, args.r)
+    elif args.bench == 'suite':
+        bench_suite(args.e.split(','), args.t.split(','), args.k, args.r, args.huge, args.small, args.depth, args.json)
+    elif args.bench == 'tls':
+        bench_tls(args.e, args.s, args.n, args.r, args.c)
+    elif args.bench == 'compression':
+        bench_compression([float(b) for b in args.b.split(',')], args.s, args.z.split(','))
+
+
+if __name__ == "__main__":
+    main()
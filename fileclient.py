@@ -3,34 +3,60 @@
 # Author: Gavin Hungaski
 
 from library import *
+import contextlib
+import threading
 import argparse
 import socket
+import queue
+import random
+import sys
 import os
 
 
 class FileClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, codec=None, checksum=DEFAULT_CHECKSUM, tls=None, sparse=True):
         self.host = host
         self.port = port
+        self.codec = codec
+        self.checksum = checksum
+        self.sparse = sparse        # offer to send and take files with holes as their data extents only
+        self.tls = tls              # client SSLContext, None for plain TCP
+        self.tls_session = None     # offered by later connections so they skip the full handshake
         self.home_dir = os.getcwd()
 
+    def dial(self):
+        s = FramedSocket(socket.create_connection((self.host, self.port)))
+        try:
+            s.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.tls:
+                s.start_tls(self.tls, server_hostname=self.host, session=self.tls_session)
+        except BaseException:
+            s.close()
+            raise
+        return s
+
+    def keep_session(self, s):
+        # a TLS 1.3 ticket only arrives with the first reply, so this runs once something has been read
+        if self.tls and s.encrypted():
+            session = s.sock.session
+            if session and (session.has_ticket or s.sock.version() != "TLSv1.3"):
+                self.tls_session = session
+
     def connect(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s = None
         try:
-            s.connect((self.host, self.port))
+            s = self.open()
+            if self.tls:
+                print(f"Encryption: {s.sock.version()}{', resumed' if s.sock.session_reused else ''}")
+            if self.codec:
+                print(f"Compression: {s.codec or 'off'}")
+            if self.checksum and not s.checksum:
+                print("Checksums: off, the server does not support them")
             while True:
                 message = input("~ ")
                 if not message:
                     continue
-                command, *_ = message.split(maxsplit=1)
-                if command == "exit":
-                    response = self.handle_exit(s)
-                elif self.is_command(command):
-                    if command in ['mkdir', 'cd', 'pwd']:
-                        command = "basic"
-                    response = getattr(self, f"handle_{command}")(s, message)
-                else:
-                    response = f"Unknown command: \'{message}\'"
+                response = self.execute(s, message)
                 if response:
                     print(response)
                 if response == "Exiting":
@@ -38,7 +64,8 @@ class FileClient:
         except KeyboardInterrupt:
             print("\nExiting...")
             try:
-                _ = self.handle_exit(s)
+                if s:
+                    _ = self.handle_exit(s)
             except OSError as e:
                 print(e)
         except ConnectionRefusedError:
@@ -46,35 +73,150 @@ class FileClient:
         except OSError as e:
             print(e)
         finally:
-            s.close()
+            if s:
+                s.close()
     
+    def open(self):
+        # a session for programmatic use: execute() or pipeline() against it, handle_exit() to end it;
+        # a busy server says when to come back, and that wait (with some jitter) is taken a few times
+        for attempt in range(BUSY_RETRIES + 1):
+            s = self.dial()
+            try:
+                self.negotiate(s)
+                return s
+            except ServerBusy as e:
+                s.close()
+                if attempt == BUSY_RETRIES:
+                    raise
+                delay = e.retry_after * random.uniform(1, 1.5)
+                print(f"Server busy, retrying in {delay:.1f} seconds")
+                time.sleep(delay)
+            except BaseException:
+                s.close()
+                raise
+
+    def execute(self, s, message):
+        command, *_ = message.split(maxsplit=1)
+        if command == "exit":
+            return self.handle_exit(s)
+        if self.is_command(command):
+            if command in ['mkdir', 'cd', 'pwd', 'du', 'stats', 'cp', 'mv', 'jobs', 'wait', 'cancel', 'reindex', 'hash',
+                           'priority']:
+                command = "basic"
+            return getattr(self, f"handle_{command}")(s, message)
+        return f"Unknown command: \'{message}\'"
+
+    def pipeline(self, s, messages, depth=PIPELINE_DEPTH):
+        # single-reply commands go out tagged, many per write, and each reply is matched back by its tag;
+        # the window is refilled once half of it has been answered
+        replies = {}
+        sent = 0
+        while len(replies) < len(messages):
+            in_flight = sent - len(replies)
+            if sent < len(messages) and in_flight <= depth // 2:
+                batch = messages[sent:sent + depth - in_flight]
+                s.send_msg(*(f"#{sent + i} {message}" for i, message in enumerate(batch)))
+                sent += len(batch)
+            tag, _, reply = s.recv_msg().partition(" ")
+            if not tag.startswith("#") or not tag[1:].isdigit():
+                raise ConnectionError(f"Unexpected reply to a pipelined command: {tag} {reply}")
+            replies[int(tag[1:])] = reply
+        return [replies[i] for i in range(len(messages))]
+
+    def run_script(self, s, lines):
+        # yields (command, reply); runs of single-reply commands are pipelined, anything else runs alone
+        lines = [line.strip() for line in lines]
+        lines = [line for line in lines if line and not line.startswith("#")]
+        i = 0
+        while i < len(lines):
+            j = i
+            while j < len(lines) and lines[j].split()[0] in PIPELINED_COMMANDS:
+                j += 1
+            if j > i:
+                yield from zip(lines[i:j], self.pipeline(s, lines[i:j]))
+                i = j
+            else:
+                yield lines[i], self.execute(s, lines[i])
+                i += 1
+
+    def batch(self, lines):
+        # non-interactive mode, returns how many commands failed
+        s = self.open()
+        failures = 0
+        try:
+            for _, response in self.run_script(s, lines):
+                if response:
+                    print(response)
+                    if response.startswith(("Error", "Unknown command")):
+                        failures += 1
+                if response == "Exiting":
+                    return failures
+            self.handle_exit(s)
+        finally:
+            s.close()
+        return failures
+
+    def negotiate(self, s):
+        offers = [f"codec {self.codec}"] * bool(self.codec) + [f"checksum {self.checksum}"] * bool(self.checksum) \
+            + ["sparse on"] * self.sparse
+        if offers:
+            s.send_msg(*offers)     # answered in order, one round trip for both
+        elif self.tls:
+            s.send_msg("pwd")       # something to read, so the session ticket is in before it is kept
+        replies = [self.first_reply(s)] if offers or self.tls else []
+        replies += [s.recv_msg() for _ in offers[1:]]
+        if self.codec:
+            s.codec = negotiate(replies.pop(0), CODECS)
+        if self.checksum:
+            s.checksum = negotiate(replies.pop(0), CHECKSUMS)
+        if self.sparse:
+            s.sparse = replies.pop(0) == "on"      # anything else is an older server
+        self.keep_session(s)
+
+    def first_reply(self, s):
+        # a full server answers the first request with a busy message and hangs up
+        reply = s.recv_msg()
+        retry_after = busy_retry(reply)
+        if retry_after is not None:
+            raise ServerBusy(reply, retry_after)
+        return reply
+
     def is_command(self, command):
         good_commands = ['cd', 'lcd', 'ls', 'lls', 'pwd', 'lpwd', 'mkdir', 
-                         'lmkdir', 'get', 'put', 'rm']
+                         'lmkdir', 'get', 'put', 'rm', 'sync', 'find', 'du', 'stats', 'cp', 'mv', 'jobs', 'wait',
+                         'cancel', 'reindex', 'hash', 'priority']
         if command in good_commands:
             return True
         else:
             return False
 
     def handle_exit(self, s):
-        message = "exit"
-        s.sendall(f"{len(message)}~".encode())
-        s.sendall(f"{message}~".encode())
-        return really_recv(s, 1024).decode()
+        s.send_msg("exit")
+        return s.recv_msg()
 
     def handle_ls(self, s, message):
-        response = self.handle_basic(s, message)
-        if response == 'success':
-            num_of_items = int(really_recv(s, 1024).decode())
-            response = []
-            for _ in range(num_of_items):
-                item = really_recv(s, 1024).decode()
-                if '.' in item:
-                    prGreen(item)
-                else:
-                    prCyan(f"{item}\\")
-        else:
+        content = message.split()
+        long = pop_flag(content, "-l")
+        s.send_msg(" ".join(content))
+        return self.receive_entries(s, long)
+
+    def handle_find(self, s, message):
+        return self.handle_ls(s, message)
+
+    def receive_entries(self, s, long=False):
+        response = s.recv_msg()
+        if response != 'success':
             return response
+        while True:
+            frame = s.recv_msg()                    # batches of entries until the closing cursor frame
+            if frame.startswith("Error"):
+                return frame
+            batch = json.loads(frame)
+            if isinstance(batch, dict):
+                break
+            print_entries(batch, long)
+        if batch["next"]:
+            return f"More entries, continue with --cursor {batch['next']}"
         return ""
 
     def handle_lls(self, s, message):
@@ -113,114 +255,857 @@ class FileClient:
             print("Error: No directory name provided.")
             
     def handle_rm(self, s, message):
-        s.sendall(f"{len(message)}~".encode())
-        s.sendall(f"{message}~".encode())
-        return really_recv(s, 1024).decode()
+        s.send_msg(message)
+        return s.recv_msg()
 
     def handle_basic(self, s, message):
-        s.sendall(f"{len(message)}~".encode())
-        s.sendall(f"{message}~".encode())
-        return really_recv(s, 1024).decode()
+        s.send_msg(message)
+        return s.recv_msg()
 
     def handle_get(self, s, message):
-        s.sendall(f"{len(message)}~".encode())
-        s.sendall(f"{message}~".encode())
-        key = really_recv(s, 4096).decode()         # receive the key
+        s.send_msg(message)
+        streams = int(pop_option(message.split(), "-j", 1))
+        key = s.recv_msg()                          # receive the key
         print(key)
         if key == 'f':                              # receive a single file
-            self.receive_file(s)
-            return really_recv(s, 4096).decode()
+            error = self.receive_file(s)
+            response = s.recv_msg()
+            return error or response
+        if key == 'r':                              # continue a partial download
+            error = self.resume_file(s)
+            response = s.recv_msg()
+            return error or response
         if key == 'd':                              # receive a directory
-            self.receive_dir(s)
-            return really_recv(s, 4096).decode()
+            receive_tree(s, "./")
+            return s.recv_msg()
+        if key == 'j':                              # receive a manifest, bodies come over parallel streams
+            base = s.recv_msg()
+            manifest = json.loads(s.recv_msg())
+            response = s.recv_msg()
+            return self.parallel_get(s, base, manifest, streams) or response
         elif key == 'e':                            # receive an error
-            return really_recv(s, 4096).decode()
-
-    def receive_dir(self, s, base_dir="./"):
-        dir_path = really_recv(s, 4096).decode()  # receive directory path
-        dir_name = os.path.basename(dir_path)
-        dir_path = os.path.join(base_dir, dir_name)
-        os.mkdir(dir_path)                        # create the directory
-        num_items = int(really_recv(s, 4096).decode())   # receive the number of items in the directory
-        for _ in range(num_items):
-            key = really_recv(s, 4096).decode()   # receive the key (file or directory)
-            if key == 'f':                        # receive a file
-                self.receive_file(s, dir_path)
-            elif key == 'd':
-                self.receive_dir(s, dir_path)
+            return s.recv_msg()
 
     def receive_file(self, s, base_dir="./"):
-        file_path = really_recv(s, 4096).decode()   # receive file path
+        file_path = s.recv_msg()                    # receive file path
         file_name = os.path.basename(file_path)
-        file_size = really_recv(s, 4096).decode()   # receive file size
-        received_data = bytearray()
-        while len(received_data) < int(file_size):
-            chunk = s.recv(4096)
-            received_data.extend(chunk)
+        file_size = s.recv_msg()                    # receive file size
         file_path = os.path.join(base_dir, file_name)
-        with open(file_path, "wb") as file:
-            file.write(received_data)
+        try:
+            receive_body(s, file_path, int(file_size))      # streamed to disk in fixed-size chunks
+        except ConnectionError:
+            raise
+        except (ValueError, OSError) as e:                 # the body has been read off the connection
+            return f"Error: {e}"
+
+    def resume_file(self, s, base_dir="./"):
+        file_path = os.path.join(base_dir, os.path.basename(s.recv_msg()))
+        file_size = int(s.recv_msg())
+        offset = min(partial_size(file_path), file_size)    # report what is already here
+        s.send_msg(f"{offset} {tail_digest(partial_path(file_path), offset)}")
+        start = int(s.recv_msg())                           # where the server agreed to continue
+        try:
+            receive_body(s, file_path, file_size, start)
+        except ConnectionError:
+            raise
+        except (ValueError, OSError) as e:
+            return f"Error: {e}"
 
     def handle_put(self, s, message):
-        s.sendall(f"{len(message)}~".encode())
-        s.sendall(f"{message}~".encode())
+        s.send_msg(message)
         message = message.split()
         recursive = is_recursive(message)
+        streams = int(pop_option(message, "-j", 0))
+        resume = pop_flag(message, "--resume")
         path = os.path.abspath(message[1])
-        if os.path.isdir(path) and recursive:
-            s.sendall("d~".encode())
-            self.send_directory(s, path)
-            return really_recv(s, 4096).decode()
-        elif os.path.isdir(path):
-            s.sendall("d~".encode())
-            s.sendall(f"{path}~".encode())
-            s.sendall("0~".encode())
-            return really_recv(s, 4096).decode()
+        if streams:
+            return self.parallel_put(s, path, recursive, streams)
+        if resume and os.path.isfile(path):
+            self.resume_put(s, path)
+            return s.recv_msg()
+        if os.path.isdir(path):
+            self.send_directory(s, path, recursive)
+            return s.recv_msg()
         else:
-            s.sendall("f~".encode())
+            s.send_msg("f")
             self.send_file(s, path)
-            return really_recv(s, 4096).decode()
+            return s.recv_msg()
+
+    def resume_put(self, s, file_path):
+        file_size = os.path.getsize(file_path)
+        s.send_msg("r", file_path, f"{file_size}")
+        offset, _, digest = s.recv_msg().partition(" ")
+        start = resume_offset(file_path, int(offset), digest, file_size)
+        s.send_msg(f"{start}")
+        send_body(s, file_path, file_size - start, start)
 
     def send_file(self, s, file_path):
         try:
-            s.sendall(f"{file_path}~".encode())
             file_size = os.path.getsize(file_path)
-            s.sendall(f"{file_size}~".encode())
-            with open(file_path, "rb") as file:         
-                s.sendfile(file)
+            s.send_msg(file_path, f"{file_size}")
+            send_body(s, file_path, file_size)
+        except ConnectionError:
+            raise
         except Exception as e:
             print(f"Error: {e}")
 
-    def send_directory(self, s, dir_path):
+    def send_directory(self, s, dir_path, recursive=True):
+        try:
+            manifest = build_manifest(dir_path, recursive)
+        except OSError as e:
+            print(f"Error: {e}")
+            manifest = []
+        s.send_msg("d", json.dumps(manifest))   # the whole tree in one frame, then the file bodies
+        send_bodies(s, dir_path, manifest)
+
+    def handle_sync(self, s, message):
+        content = message.split()
+        pull = pop_flag(content, "--pull")
+        if len(content) < 2:
+            return "Error: No directory name provided"
+        path = os.path.abspath(content[1])
+        if not pull and not os.path.isdir(path):
+            return f"Error: {content[1]} is not a directory"
+        s.send_msg(message)
+        response = s.recv_msg()
+        if response != "ok":
+            return response
+        if pull:
+            stats = sync_receive(s, "./")
+        else:
+            stats = sync_send(s, path)
+        return describe_sync(stats)
+
+    def open_stream(self):
+        try:
+            conn = self.dial()
+        except OSError:
+            return None
+        try:
+            # ranges carry a digest when the stream agrees on a checksum, like the control connection
+            conn.send_msg(f"checksum {self.checksum}" if self.checksum else "pwd")
+            reply = conn.recv_msg()
+            if not reply.startswith("Error"):
+                if self.checksum:
+                    conn.checksum = negotiate(reply, CHECKSUMS)
+                self.keep_session(conn)
+                return conn
+        except OSError:
+            pass
+        conn.close()
+        return None
+
+    def run_streams(self, s, ranges, streams, transfer):
+        # the control connection doubles as the first stream, extra streams that fail to open are skipped
+        work = queue.Queue()
+        for item in ranges:
+            work.put(item)
+        conns = [s] + [conn for conn in (self.open_stream() for _ in range(streams - 1)) if conn]
+        errors = []
+
+        def worker(conn):
+            while not errors:
+                batch = take_batch(work)
+                if not batch:
+                    return
+                try:
+                    transfer(conn, batch)
+                except ConnectionError:
+                    for item in batch:
+                        work.put(item)
+                    return
+                except RuntimeError as e:
+                    errors.append(str(e))
+                    return
+
+        threads = [threading.Thread(target=worker, args=(conn,)) for conn in conns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for conn in conns[1:]:
+            try:
+                conn.send_msg("exit")
+            except OSError:
+                pass
+            conn.close()
+        if errors:
+            return errors[0]
+        if not work.empty():
+            return "Error: Every transfer stream failed"
+        return None
+
+    def fetch_ranges(self, conn, base, batch, fds):
+        # every pget of the batch is sent at once, then the replies are read in order
+        conn.send_msg(*[f"pget {offset} {length} {remote_path(base, path)}" for path, offset, length in batch])
+        error = None
+        for path, offset, length in batch:
+            reply = conn.recv_msg()
+            if reply != "ok":
+                error = error or reply
+                continue
+            try:
+                receive_range(conn, fds[path], offset, length, f"{path} at {offset}")
+            except ConnectionError:
+                raise
+            except (ValueError, OSError) as e:
+                error = error or f"Error: {e}"
+        if error:
+            raise RuntimeError(error)
+
+    def send_ranges(self, conn, base, batch, local_base):
+        for path, offset, length in batch:
+            conn.send_msg(f"pput {offset} {length} {remote_path(base, path)}")
+            send_digested(conn, os.path.join(local_base, path), length, offset)
+        error = None
+        for _ in batch:
+            reply = conn.recv_msg()
+            if reply != "ok":
+                error = error or reply
+        if error:
+            raise RuntimeError(error)
+
+    def parallel_get(self, s, base, manifest, streams):
+        fds = {}
+        error = None
+        try:
+            for path, kind, size, _ in manifest:
+                target = safe_join("./", path)
+                if kind == "d":
+                    os.makedirs(target, 0o766, exist_ok=True)
+                else:
+                    fds[path] = open_partial(target, size)
+            error = self.run_streams(s, split_ranges(manifest), streams,
+                                     lambda conn, batch: self.fetch_ranges(conn, base, batch, fds))
+        except (ValueError, OSError) as e:
+            if isinstance(e, ConnectionError):
+                raise
+            error = f"Error: {e}"
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+            commit_partials("./", manifest, error is None)
+        return error
+
+    def parallel_put(self, s, path, recursive, streams):
+        try:
+            manifest = build_manifest(path, recursive)
+        except OSError as e:
+            print(f"Error: {e}")
+            manifest = []
+        s.send_msg("j", json.dumps(manifest))
+        reply = s.recv_msg()
+        if reply != "ok":
+            return reply
+        base = s.recv_msg()
+        local_base = os.path.dirname(path)
+        error = self.run_streams(s, split_ranges(manifest), streams,
+                                 lambda conn, batch: self.send_ranges(conn, base, batch, local_base))
+        s.send_msg("pdone abort" if error else "pdone")
+        response = s.recv_msg()
+        return error or response
+
+
+class FileClientPool:
+    # Warm, negotiated connections shared between threads. Every call borrows a connection for as long as it
+    # runs, so up to size callers proceed side by side. cd state lives on the server side of a connection,
+    # so each call names the directory it works in and the borrowed connection is moved there first.
+    def __init__(self, host, port, size=POOL_SIZE, codec=None, checksum=DEFAULT_CHECKSUM, tls=None):
+        self.client = FileClient(host, port, codec, checksum, tls)
+        self.size = size
+        self.idle = []          # (conn, last used), most recently used last
+        self.places = {}        # conn -> its directory relative to the serving root, None when unknown
+        self.opened = 0
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def session(self, cwd=""):
+        return PoolSession(self, remote_dir("", cwd))
+
+    def acquire(self, cwd=""):
+        # an idle connection already sitting in cwd is preferred, then the warmest one, then a new one
+        with self.ready:
+            while not self.idle and self.opened >= self.size and not self.closed:
+                self.ready.wait()
+            if self.closed:
+                raise ConnectionError("The connection pool is closed")
+            if self.idle:
+                at = [i for i, (conn, _) in enumerate(self.idle) if self.places.get(conn) == cwd]
+                conn, used = self.idle.pop(at[-1] if at else -1)
+            else:
+                conn, used = None, None
+                self.opened += 1
+        try:
+            if conn and time.monotonic() - used > POOL_IDLE and not self.alive(conn):
+                self.places.pop(conn, None)
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = self.client.open()
+                self.places[conn] = ""
+        except BaseException:
+            with self.ready:
+                self.opened -= 1
+                self.ready.notify()
+            raise
+        return conn
+
+    def alive(self, conn):
+        try:
+            conn.send_msg("pwd")
+            return not conn.recv_msg().startswith("Error")
+        except (OSError, ValueError):
+            return False
+
+    def release(self, conn, healthy=True):
+        with self.ready:
+            if healthy and not self.closed:
+                self.idle.append((conn, time.monotonic()))
+                self.ready.notify()
+                return
+            self.places.pop(conn, None)
+            self.opened -= 1
+            self.ready.notify()
+        conn.close()
+
+    @contextlib.contextmanager
+    def borrow(self, cwd=""):
+        # RuntimeError is a refusal read off the wire in full; anything else may leave replies unread,
+        # including a caller abandoning a generator halfway, and costs the connection
+        conn = self.acquire(cwd)
+        healthy = False
+        try:
+            self.move(conn, cwd)
+            yield conn
+            healthy = True
+        except RuntimeError:
+            healthy = True
+            raise
+        finally:
+            self.release(conn, healthy)
+
+    def move(self, conn, cwd):
+        # cd is relative and a bare cd returns to the serving root, both go out in one write
+        place = self.places.get(conn)
+        if place == cwd:
+            return
+        messages = ["cd"] * (place != "") + [f"cd {cwd}"] * bool(cwd)
+        self.places[conn] = None
+        conn.send_msg(*messages)
+        replies = [conn.recv_msg() for _ in messages]
+        for reply in replies:
+            if reply.startswith("Error"):
+                raise RuntimeError(reply)
+        self.places[conn] = cwd
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.ready.notify_all()
+        for conn, _ in idle:
+            try:
+                self.client.handle_exit(conn)
+            except (OSError, ValueError):
+                pass
+            conn.close()
+
+    def execute(self, message, cwd=""):
+        # a single-reply command other than cd, returned as text
+        command = message.split()[0]
+        if command not in PIPELINED_COMMANDS - {"cd"}:
+            raise ValueError(f"{command} cannot be run through the pool")
+        with self.borrow(cwd) as conn:
+            conn.send_msg(message)
+            return conn.recv_msg()
+
+    def pipeline(self, messages, cwd=""):
+        # many single-reply commands in one round trip on one connection, replies in order
+        for message in messages:
+            if message.split()[0] not in PIPELINED_COMMANDS - {"cd"}:
+                raise ValueError(f"{message.split()[0]} cannot be run through the pool")
+        with self.borrow(cwd) as conn:
+            return self.client.pipeline(conn, messages)
+
+    def listdir(self, path="", cwd=""):
+        # yields (name, kind, size, mtime) as the batches arrive; kind is 'd' or 'f', mtime in nanoseconds
+        return self.entries(f"ls {path}".strip(), cwd)
+
+    def find(self, pattern, path="", cwd=""):
+        # yields (path, kind, size, mtime) from the server's index, paths relative to the serving root
+        return self.entries(" ".join(["find", *[path] * bool(path), pattern]), cwd)
+
+    def entries(self, message, cwd=""):
+        with self.borrow(cwd) as conn:
+            conn.send_msg(message)
+            reply = conn.recv_msg()
+            if reply != "success":
+                raise RuntimeError(reply)
+            while True:
+                frame = conn.recv_msg()
+                if frame.startswith("Error"):
+                    raise RuntimeError(frame)
+                batch = json.loads(frame)
+                if isinstance(batch, dict):
+                    return
+                for entry in batch:
+                    yield tuple(entry)
+
+    def iter_bytes(self, path, cwd=""):
+        # yields a remote file in chunks as they arrive, nothing touches the local disk
+        with self.borrow(cwd) as conn:
+            conn.send_msg(f"get {path}")
+            key = conn.recv_msg()
+            if key == "e":
+                raise RuntimeError(conn.recv_msg())
+            if key != "f":
+                raise IsADirectoryError(f"{path} is a directory")   # the tree is on its way, drop the connection
+            name = conn.recv_msg()
+            if name.startswith("Error"):
+                conn.recv_msg()
+                raise RuntimeError(name)
+            size = int(conn.recv_msg())
             try:
-                s.sendall(f"{dir_path}~".encode())
-                contents_list = listDirectory(dir_path)
-                s.sendall(f"{len(contents_list)}~".encode()) 
-                for item in contents_list:
-                    item_path = os.path.join(dir_path, item)
-                    if os.path.isfile(item_path):
-                        s.sendall("f~".encode())
-                        self.send_file(s, item_path)
-                    elif os.path.isdir(item_path):
-                        s.sendall("d~".encode())
-                        self.send_directory(s, item_path)
-            except Exception as e:
-                print(f"Error: {e}")
+                yield from body_chunks(conn, size, path)
+            except ValueError as e:
+                conn.recv_msg()
+                raise RuntimeError(f"Error: {e}")
+            conn.recv_msg()
+
+    def get_bytes(self, path, cwd=""):
+        return b"".join(self.iter_bytes(path, cwd))
+
+    def put_bytes(self, path, data, cwd="", size=None):
+        # data is bytes, or any iterable of chunks when size says how long it is in total
+        folder, name = os.path.split(path)
+        if name in ("", ".", ".."):
+            raise ValueError(f"{path} does not name a file")
+        if size is None:
+            data, size = [data], len(data)
+        with self.borrow(remote_dir(cwd, folder)) as conn:
+            conn.send_msg(f"put {name}", "f", name, f"{size}")
+            complete = send_chunks(conn, data, size)
+            reply = conn.recv_msg()
+            if reply.startswith("Error"):
+                raise RuntimeError(reply)
+            if not complete:
+                raise RuntimeError(f"Error: {path} did not come to {size} bytes")
+            return reply
+
+
+class PoolSession:
+    # a working directory of its own over the shared connections of a FileClientPool
+    def __init__(self, pool, cwd=""):
+        self.pool = pool
+        self.cwd = cwd
+
+    def cd(self, path=""):
+        cwd = remote_dir(self.cwd, path) if path else ""
+        with self.pool.borrow(cwd):     # moving a connection there proves the directory exists
+            pass
+        self.cwd = cwd
+        return cwd
+
+    def pwd(self):
+        return self.cwd
+
+    def execute(self, message):
+        return self.pool.execute(message, self.cwd)
+
+    def pipeline(self, messages):
+        return self.pool.pipeline(messages, self.cwd)
+
+    def listdir(self, path=""):
+        return self.pool.listdir(path, self.cwd)
+
+    def iter_bytes(self, path):
+        return self.pool.iter_bytes(path, self.cwd)
+
+    def get_bytes(self, path):
+        return self.pool.get_bytes(path, self.cwd)
+
+    def put_bytes(self, path, data, size=None):
+        return self.pool.put_bytes(path, data, self.cwd, size)
+
+
+class ClusterClient:
+    # Several servers, each holding a shard of the files: a file lives on the first replicas nodes clockwise from
+    # its path on a HashRing. Directories exist on every node, so mkdir, ls and find go to all of them at once.
+    def __init__(self, nodes, replicas=1, size=POOL_SIZE, codec=None, checksum=DEFAULT_CHECKSUM, tls=None):
+        self.replicas = replicas
+        self.options = (size, codec, checksum, tls)
+        self.ring = HashRing()
+        self.pools = {}             # "host:port" -> FileClientPool
+        self.fanout = ThreadPoolExecutor(max_workers=CLUSTER_THREADS)
+        self.cwd = ""
+        for node in nodes:
+            self.attach(node)
+
+    def attach(self, node):
+        host, port = split_node(node)
+        self.pools[node] = FileClientPool(host, port, *self.options)
+        self.ring.add(node)
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.fanout.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def key(self, path):
+        return remote_dir(self.cwd, path)
+
+    def owners(self, key):
+        return self.ring.owners(key, self.replicas)
+
+    def each(self, func, nodes=None):
+        # func(pool) on every node at once; node -> its result, or the exception it raised
+        nodes = list(self.pools if nodes is None else nodes)
+        futures = {node: self.fanout.submit(func, self.pools[node]) for node in nodes}
+        results = {}
+        for node, future in futures.items():
+            try:
+                results[node] = future.result()
+            except (OSError, ValueError, RuntimeError) as e:
+                results[node] = e
+        return results
+
+    def merged(self, results):
+        # what the nodes that answered said; a failure only when every node failed
+        answers = {node: result for node, result in results.items() if not isinstance(result, Exception)}
+        if not answers:
+            raise next(iter(results.values()), RuntimeError("Error: The cluster has no nodes"))
+        return answers
+
+    def cd(self, path=""):
+        key = self.key(path) if path else ""
+        self.merged(self.each(lambda pool: pool.execute("pwd", key)))
+        self.cwd = key
+        return f"/{key}"
+
+    def pwd(self):
+        return f"/{self.cwd}"
+
+    def listdir(self, path=""):
+        # one listing merged from every node; a replicated file counts once, with its newest copy
+        key = self.key(path)
+        entries = {}
+        for listing in self.merged(self.each(lambda pool: list(pool.listdir(f"/{key}")))).values():
+            for entry in listing:
+                if entry[0] not in entries or entries[entry[0]][3] < entry[3]:
+                    entries[entry[0]] = entry
+        return sorted(entries.values())
+
+    def find(self, pattern, path=""):
+        key = self.key(path)
+        rows = {}
+        for found in self.merged(self.each(lambda pool: list(pool.find(pattern, f"/{key}")))).values():
+            for row in found:
+                rows.setdefault(row[0], row)
+        return sorted(rows.values())
+
+    def mkdir(self, path):
+        key = self.key(path)
+        replies = self.each(lambda pool: pool.execute(f"mkdir /{key}"))
+        return first_reply(replies.values())
+
+    def remove(self, path, recursive=False):
+        # a file goes from the nodes that own it; a directory, or anything its owners do not have, from all of them
+        key = self.key(path)
+        command = f"rm -r /{key}" if recursive else f"rm /{key}"
+        owners = [] if recursive else self.owners(key)
+        replies = self.each(lambda pool: pool.execute(command), owners)
+        if owners and all(reply == "" for reply in replies.values()):
+            return ""
+        replies.update(self.each(lambda pool: pool.execute(command), [node for node in self.pools if node not in owners]))
+        found = [reply for reply in replies.values() if not isinstance(reply, Exception) and "cannot be found" not in reply]
+        return first_reply(found or list(replies.values()))
+
+    def read(self, key, consume):
+        # the first owner that answers; replicas are only tried when it cannot
+        error = None
+        for node in self.owners(key):
+            try:
+                return consume(self.pools[node])
+            except (OSError, RuntimeError) as e:
+                error = e
+        raise error
+
+    def get_bytes(self, path):
+        key = self.key(path)
+        return self.read(key, lambda pool: pool.get_bytes(key))
+
+    def get_file(self, path, local_path):
+        key = self.key(path)
+
+        def download(pool):
+            fd = open_partial(local_path, 0)
+            complete = False
+            try:
+                for chunk in pool.iter_bytes(key):
+                    write_all(fd, chunk)
+                complete = True
+            finally:
+                close_partial(fd, local_path, complete)
+            return os.path.getsize(local_path)
+        return self.read(key, download)
+
+    def write(self, key, send):
+        # every owner gets the file at once; a single failure fails the put
+        results = self.each(send, self.owners(key))
+        for node, result in results.items():
+            if isinstance(result, Exception):
+                raise RuntimeError(f"Error: {key} could not be stored on {node}: {result}")
+        return first_reply(results.values())
+
+    def put_bytes(self, path, data):
+        key = self.key(path)
+        return self.write(key, lambda pool: pool.put_bytes(key, data))
+
+    def put_file(self, local_path, path=None):
+        key = self.key(path or os.path.basename(local_path))
+        size = os.path.getsize(local_path)
+
+        def upload(pool):
+            with open(local_path, "rb") as file:
+                return pool.put_bytes(key, iter(lambda: file.read(STREAM_CHUNK), b""), size=size)
+        return self.write(key, upload)
+
+    def add_node(self, node):
+        self.attach(node)
+        return self.rebalance()
+
+    def remove_node(self, node):
+        # its files are copied to their new owners before it leaves
+        self.ring.remove(node)
+        try:
+            return self.rebalance()
+        finally:
+            self.pools.pop(node).close()
+
+    def inventory(self, pool):
+        # (directories, {path: (size, mtime)}) of one node, walked with ls
+        dirs, files, stack = [], {}, [""]
+        while stack:
+            rel_dir = stack.pop()
+            for name, kind, size, mtime in pool.listdir(f"/{rel_dir}"):
+                path = f"{rel_dir}/{name}" if rel_dir else name
+                if name.startswith(".") and name.endswith(".part"):
+                    continue        # an upload still in flight
+                if kind == "d":
+                    dirs.append(path)
+                    stack.append(path)
+                elif kind == "f":
+                    files[path] = (size, mtime)
+        return dirs, files
+
+    def rebalance(self):
+        # Compares where every file is with where the ring wants it. Only files whose owners changed are copied,
+        # from their newest copy, and then dropped from the nodes that no longer own them.
+        held = {}
+        for node, inventory in self.each(self.inventory).items():
+            if isinstance(inventory, Exception):
+                raise RuntimeError(f"Error: Cannot list {node}: {inventory}")
+            held[node] = inventory
+        every_dir = sorted(set().union(*(dirs for dirs, _ in held.values())))
+        for node, (dirs, _) in held.items():
+            missing = set(every_dir) - set(dirs)
+            if node in self.ring.nodes and missing:
+                self.pools[node].pipeline([f"mkdir /{path}" for path in every_dir if path in missing])
+        holders = {}
+        for node, (_, files) in held.items():
+            for path, (size, mtime) in files.items():
+                holders.setdefault(path, []).append((mtime, size, node))
+        stats = {"files": len(holders), "moved": 0, "dropped": 0, "bytes": 0}
+        for path, copies in holders.items():
+            wanted = self.owners(path)
+            mtime, size, source = max(copies)
+            present = {node for _, _, node in copies}
+            for node in wanted:
+                if node not in present:
+                    self.pools[node].put_bytes(path, self.pools[source].iter_bytes(path), size=size)
+                    stats["moved"] += 1
+                    stats["bytes"] += size
+            for node in present - set(wanted):
+                reply = self.pools[node].execute(f"rm /{path}")
+                if reply.startswith("Error"):
+                    raise RuntimeError(reply)
+                stats["dropped"] += 1
+        return stats
+
+    def execute(self, message):
+        # the shell's commands, answered as text
+        content = message.split()
+        command, args = content[0], content[1:]
+        try:
+            if command in ("ls", "find"):
+                long = pop_flag(args, "-l")
+                entries = self.listdir(*args[:1]) if command == "ls" else self.find(args[-1], *args[:-1][:1])
+                print_entries(entries, long)
+                return ""
+            if command == "cd":
+                return f"Changed server directory to {self.cd(*args[:1])}"
+            if command == "pwd":
+                return self.pwd()
+            if command == "mkdir":
+                return self.mkdir(args[0])
+            if command == "rm":
+                recursive = is_recursive(args)
+                return self.remove(args[0], recursive)
+            if command == "get":
+                local_path = args[1] if len(args) > 1 else os.path.basename(args[0])
+                return f"Received {local_path}, {self.get_file(args[0], local_path)} bytes"
+            if command == "put":
+                return self.put_file(args[0], *args[1:2])
+            if command == "nodes":
+                return "\n".join(f"{node}  {len([1 for point in self.ring.points if point[1] == node])} points"
+                                 for node in self.ring.nodes)
+            if command in ("join", "leave"):
+                stats = self.add_node(args[0]) if command == "join" else self.remove_node(args[0])
+                return describe_rebalance(stats)
+        except IndexError:
+            return f"Error: {command} is missing an argument"
+        except (OSError, ValueError, RuntimeError) as e:
+            return str(e) if str(e).startswith("Error") else f"Error: {e}"
+        return f"Unknown command: \'{message}\'"
+
+    def batch(self, lines):
+        failures = 0
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line == "exit":
+                break
+            response = self.execute(line)
+            if response:
+                print(response)
+                if response.startswith(("Error", "Unknown command")):
+                    failures += 1
+        return failures
+
+    def connect(self):
+        try:
+            while True:
+                message = input("~ ")
+                if not message:
+                    continue
+                if message == "exit":
+                    break
+                response = self.execute(message)
+                if response:
+                    print(response)
+        except (KeyboardInterrupt, EOFError):
+            print("\nExiting...")
+
+
+def split_node(node):
+    host, _, port = node.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"{node} is not host:port")
+    return host, int(port)
+
+
+def first_reply(replies):
+    # an error if any node refused, otherwise what the first one said
+    replies = list(replies)
+    for reply in replies:
+        if isinstance(reply, Exception) or reply.startswith("Error"):
+            return str(reply)
+    return replies[0] if replies else ""
+
+
+def describe_rebalance(stats):
+    return f"Rebalanced {stats['files']} files: {stats['moved']} copies made ({stats['bytes']} bytes), {stats['dropped']} dropped"
+
+
+def print_entries(entries, long=False):
+    for name, kind, size, mtime in entries:
+        label = f"{name}\\" if kind == 'd' else name
+        if long:
+            stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime / 1e9))
+            label = f"{kind} {size:>12} {stamp} {label}"
+        if kind == 'd':
+            prCyan(label)
+        else:
+            prGreen(label)
+
+
+def remote_dir(cwd, path):
+    # relative to cwd, or to the serving root with a leading /; the root itself is ""
+    path = os.path.normpath(path if path.startswith("/") else os.path.join("/", cwd, path))
+    return path.lstrip("/")
+
+
+def remote_path(base, path):
+    return os.path.normpath(os.path.join(base, path))
+
+
+def take_batch(work):
+    # either one large range or up to STREAM_BATCH small ones
+    batch, total = [], 0
+    while len(batch) < STREAM_BATCH and total < STREAM_CHUNK:
+        try:
+            item = work.get_nowait()
+        except queue.Empty:
+            break
+        batch.append(item)
+        total += item[2]
+    return batch
 
 
 def parse():
     parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument('-h', help='Host', required=True)
-    parser.add_argument('-p', type=int, help='Port', required=True)
+    parser.add_argument('-h', help='Host')
+    parser.add_argument('-p', type=int, help='Port')
+    parser.add_argument('--cluster', help='Servers sharing the files between them, as host:port,host:port,...')
+    parser.add_argument('--replicas', type=int, default=1, help='Copies of every file kept in a cluster (default 1)')
+    parser.add_argument('-z', help=f"Compression codecs to offer, e.g. {','.join(CODECS)}")
+    parser.add_argument('--checksum', choices=[*CHECKSUMS, 'none'], default=DEFAULT_CHECKSUM,
+                        help='Digest verifying every file transfer (default %(default)s)')
+    parser.add_argument('--no-sparse', action='store_true', help='Send and receive holes in files as zeros')
+    parser.add_argument('-b', help='Run the commands in this file, or - for stdin, instead of prompting')
+    parser.add_argument('--tls', action='store_true', help='Connect over TLS, trusting the system certificates')
+    parser.add_argument('--tls-ca', help='Connect over TLS, trusting this certificate (e.g. a self-signed server one)')
     args = parser.parse_args()
+    if not args.cluster and (args.h is None or args.p is None):
+        parser.error("-h and -p are required unless --cluster is given")
     return args
 
 
 def main():
     args = parse()
     
-    client = FileClient(args.h, int(args.p))
-    client.connect()
+    checksum = None if args.checksum == "none" else args.checksum
+    tls = client_tls(args.tls_ca) if args.tls or args.tls_ca else None
+    if args.cluster:
+        client = ClusterClient(args.cluster.split(","), args.replicas, codec=args.z, checksum=checksum, tls=tls)
+    else:
+        client = FileClient(args.h, int(args.p), args.z, checksum, tls, not args.no_sparse)
+    try:
+        if args.b:
+            try:
+                with (open(args.b) if args.b != "-" else sys.stdin) as script:
+                    failures = client.batch(script)
+            except OSError as e:
+                print(e)
+                sys.exit(2)
+            sys.exit(1 if failures else 0)
+        client.connect()
+    finally:
+        if args.cluster:
+            client.close()
 
 
 if __name__ == "__main__":
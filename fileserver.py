@@ -4,57 +4,303 @@
 
 
 from library import *
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import argparse
+import asyncio
+import collections
+import logging
+import select
 import socket
-import shutil
 import signal
+import threading
 import time
 import os
 
+log = logging.getLogger("fileserver")
+
+
+class ClientSession(FramedSocket):
+    def __init__(self, sock, current_dir):
+        super().__init__(sock)
+        self.current_dir = current_dir
+        self.pending_put = None     # (directory, manifest) of a parallel upload awaiting pdone
+        self.failed = False         # set when the current command answers with an error
+        self.counted = (0, 0)       # TCP bytes out and in already credited to metrics
+        self.tag = None             # "#id" of a pipelined command, put in front of its reply
+        self.outbox = None          # replies held back while more pipelined requests are buffered
+
+    def send_msg(self, *messages):
+        if any(isinstance(message, str) and message.startswith("Error") for message in messages):
+            self.failed = True
+        messages = tag_reply(self, messages)
+        if self.outbox is None:
+            super().send_msg(*messages)
+            return
+        self.outbox += pack_frames(*messages)
+        if len(self.outbox) >= BUFFER_SIZE:
+            self.flush()
+            self.outbox = bytearray()
+
+    def hold(self):
+        if self.outbox is None:
+            self.outbox = bytearray()
+
+    def flush(self):
+        if self.outbox:
+            self.sock.sendall(self.outbox)     # replies are never paced, only bodies
+        self.outbox = None
+
+
+def tag_reply(session, messages):
+    # the first frame answering a tagged command carries the tag
+    if not session.tag:
+        return messages
+    first = messages[0]
+    first = f"{session.tag} {first}" if isinstance(first, str) else session.tag.encode() + b" " + first
+    session.tag = None
+    return (first, *messages[1:])
+
+
+def split_tag(content):
+    if content and content[0].startswith("#"):
+        return content[0], content[1:]
+    return None, content
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def metrics_endpoint(metrics, port):
+    # bound up front so a taken port fails at startup, served by a child process or a thread
+    httpd = HTTPServer(("127.0.0.1", port), MetricsHandler)
+    httpd.metrics = metrics
+    return httpd
+
+
+def file_slice(file_path, file_size, offset, length):
+    # a ranged get is named after its range, so the client never writes a slice over a whole copy
+    start = max(0, min(offset, file_size))
+    end = file_size if length is None else max(start, min(start + length, file_size))
+    if not offset and length is None:
+        return file_path, start, end - start
+    return f"{file_path}.{start}-{end}", start, end - start
+
+
+def range_error(file_path, offset, length, size):
+    if offset < 0 or length < 0 or offset + length > size:
+        return f"Error: Range {offset}+{length} is outside {file_path}"
+    return None
+
+
+def exit_with_parent(parent, interval=1):
+    # a helper child whose server died without stopping it (SIGKILL, a crash) must not run on, holding its port
+    while os.getppid() == parent:
+        time.sleep(interval)
+    os._exit(0)
+
 
 class FileServer:
-    def __init__(self, host, port, serve_dir):
+    def __init__(self, host, port, serve_dir, max_clients=4, index=None, hashes=None):
         self.host = host
         self.port = port
         self.serve_dir = serve_dir
-        self.current_dir = self.serve_dir
-        self.active_clients = []
+        self.max_clients = max_clients
+        self.active_clients = []    # the connection served by a child process
+        self.workers = {}           # pid -> metrics shard of the live children, tracked by the parent
+        self.listings = ListingCache()  # shared by every session with asyncio, per worker when forking
+        self.files = FileCache()        # hot files for single-file gets, the same; None when disabled.
+                                        # The parent never fills it, so a forked worker only reuses its own gets
+        self.index = index          # MetadataIndex behind find and du, None when disabled
+        self.indexer = None         # pid of the child keeping the index current
+        self.stale = set()          # directories changed by this process, refreshed in the index in batches
+        self.stale_lock = threading.Lock()
+        self.hashes = hashes or HashCache()     # digests of unchanged files for checksum trailers
+        self.metrics = Metrics(max_clients + 1)     # one shard per worker, shared memory survives the fork
+        self.metrics_port = None    # Prometheus endpoint on localhost, None when disabled
+        self.exporter = None        # pid of the child serving it
+        self.trace = None           # fd that per-command spans are appended to, None when disabled
+        self.tls = None             # server SSLContext, None for plain TCP
+        self.jobs = JobManager()    # background rm -r, cp, mv, reindex and hash; per worker when forking
+        self.listener = None        # the listening socket, closed in every child
+        self.queue_size = ADMISSION_QUEUE   # connections held back while every slot is busy
+        self.queue_wait = ADMISSION_WAIT    # seconds one is held before it is told when to retry
+        self.waiting = collections.deque()  # (session, arrival) in the parent, admitted oldest first
+        self.started = {}           # pid -> when its session began, for the retry hint
+        self.session_seconds = 1.0  # moving average of how long sessions last
+        self.wakeup = None          # pipe the SIGCHLD handler writes to, so a freed slot is filled at once
+        self.shaper = None          # Shaper capping body bandwidth, None for no cap
+        self.weights = {}           # client address -> its weight in the shaper's split, 1 when absent
+
+    def start_child(self, target):
+        # a separate process rather than a thread, so forked workers never inherit a held lock
+        parent = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                if self.listener:
+                    self.listener.close()
+                threading.Thread(target=exit_with_parent, args=(parent,), daemon=True).start()
+                target()
+            finally:
+                os._exit(0)
+        return pid
 
     def run(self):
         signal.signal(signal.SIGINT, self.__exit_signal_handler)
+        signal.signal(signal.SIGTERM, self.__exit_signal_handler)
+        signal.signal(signal.SIGCHLD, self.__reap_workers)
         changeDirectory(self.serve_dir)
+        if self.index:
+            self.indexer = self.start_child(self.index.run_forever)
+        if self.metrics_port:
+            httpd = metrics_endpoint(self.metrics, self.metrics_port)
+            self.exporter = self.start_child(httpd.serve_forever)
+            httpd.server_close()
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[1], False)
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            self.listener = s
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind((self.host, self.port))
-            s.listen(5)
+            s.listen(max(5, self.max_clients))
             while True:
                 try:
-                    if len(self.active_clients) >= 4:
+                    self.__admit(s)
+                    timeout = self.queue_wait - (time.monotonic() - self.waiting[0][1]) if self.waiting else None
+                    ready, _, _ = select.select([s, self.wakeup[0]], [], [], max(0, timeout) if timeout is not None else None)
+                    if self.wakeup[0] in ready:
+                        os.read(self.wakeup[0], 4096)
+                    if s in ready:
                         client, _ = s.accept()
-                        client.send(b"Error: Server busy, please try again later.")
-                        client.close()
-                        continue
-                    client, _ = s.accept()
-                    pid = os.fork()
-                    if pid == 0:
-                        self.active_clients.append(client)
-                        self.__handle_client(client)
-                        self.active_clients.remove(client)
-                        os._exit(0)
-                    else:
-                        client.close()
-                        os.waitpid(pid, 0)
+                        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        self.waiting.append((ClientSession(client, self.serve_dir), time.monotonic()))
+                        if len(self.workers) >= self.max_clients:
+                            self.metrics.add("sessions_queued")
                 except ConnectionRefusedError:
-                    print(f"Error: Connection refused to {self.host}:{self.port}")
+                    log.error("Connection refused to %s:%s", self.host, self.port)
                 except OSError as e:
-                    print(e)
+                    log.error("%s", e)
+
+    def __admit(self, listener):
+        # Queued connections take free slots oldest first. The rest wait up to queue_wait, and no more than
+        # queue_size wait at once; a connection turned away is told when to retry instead of just being dropped.
+        while self.waiting and len(self.workers) < self.max_clients:
+            self.__spawn(self.waiting.popleft()[0], listener)
+        now = time.monotonic()
+        while self.waiting and now - self.waiting[0][1] >= self.queue_wait:
+            self.__turn_away(self.waiting.popleft()[0])
+        while len(self.waiting) > self.queue_size:
+            self.__turn_away(self.waiting.pop()[0])
+
+    def __turn_away(self, client):
+        log.info("Server busy, turning a client away")
+        self.metrics.add("sessions_turned_away")
+        try:
+            if not self.tls:    # the parent never spends a handshake on a client it turns away
+                client.send_msg(busy_message(retry_hint(self.session_seconds, len(self.waiting), self.max_clients)))
+        except OSError:
+            pass
+        client.close()
+
+    def __spawn(self, client, listener):
+        # a child exiting before its pid is recorded must not be reaped early
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+        try:
+            shard = self.metrics.claim()
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGCHLD])
+                listener.close()
+                for queued, _ in self.waiting:
+                    queued.sock.close()
+                os.close(self.wakeup[0])
+                os.close(self.wakeup[1])
+                self.waiting.clear()
+                self.workers.clear()
+                self.metrics.shard = shard
+                if self.tls and not self.__start_tls(client):
+                    os._exit(0)
+                client.pacer = self.pacer_for(client.sock.getpeername()[0], shard)
+                self.active_clients.append(client)
+                self.__handle_client(client)
+                self.active_clients.remove(client)
+                self.jobs.shutdown()    # jobs started by the client finish after it leaves
+                os._exit(0)
+            self.workers[pid] = shard
+            self.started[pid] = time.monotonic()
+            self.metrics.add("sessions")
+            self.metrics.add("sessions_active")
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGCHLD])
+        client.close()
+
+    def pacer_for(self, host, slot):
+        if not self.shaper:
+            return None
+        return Pacer(self.shaper, slot, self.weights.get(host, 1.0))
+
+    def session_ended(self, seconds):
+        self.session_seconds += (seconds - self.session_seconds) / 8
+
+    def __start_tls(self, client):
+        # in the worker, so a slow handshake never holds up accept
+        try:
+            client.start_tls(self.tls, server_side=True)
+        except OSError as e:
+            log.warning("TLS handshake failed: %s", e)
+            client.close()
+            return False
+        log.debug("%s, session %s", client.sock.version(), "resumed" if client.sock.session_reused else "new")
+        return True
+
+    def __reap_workers(self, sig, frame):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self.workers:
+                self.metrics.release(self.workers.pop(pid))
+                self.metrics.add("sessions_active", -1)
+                self.session_ended(time.monotonic() - self.started.pop(pid))
+                try:
+                    os.write(self.wakeup[1], b"\0")
+                except BlockingIOError:
+                    pass
 
     def __exit_signal_handler(self, sig, frame):
-        print("\nServer shutting down in 5 seconds . . .")
+        log.info("Server shutting down in 5 seconds . . .")
+        self.jobs.cancel_all()
+        pids = list(self.workers) + [pid for pid in (self.indexer, self.exporter) if pid]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
         if len(self.active_clients) > 0:
             for client in self.active_clients[:]:
                 try:
-                    client.sendall(b"Server shutting down in 5 seconds, closing connection now . . .~")
+                    client.send_msg("Server shutting down in 5 seconds, closing connection now . . .")
                 except OSError:
                     pass
                 finally:
@@ -66,10 +312,15 @@ class FileServer:
     def __handle_client(self, client):
         try:
             while True:
-                msg_length = really_recv(client, 1024).decode()
-                if msg_length != "":
-                    content = really_recv(client, int(msg_length)).decode().split()
-                    print(f"Length: {msg_length}\nContent: {content}\n")
+                client.tag, content = split_tag(client.recv_msg().split())
+                if content:
+                    log.debug("Content: %s", content)
+                    if client.pending() and content[0] in PIPELINED_COMMANDS:
+                        client.hold()       # more requests are already buffered, answer them in one write
+                    else:
+                        client.flush()
+                    began, failed = time.perf_counter(), True
+                    client.failed = False
                     actions = {
                         "cd": self.dir_change,
                         "ls": self.display_dir,
@@ -78,248 +329,1619 @@ class FileServer:
                         "rm": self.remove,
                         "get": self.get_file,
                         "put": self.put_file,
+                        "pget": self.get_range,
+                        "pput": self.put_range,
+                        "pdone": self.finish_parallel_put,
+                        "sync": self.sync_dir,
+                        "codec": self.set_codec,
+                        "checksum": self.set_checksum,
+                        "find": self.find,
+                        "du": self.disk_usage,
+                        "stats": self.show_stats,
+                        "cp": self.copy,
+                        "mv": self.move,
+                        "jobs": self.list_jobs,
+                        "wait": self.wait_jobs,
+                        "cancel": self.cancel_jobs,
+                        "reindex": self.reindex,
+                        "hash": self.hash_tree,
+                        "priority": self.set_priority,
+                        "sparse": self.set_sparse,
                     }
-                    if content[0] in actions:
-                        actions[content[0]](client, content)
-                    elif content[0] == "exit":
-                        client.sendall(f"Exiting~".encode())
-                        break;
-                    else:
-                        client.sendall(b"Unknown content recieved, ignoring . . .~")
-                        print("Unknown content recieved, ignoring . . .")
+                    try:
+                        if content[0] in actions:
+                            actions[content[0]](client, content)
+                        elif content[0] == "exit":
+                            client.send_msg("Exiting")
+                            failed = False
+                            break;
+                        else:
+                            client.send_msg("Unknown content recieved, ignoring . . .")
+                            log.info("Unknown content recieved, ignoring . . .")
+                        failed = False
+                    finally:
+                        if not client.pending():
+                            client.flush()
+                            self.refresh_index()
+                        self.command_done(client, content, began, failed)
+        except ConnectionError:
+            pass
         except Exception as e:
-            print(f"Error handling client: {e}")
+            log.error("Error handling client: %s", e)
         finally:
-            print("Closing client connection\n")
-            client.close()    
+            log.debug("Closing client connection")
+            self.session_done(client)
+            try:
+                client.flush()
+            except OSError:
+                pass
+            if client.pending_put:
+                commit_partials(*client.pending_put, False)
+            client.close()
     
-    def __prep_path(self, client, content, key=False):
+    def command_done(self, session, content, began, failed):
+        # one histogram sample per command; bytes come from the kernel's TCP_INFO counters, so a command
+        # is credited with its request and with whatever the peer acknowledged since the previous one
+        seconds = time.perf_counter() - began
+        after = tcp_bytes(session.sock)
+        failed = failed or session.failed
+        sent, received = after[0] - session.counted[0], after[1] - session.counted[1]
+        session.counted = after
+        self.metrics.record(content[0], seconds, failed, sent, received)
+        if self.trace is not None:
+            span = {"ts": time.time() - seconds, "pid": os.getpid(), "session": id(session), "command": content[0],
+                    "args": content[1:], "seconds": round(seconds, 6), "bytes_out": sent, "bytes_in": received,
+                    "error": failed}
+            os.write(self.trace, (json.dumps(span) + "\n").encode())
+
+    def session_done(self, session):
+        after = tcp_bytes(session.sock)
+        self.metrics.add("bytes_out", max(0, after[0] - session.counted[0]))
+        self.metrics.add("bytes_in", max(0, after[1] - session.counted[1]))
+
+    def show_stats(self, client, content):
+        client.send_msg(self.metrics.summary() + (f"\n{self.files.summary()}" if self.files else ""))
+
+    def check_path(self, current_dir, content, must_exist=True):
         if len(content) > 1:
             if content[1][0] == "/":
                 content[1] = content[1].replace("/", "", 1)
             dir_path = content[1]
         else:
             dir_path = ""
-        full_path = os.path.abspath(os.path.join(self.current_dir, dir_path))
-        if not os.path.exists(full_path):
-            if key:
-                client.sendall("e~".encode())
-            client.sendall(f"Error: The directory {dir_path} cannot be found~".encode())
-            return "0"
+        full_path = os.path.abspath(os.path.join(current_dir, dir_path))
+        if must_exist and not os.path.exists(full_path):
+            return full_path, f"Error: The directory {dir_path} cannot be found"
         if not os.path.commonpath([full_path, self.serve_dir]) == self.serve_dir:
+            return full_path, "Error: Cannot affect directory above the serving directory"
+        return full_path, None
+
+    def __prep_path(self, client, content, key=False):
+        full_path, error = self.check_path(client.current_dir, content)
+        if error:
             if key:
-                client.sendall("e~".encode())
-            client.sendall(f"Error: Cannot affect directory above the serving directory~".encode())
+                client.send_msg("e")
+            client.send_msg(error)
             return "0"
         return full_path
 
+    def listing_options(self, content):
+        # ls [path or path/glob] [--sort name|size|mtime] [--reverse] [--limit n] [--cursor c]
+        sort = pop_option(content, "--sort")
+        if sort is not None and sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key {sort}")
+        limit = pop_option(content, "--limit")
+        if limit is not None and int(limit) < 1:
+            raise ValueError("--limit must be at least 1")
+        options = {
+            "sort": sort,
+            "reverse": pop_flag(content, "--reverse"),
+            "limit": None if limit is None else int(limit),
+            "cursor": pop_option(content, "--cursor"),
+        }
+        pattern = None
+        if len(content) > 1 and any(c in os.path.basename(content[1]) for c in "*?["):
+            dir_path, pattern = os.path.split(content[1])
+            content[1:] = [dir_path] if dir_path else []
+        return pattern, options
+
     def display_dir(self, client, content):
+        # entries stream out in batches as they are scanned, the last frame carries the next cursor
+        try:
+            pattern, options = self.listing_options(content)
+        except ValueError as e:
+            client.send_msg(f"Error: {e}")
+            return
         full_path = self.__prep_path(client, content)
-        if full_path != "0":
-            try:
-                client.sendall(f"success~".encode())
-                contents_list = listDirectory(full_path)
-                bytes_list = [s.encode()+b'~' for s in contents_list]
-                client.sendall(f"{len(bytes_list)}~".encode())
-                for item in bytes_list:
-                    client.sendall(item)
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                client.sendall(f"Error: Unable to display directory {full_path}~".encode())
+        if full_path == "0":
+            return
+        try:
+            page, cursor = list_page(self.listings.iter(full_path, pattern), **options)
+        except Exception as e:
+            log.warning("An error occurred: %s", e)
+            client.send_msg(f"Error: Unable to display directory {full_path}: {e}")
+            return
+        client.send_msg("success")
+        page = iter(page)
+        try:
+            while batch := take(page, LS_BATCH):
+                client.send_msg(json.dumps(batch))
+        except OSError as e:
+            if isinstance(e, ConnectionError):
+                raise
+            log.warning("An error occurred: %s", e)
+            client.send_msg(f"Error: Unable to display directory {full_path}")
+            return
+        client.send_msg(json.dumps({"next": cursor}))
 
     def dir_change(self, client, content):
         full_path = self.__prep_path(client, content)
         if full_path == "0":
             return
-        elif full_path == self.current_dir:
+        elif full_path == client.current_dir:
             full_path = self.serve_dir
         try:
-            changeDirectory(full_path)
-            self.current_dir = full_path
-            client.sendall(f"Changed server directory to {self.current_dir}~".encode())
+            if not os.path.isdir(full_path):
+                raise OSError(2, "Given file rather than directory")
+            client.current_dir = full_path
+            client.send_msg(f"Changed server directory to {client.current_dir}")
         except Exception as e:
-            print(f"An error occurred: {e}")
-            client.sendall(f"Error: Unable to change directory to {full_path}~".encode())
+            log.warning("An error occurred: %s", e)
+            client.send_msg(f"Error: Unable to change directory to {full_path}")
 
     def display_path(self, client, content):
-        client.sendall(f"{self.current_dir}~".encode())
+        client.send_msg(client.current_dir)
 
     def make_dir(self, client, content):
-        if len(content) > 1:
-            if content[1][0] == "/":
-                content[1] = content[1].replace("/", "", 1)
-            dir_path = content[1]
-        else:
-            dir_path = ""
-        full_path = os.path.abspath(os.path.join(self.current_dir, dir_path))
-        if not os.path.commonpath([full_path, self.serve_dir]) == self.serve_dir:
-            client.sendall(f"Error: Cannot affect directory above the serving directory~".encode())
+        full_path, error = self.check_path(client.current_dir, content, must_exist=False)
+        if error:
+            client.send_msg(error)
             return
         try:
             makeDirectory(full_path)
-            client.sendall(f"Created directory here: {full_path}~".encode())
+            self.changed(os.path.dirname(full_path))
+            client.send_msg(f"Created directory here: {full_path}")
         except Exception as e:
-            print(f"An error occurred: {e}")
-            client.sendall(f"Error: Unable to create directory {full_path}~".encode())
+            log.warning("An error occurred: %s", e)
+            client.send_msg(f"Error: Unable to create directory {full_path}")
             
     def remove(self, client, content):
         try:
             recursive = is_recursive(content)
             if len(content) < 2:
-                client.sendall("Error: No file name provided~".encode())
+                client.send_msg("Error: No file name provided")
                 return
             full_path = self.__prep_path(client, content)
+            if full_path == "0":
+                return
             if os.path.isdir(full_path) and recursive:
-                shutil.rmtree(full_path)
-                client.sendall(f"Deleted everything at {full_path}~".encode())
-            elif os.path.isdir(full_path):
-                if len(list(os.scandir(full_path))) == 0:
-                    os.rmdir(full_path)
-                    client.sendall(f"Deleted the directory {full_path}~".encode())
+                self.run_job(client, f"rm -r {full_path}", lambda job: self.delete_tree(full_path, job),
+                             [os.path.dirname(full_path)])
+                return
+            try:
+                if os.path.isdir(full_path):
+                    if len(list(os.scandir(full_path))) == 0:
+                        os.rmdir(full_path)
+                        client.send_msg(f"Deleted the directory {full_path}")
+                    else:
+                        client.send_msg(f"Error: {full_path} has contents.")
+                        return
                 else:
-                    client.sendall(f"Error: {full_path} has contents.~".encode())
-                    return
-            else:
-                os.remove(full_path)
-                client.sendall(f"~".encode())
+                    os.remove(full_path)
+                    client.send_msg("")
+            finally:
+                self.changed(os.path.dirname(full_path))
         except Exception as e:
-            client.sendall(f"Error: {e}~".encode())
+            client.send_msg(f"Error: {e}")
+
+    def resolve_pair(self, current_dir, content):
+        # cp and mv: both ends inside the serving directory, and a target directory receives the source by name
+        if len(content) < 3:
+            return None, None, f"Error: {content[0]} needs a source and a target"
+        source, error = self.check_path(current_dir, content[:2])
+        if not error:
+            target, error = self.check_path(current_dir, [content[0], content[2]], must_exist=False)
+        if error:
+            return None, None, error
+        if os.path.isdir(target):
+            target = os.path.join(target, os.path.basename(source))
+        if source == self.serve_dir:
+            return None, None, "Error: Cannot move or copy the serving directory"
+        if target == source:
+            return None, None, f"Error: {content[1]} and {content[2]} are the same"
+        if target.startswith(source + os.sep):
+            return None, None, f"Error: {content[2]} is inside {content[1]}"
+        return source, target, None
+
+    def copy(self, client, content):
+        recursive = is_recursive(content)
+        source, target, error = self.resolve_pair(client.current_dir, content)
+        if error:
+            client.send_msg(error)
+            return
+        self.run_job(client, f"cp {source} {target}",
+                     lambda job: describe_copy(copy_path(source, target, recursive, job=job)), [os.path.dirname(target)])
+
+    def move(self, client, content):
+        source, target, error = self.resolve_pair(client.current_dir, content)
+        if error:
+            client.send_msg(error)
+            return
+        self.run_job(client, f"mv {source} {target}", lambda job: self.move_tree(source, target, job),
+                     [os.path.dirname(source), os.path.dirname(target)])
+
+    def delete_tree(self, full_path, job):
+        remove_tree(full_path, job)
+        return f"Deleted everything at {full_path}"
+
+    def move_tree(self, source, target, job):
+        move_path(source, target, job)
+        return f"Moved {source} to {target}"
+
+    def submit_job(self, session, description, work, changes=()):
+        # the changed directories are marked stale however the job ends, a cancelled copy leaves files behind too
+        def run(job):
+            try:
+                return work(job)
+            except Exception as e:
+                if not isinstance(e, JobCancelled):
+                    log.warning("Job %s failed: %s", job.id, e)
+                raise
+            finally:
+                for dir_path in changes:
+                    self.changed(dir_path)
+        return self.jobs.submit(description, run, owner=session)
+
+    def run_job(self, client, description, work, changes=()):
+        # a job that finishes within JOB_GRACE answers like the command always did, a longer one answers with its id
+        job = self.submit_job(client, description, work, changes)
+        try:
+            job.future.result(JOB_GRACE)
+        except TimeoutError:
+            client.send_msg(f"Started job {job.id}: {description}")
+            return
+        client.send_msg(job.reply())
+
+    def job_ids(self, session, content):
+        # wait and cancel name jobs by id; without ids wait takes every job not yet reported, cancel every unfinished one
+        if len(content) < 2:
+            return [job for job in self.jobs.owned(session) if not job.reported], None
+        jobs = []
+        for arg in content[1:]:
+            job = self.jobs.find(int(arg), session) if arg.isdigit() else None
+            if job is None:
+                return None, f"Error: No job {arg}"
+            jobs.append(job)
+        return jobs, None
+
+    def cancel_message(self, session, content):
+        jobs, error = self.job_ids(session, content)
+        if error:
+            return error
+        jobs = [job for job in jobs if not job.finished]
+        for job in jobs:
+            job.cancel()
+        if not jobs:
+            return "No jobs to cancel"
+        return f"Cancelling job {', '.join(str(job.id) for job in jobs)}"
+
+    def reindex_work(self, current_dir, content):
+        # (description, work) for a full rescan of a subtree, or an error message
+        if not self.index:
+            return None, "Error: The index is disabled on this server"
+        full_path, error = self.check_path(current_dir, content)
+        if error:
+            return None, error
+        rel_path = self.index.relative(full_path)
+
+        def work(job):
+            self.index.update(rel_path, full=True, job=job)
+            stats = self.index.du(rel_path)
+            return f"Indexed {stats['files']} files and {stats['dirs']} directories under /{rel_path}"
+        return (f"reindex /{rel_path}", work), None
+
+    def hash_work(self, session, content):
+        full_path, error = self.check_path(session.current_dir, content)
+        if error:
+            return None, error
+        algorithm = session.checksum or DEFAULT_CHECKSUM
+        return (f"hash {full_path}", lambda job: tree_digest(full_path, algorithm, self.hashes, job)), None
+
+    def list_jobs(self, client, content):
+        client.send_msg(describe_jobs(self.jobs.owned(client)))
+
+    def wait_jobs(self, client, content):
+        jobs, error = self.job_ids(client, content)
+        if error:
+            client.send_msg(error)
+            return
+        for job in jobs:
+            job.future.result()
+        client.send_msg(report_jobs(jobs))
+
+    def cancel_jobs(self, client, content):
+        client.send_msg(self.cancel_message(client, content))
+
+    def reindex(self, client, content):
+        spec, error = self.reindex_work(client.current_dir, content)
+        if error:
+            client.send_msg(error)
+            return
+        self.run_job(client, *spec)
+
+    def hash_tree(self, client, content):
+        spec, error = self.hash_work(client, content)
+        if error:
+            client.send_msg(error)
+            return
+        self.run_job(client, *spec)
 
     def get_file(self, client, content):
         recursive = is_recursive(content)
+        streams = pop_option(content, "-j")
+        resume = pop_flag(content, "--resume")
+        offset = int(pop_option(content, "--offset", 0))
+        length = pop_option(content, "--length")
         if len(content) < 2:
-            client.sendall("e~".encode())
-            client.sendall("Error: No file name provided~".encode())
+            client.send_msg("e", "Error: No file name provided")
             return
         full_path = self.__prep_path(client, content, True)
         if full_path != '0':
-            if os.path.isdir(full_path) and recursive:
-                client.sendall("d~".encode())
-                dir_name = os.path.basename(full_path)
-                self.__send_directory(client, full_path)
-                client.sendall(f"You successfully fetched {dir_name}~".encode())
+            if streams:
+                self.__send_manifest(client, full_path, recursive)
             elif os.path.isdir(full_path):
-                client.sendall("d~".encode())
-                dir_name = os.path.basename(full_path)
-                client.sendall(f"{dir_name}~".encode())
-                client.sendall("0~".encode())
-                client.sendall(f"Successfully fetched {dir_name}~".encode())
-            else:
-                client.sendall("f~".encode())
-                self.__send_file(client, full_path)
-                client.sendall(f"Successfully fetched {full_path}~".encode())
+                self.__send_directory(client, full_path, recursive)
+            elif resume:
+                self.__resume_file(client, full_path)
+            elif offset or length is not None or not self.__send_hot(client, full_path):
+                client.send_msg("f")
+                name = self.__send_file(client, full_path, offset, None if length is None else int(length))
+                client.send_msg(f"Successfully fetched {name or full_path}")
 
-    def __send_file(self, client, file_path):
+    def __send_hot(self, client, file_path):
+        # a cached file goes out with its framing in as few writes as possible, False when it was not sent
+        if not self.files:
+            return False
+        entry, hit = self.files.fetch(file_path)
+        self.metrics.add("hot_hits" if hit else "hot_misses")
+        if entry is None:
+            return False
+        try:
+            if not self.files.servable(entry, client.codec, client.sparse):
+                return False
+            send_hot(client, self.files, entry, tag_reply(client, ("f", file_path, f"{entry.size}")),
+                     (f"Successfully fetched {file_path}",))
+            return True
+        finally:
+            self.files.done(entry)
+
+    def __resume_file(self, client, file_path):
+        # the client answers with the size of its partial copy and a hash of its tail
+        file_size = os.path.getsize(file_path)
+        client.send_msg("r", file_path, f"{file_size}")
+        offset, _, digest = client.recv_msg().partition(" ")
+        start = resume_offset(file_path, int(offset), digest, file_size)
+        client.send_msg(f"{start}")
+        send_body(client, file_path, file_size - start, start, self.hashes)
+        client.send_msg(f"Successfully fetched {file_path} (resumed at byte {start})")
+
+    def __send_file(self, client, file_path, offset=0, length=None):
+        # returns the name the body was sent under, None when it could not be sent
         try:
-            client.sendall(f"{file_path}~".encode())
             file_size = os.path.getsize(file_path)
-            client.sendall(f"{file_size}~".encode())
-            with open(file_path, "rb") as file:         
-                client.sendfile(file)
+            name, offset, length = file_slice(file_path, file_size, offset, length)
+            client.send_msg(name, f"{length}")
+            send_body(client, file_path, length, offset, self.hashes)
+            return name
+        except ConnectionError:
+            raise
         except Exception as e:
-            print(f"Error: {e}")
-            client.sendall(f"Error: Unable to send file {file_path}~".encode())
-
-    def __send_directory(self, client, dir_path):
-        try:
-            client.sendall(f"{dir_path}~".encode())
-            contents_list = listDirectory(dir_path)
-            client.sendall(f"{len(contents_list)}~".encode())
-            for item in contents_list:
-                item_path = os.path.join(dir_path, item)
-                if os.path.isfile(item_path):
-                    client.sendall("f~".encode())
-                    self.__send_file(client, item_path)
-                elif os.path.isdir(item_path):
-                    client.sendall("d~".encode())
-                    self.__send_directory(client, item_path)
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            client.sendall(f"Error: Unable to send directory {dir_path}~".encode())
+            log.warning("Error: %s", e)
+            client.send_msg(f"Error: Unable to send file {file_path}")
+
+    def __send_directory(self, client, dir_path, recursive):
+        # one manifest frame describing the whole tree, then every file body back to back
+        dir_name = os.path.basename(dir_path)
+        try:
+            manifest = build_manifest(dir_path, recursive)
+        except OSError as e:
+            log.warning("An error occurred: %s", e)
+            client.send_msg("e", f"Error: Unable to send directory {dir_path}")
+            return
+        client.send_msg("d", json.dumps(manifest))
+        send_bodies(client, dir_path, manifest, hashes=self.hashes)
+        if recursive:
+            client.send_msg(f"You successfully fetched {dir_name}")
+        else:
+            client.send_msg(f"Successfully fetched {dir_name}")
+
+    def __send_manifest(self, client, full_path, recursive):
+        # parallel gets only receive the manifest here, the client fetches the bodies with pget
+        try:
+            manifest = build_manifest(full_path, recursive)
+        except OSError as e:
+            log.warning("An error occurred: %s", e)
+            client.send_msg("e", f"Error: Unable to send {full_path}")
+            return
+        base = os.path.relpath(os.path.dirname(full_path), self.serve_dir)
+        client.send_msg("j", base, json.dumps(manifest), f"Successfully fetched {os.path.basename(full_path)}")
+
+    def resolve_range(self, content):
+        # pget/pput <offset> <length> <path relative to the serving directory>; a length of None when malformed
+        try:
+            offset, length = int(content[1]), int(content[2])
+        except (IndexError, ValueError):
+            return 0, None, None, "Error: Malformed range"
+        full_path, error = self.check_path(self.serve_dir, [content[0], " ".join(content[3:])], must_exist=False)
+        return offset, length, full_path, error
+
+    def check_range(self, full_path, offset, length):
+        # the body is padded with zeros to the length asked for, so a range past the end is refused
+        if not os.path.isfile(full_path):
+            return f"Error: {full_path} is not a file"
+        return range_error(full_path, offset, length, os.path.getsize(full_path))
+
+    def open_range(self, full_path, offset, length):
+        # (fd, None) for a pput into a partial made by create_partials, which has the file's final size;
+        # (None, error) when the range does not fit in it
+        try:
+            fd = os.open(partial_path(full_path), os.O_WRONLY)
+        except OSError as e:
+            return None, f"Error: {e}"
+        error = range_error(full_path, offset, length, os.fstat(fd).st_size)
+        if error:
+            os.close(fd)
+            return None, error
+        return fd, None
+
+    def get_range(self, client, content):
+        offset, length, full_path, error = self.resolve_range(content)
+        if not error:
+            error = self.check_range(full_path, offset, length)
+        if error:
+            client.send_msg(error)
+            return
+        client.send_msg("ok")
+        send_digested(client, full_path, length, offset, self.hashes)
+
+    def put_range(self, client, content):
+        offset, length, full_path, error = self.resolve_range(content)
+        if length is None or length < 0:
+            raise ConnectionError("Malformed pput, the body that follows cannot be skipped")
+        fd = None
+        if not error:
+            fd, error = self.open_range(full_path, offset, length)
+        if error:
+            discard(client, length)
+            if client.checksum:
+                client.recv_frame()
+            client.send_msg(error)
+            return
+        try:
+            receive_range(client, fd, offset, length, f"{full_path} at {offset}")
+        except ConnectionError:
+            raise
+        except (ValueError, OSError) as e:
+            client.send_msg(f"Error: {e}")
+            return
+        finally:
+            os.close(fd)
+        client.send_msg("ok")
+
+    def finish_parallel_put(self, client, content):
+        if not client.pending_put:
+            client.send_msg("Error: No parallel upload in progress")
+            return
+        base_dir, manifest = client.pending_put
+        client.pending_put = None
+        commit = content[1:] != ["abort"]
+        full_path = os.path.join(base_dir, manifest[0][0])
+        try:
+            commit_partials(base_dir, manifest, commit)
+            self.changed(base_dir)
+        except (ValueError, OSError) as e:
+            client.send_msg(f"Error: {e}")
+            return
+        if not commit:
+            client.send_msg(f"Upload of {full_path} aborted")
+        elif manifest[0][1] == "d":
+            client.send_msg(f"You placed {full_path} dir.")
+        else:
+            client.send_msg(f"You placed {full_path} file")
 
     def put_file(self, client, content):
+        pop_option(content, "-j")
+        pop_flag(content, "--resume")
         i = min(len(content) - 1, 2)
         if content[i][0] == "/":
             content[i] = content[i].replace("/", "", 1)
         dir_path = content[i]
-        full_path = os.path.abspath(os.path.join(self.current_dir, dir_path))
+        full_path = os.path.abspath(os.path.join(client.current_dir, dir_path))
         if not os.path.commonpath([full_path, self.serve_dir]) == self.serve_dir:
-            client.sendall(f"Error: Cannot affect directory above the serving directory~".encode())
+            client.send_msg("Error: Cannot affect directory above the serving directory")
             return
-        key = really_recv(client, 4096).decode()
-        if not key:
-            key = really_recv(client, 4096).decode()
+        key = client.recv_msg()
         if key == 'd':
             try:
-                self.receive_dir(client, self.current_dir)
+                receive_tree(client, client.current_dir)
             finally:
-                client.sendall(f"You placed {full_path} dir.~".encode())
+                self.changed(client.current_dir)
+                client.send_msg(f"You placed {full_path} dir.")
         elif key == 'f':
+            error = None
+            try:
+                error = self.receive_file(client, client.current_dir)
+            finally:
+                self.changed(client.current_dir)
+                client.send_msg(error or f"You placed {full_path} file")
+        elif key == 'r':
+            error = None
             try:
-                self.receive_file(client, self.current_dir)
+                error = self.resume_file(client, client.current_dir)
             finally:
-                client.sendall(f"You placed {full_path} file~".encode())
+                self.changed(client.current_dir)
+                client.send_msg(error or f"You placed {full_path} file")
+        elif key == 'j':
+            # partial files are preallocated here and filled by pput over any number of streams
+            manifest = json.loads(client.recv_msg())
+            if not manifest:
+                client.send_msg("Error: Nothing to upload")
+                return
+            try:
+                create_partials(client.current_dir, manifest)
+            except (ValueError, OSError) as e:
+                commit_partials(client.current_dir, manifest, False)
+                client.send_msg(f"Error: {e}")
+                return
+            client.pending_put = (client.current_dir, manifest)
+            client.send_msg("ok", os.path.relpath(client.current_dir, self.serve_dir))
     
     def receive_file_metadata(self, client):
-        file_path = really_recv(client, 4096).decode()
-        file_size = really_recv(client, 4096).decode()
-        if not file_size:
-            file_size = really_recv(client, 4096).decode()
+        file_path = client.recv_msg()
+        file_size = client.recv_msg()
         return file_path, file_size
 
-    def receive_file_data(self, client, file_size):
-        received_data = bytearray()
-        while len(received_data) < int(file_size):
-            chunk = client.recv(4096)
-            received_data.extend(chunk)
-        return received_data
-
-    def write_file_to_disk(self, file_path, file_data):
+    def resume_file(self, client, path):
+        # report what an interrupted upload left behind, the client decides where to continue
+        file_path, file_size = self.receive_file_metadata(client)
+        file_path = os.path.join(path, os.path.basename(file_path))
+        file_size = int(file_size)
+        offset = min(partial_size(file_path), file_size)
+        client.send_msg(f"{offset} {tail_digest(partial_path(file_path), offset)}")
+        start = int(client.recv_msg())
         try:
-            with open(file_path, "wb") as file:
-                file.write(file_data)
+            receive_body(client, file_path, file_size, start)
+        except ConnectionError:
+            raise
         except Exception as e:
-            print(f"Error writing file: {e}")
+            log.warning("Error receiving file: %s", e)
+            return f"Error: {e}"
 
     def receive_file(self, client, path):
         file_path, file_size = self.receive_file_metadata(client)
         file_name = os.path.basename(file_path)
-        file_path = os.path.join(path, file_name)        
+        file_path = os.path.join(path, file_name)
         try:
-            file_data = self.receive_file_data(client, file_size)
-            self.write_file_to_disk(file_path, file_data)
+            receive_body(client, file_path, int(file_size))
+        except ConnectionError:
+            raise
         except Exception as e:
-            print(f"Error receiving file: {e}")
-        
-    def receive_dir(self, client, path):
-        dir_path = really_recv(client, 4096).decode()
+            log.warning("Error receiving file: %s", e)
+            return f"Error: {e}"
+
+    def changed(self, dir_path):
+        # keeps the listing cache and the index in step with the server's own writes
+        self.listings.invalidate(dir_path)
+        if self.index:
+            with self.stale_lock:
+                self.stale.add(dir_path)
+
+    def refresh_index(self):
+        # once per burst of commands rather than per command, a rescan costs a whole directory
+        with self.stale_lock:
+            stale, self.stale = self.stale, set()
+        for dir_path in stale:
+            self.index.refresh(dir_path)
+
+    def index_path(self, current_dir, content):
+        if not self.index:
+            raise ValueError("The index is disabled on this server")
+        self.refresh_index()
+        full_path, error = self.check_path(current_dir, content)
+        if error:
+            raise ValueError(error.removeprefix("Error: "))
+        if not self.index.ready():
+            raise ValueError("The index is still being built, try again shortly")
+        return self.index.relative(full_path)
+
+    def index_find(self, current_dir, content):
+        # find [dir] <pattern> [--limit n]
+        limit = int(pop_option(content, "--limit", FIND_LIMIT))
+        if len(content) < 2:
+            raise ValueError("No pattern provided")
+        pattern = content.pop()
+        rows = self.index.find(pattern, self.index_path(current_dir, content), limit) if self.index else []
+        return [json.dumps(rows[i:i + LS_BATCH]) for i in range(0, len(rows), LS_BATCH)]
+
+    def index_du(self, current_dir, content):
+        rel_path = self.index_path(current_dir, content)
+        stats = self.index.du(rel_path)
+        return f"{stats['bytes']} bytes in {stats['files']} files and {stats['dirs']} directories under /{rel_path}"
+
+    def find(self, client, content):
+        try:
+            batches = self.index_find(client.current_dir, content)
+        except Exception as e:
+            client.send_msg(f"Error: {e}")
+            return
+        client.send_msg("success", *batches, json.dumps({"next": None}))
+
+    def disk_usage(self, client, content):
+        try:
+            client.send_msg(self.index_du(client.current_dir, content))
+        except Exception as e:
+            client.send_msg(f"Error: {e}")
+
+    def set_codec(self, client, content):
+        client.codec = negotiate(content[1], CODECS) if len(content) > 1 else None
+        client.send_msg(client.codec or "none")
+
+    def set_checksum(self, client, content):
+        client.checksum = negotiate(content[1], CHECKSUMS) if len(content) > 1 else None
+        client.send_msg(client.checksum or "none")
+
+    def priority_message(self, session, content):
+        # a client may lower its own weight for bulk work, raising it is left to --client-weight
+        level = content[1] if len(content) > 1 else "normal"
+        if level not in PRIORITIES:
+            return f"Error: Unknown priority {level}, use {' or '.join(PRIORITIES)}"
+        if session.pacer:
+            session.pacer.priority = PRIORITIES[level]
+        return f"Priority {level}"
+
+    def set_priority(self, client, content):
+        client.send_msg(self.priority_message(client, content))
+
+    def set_sparse(self, client, content):
+        client.sparse = len(content) > 1 and content[1] == "on"
+        client.send_msg("on" if client.sparse else "off")
+
+    def sync_dir(self, client, content):
+        pull = pop_flag(content, "--pull")
+        if len(content) < 2:
+            client.send_msg("Error: No directory name provided")
+            return
+        if not pull:
+            client.send_msg("ok")
+            sync_receive(client, client.current_dir)
+            self.changed(client.current_dir)
+            return
+        full_path = self.__prep_path(client, content)
+        if full_path == "0":
+            return
+        if not os.path.isdir(full_path):
+            client.send_msg(f"Error: {content[1]} is not a directory")
+            return
+        client.send_msg("ok")
+        sync_send(client, full_path)
+
+
+class AsyncSession:
+    def __init__(self, reader, writer, current_dir):
+        self.reader = reader
+        self.writer = writer
+        self.current_dir = current_dir
+        self.pending_put = None
+        self.codec = None
+        self.checksum = None
+        self.sparse = False
+        self.sock = writer.get_extra_info("socket")
+        self.failed = False
+        self.counted = (0, 0)
+        self.tag = None
+        self.pacer = None
+
+    async def pace(self, count):
+        if self.pacer:
+            delay = self.pacer.delay(count)
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def sendall(self, data):
+        await self.pace(len(data))
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def sendfile(self, file, offset, count):
+        # paced sessions send in SHAPE_CHUNK pieces, like FramedSocket.sendfile
+        loop = asyncio.get_running_loop()
+        if not self.pacer:
+            return await loop.sendfile(self.writer.transport, file, offset, count)
+        sent = 0
+        while sent < count:
+            piece = min(count - sent, SHAPE_CHUNK)
+            await self.pace(piece)
+            moved = await loop.sendfile(self.writer.transport, file, offset + sent, piece)
+            sent += moved
+            if moved < piece:
+                break
+        return sent
+
+    async def read_body(self, size):
+        chunk = await self.reader.read(size)
+        await self.pace(len(chunk))
+        return chunk
+
+    async def send_msg(self, *messages):
+        if any(isinstance(message, str) and message.startswith("Error") for message in messages):
+            self.failed = True
+        self.writer.write(pack_frames(*tag_reply(self, messages)))
+        await self.writer.drain()
+
+    async def recv_frame(self):
+        (length,) = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+        if length > MAX_FRAME:
+            raise ValueError(f"Frame of {length} bytes exceeds the limit")
+        return await self.reader.readexactly(length)
+
+    async def recv_msg(self):
+        return (await self.recv_frame()).decode()
+
+    def close(self):
+        self.writer.close()
+
+
+class BlockingSession:
+    # Lets the blocking protocol helpers from library run on the thread pool against an asyncio session.
+    def __init__(self, session, loop):
+        self.session = session
+        self.loop = loop
+        self.codec = session.codec
+        self.checksum = session.checksum
+        self.sparse = session.sparse
+
+    def __wait(self, coro):
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionError("Connection closed by peer") from e
+
+    def sendall(self, data):
+        # copied, the transport may still hold on to it after this returns
+        self.__wait(self.session.sendall(bytes(data)))
+
+    def sendfile(self, file, offset=0, count=None):
+        # asyncio falls back to seek and read for TLS, which is not safe on a file shared between threads
+        if self.session.writer.get_extra_info("sslcontext"):
+            return send_chunked(self, file, offset, count)
+        return self.__wait(self.session.sendfile(file, offset, count))
+
+    def send_msg(self, *messages):
+        self.__wait(self.session.send_msg(*messages))
+
+    def send_buffers(self, buffers):
+        self.__wait(self.session.sendall(b"".join(buffers)))
+
+    def recv_frame(self):
+        return self.__wait(self.session.recv_frame())
+
+    def recv_msg(self):
+        return self.recv_frame().decode()
+
+    def read_into(self, view):
+        data = self.__wait(self.session.read_body(len(view)))
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        view[:len(data)] = data
+        return len(data)
+
+
+def scan_entries(dir_path):
+    with os.scandir(dir_path) as entries:
+        return [(entry.name, entry.is_file(), entry.is_dir()) for entry in entries]
+
+
+class AsyncFileServer(FileServer):
+    # One process, one event loop; every blocking disk call goes through a bounded thread pool.
+    def __init__(self, host, port, serve_dir, max_clients=1024, threads=4, index=None, hashes=None):
+        super().__init__(host, port, serve_dir, max_clients, index, hashes)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.sessions = set()
+        self.metrics = Metrics()
+        self.refresher = None       # task folding a burst of changes into one index refresh
+        self.slots = None           # semaphore of max_clients, made on the loop; waiters queue on it in order
+        self.queued = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, signal.default_int_handler)     # shut down as on Ctrl-C
+        changeDirectory(self.serve_dir)
+        if self.index:
+            threading.Thread(target=self.index.run_forever, daemon=True).start()
+        if self.metrics_port:
+            threading.Thread(target=metrics_endpoint(self.metrics, self.metrics_port).serve_forever, daemon=True).start()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            log.info("Server shutting down . . .")
+        finally:
+            self.jobs.cancel_all()
+            self.pool.shutdown(wait=False)
+
+    async def serve(self):
+        self.slots = asyncio.Semaphore(self.max_clients)
+        server = await asyncio.start_server(self.handle_connection, self.host or None, self.port, ssl=self.tls,
+                                            reuse_address=True, backlog=max(100, self.max_clients))
+        async with server:
+            await server.serve_forever()
+
+    async def offload(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    async def handle_connection(self, reader, writer):
+        session = AsyncSession(reader, writer, self.serve_dir)
+        if not await self.admit(session):
+            return
+        session_began = time.monotonic()
+        slot = self.shaper.claim() if self.shaper else None
+        session.pacer = self.pacer_for(writer.get_extra_info("peername")[0], slot)
+        self.sessions.add(session)
+        self.metrics.add("sessions")
+        self.metrics.add("sessions_active")
+        actions = {
+            "cd": self.dir_change,
+            "ls": self.display_dir,
+            "pwd": self.display_path,
+            "mkdir": self.make_dir,
+            "rm": self.remove,
+            "get": self.get_file,
+            "put": self.put_file,
+            "pget": self.get_range,
+            "pput": self.put_range,
+            "pdone": self.finish_parallel_put,
+            "sync": self.sync_dir,
+            "codec": self.set_codec,
+            "checksum": self.set_checksum,
+            "find": self.find,
+            "du": self.disk_usage,
+            "stats": self.show_stats,
+            "cp": self.copy,
+            "mv": self.move,
+            "jobs": self.list_jobs,
+            "wait": self.wait_jobs,
+            "cancel": self.cancel_jobs,
+            "reindex": self.reindex,
+            "hash": self.hash_tree,
+            "priority": self.set_priority,
+            "sparse": self.set_sparse,
+        }
+        try:
+            while True:
+                session.tag, content = split_tag((await session.recv_msg()).split())
+                if content:
+                    log.debug("Content: %s", content)
+                    began, failed = time.perf_counter(), True
+                    session.failed = False
+                    try:
+                        if content[0] in actions:
+                            await actions[content[0]](session, content)
+                        elif content[0] == "exit":
+                            await session.send_msg("Exiting")
+                            failed = False
+                            break
+                        else:
+                            await session.send_msg("Unknown content recieved, ignoring . . .")
+                        failed = False
+                    finally:
+                        if self.stale and not self.refresher:
+                            self.refresher = asyncio.create_task(self.refresh_later())
+                        self.command_done(session, content, began, failed)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            log.error("Error handling client: %s", e)
+        finally:
+            self.slots.release()
+            if slot is not None:
+                self.shaper.release(slot)
+            self.session_ended(time.monotonic() - session_began)
+            self.sessions.discard(session)
+            self.metrics.add("sessions_active", -1)
+            self.session_done(session)
+            if session.pending_put:
+                await self.offload(commit_partials, *session.pending_put, False)
+            session.close()
+
+    async def admit(self, session):
+        # waits in line for a slot like the fork engine's queue, and is told when to retry if it cannot
+        if self.slots.locked():
+            if self.queued >= self.queue_size:
+                await self.turn_away(session)
+                return False
+            self.metrics.add("sessions_queued")
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_wait)
+            return True
+        except asyncio.TimeoutError:
+            await self.turn_away(session)
+            return False
+        finally:
+            self.queued -= 1
+
+    async def turn_away(self, session):
+        log.info("Server busy, turning a client away")
+        self.metrics.add("sessions_turned_away")
+        try:
+            await session.send_msg(busy_message(retry_hint(self.session_seconds, self.queued, self.max_clients)))
+        except OSError:
+            pass
+        session.close()
+
+    async def __prep_path(self, session, content, key=False):
+        full_path, error = await self.offload(self.check_path, session.current_dir, content)
+        if error:
+            if key:
+                await session.send_msg("e", error)
+            else:
+                await session.send_msg(error)
+            return "0"
+        return full_path
+
+    async def display_dir(self, session, content):
+        try:
+            pattern, options = self.listing_options(content)
+        except ValueError as e:
+            await session.send_msg(f"Error: {e}")
+            return
+        full_path = await self.__prep_path(session, content)
+        if full_path == "0":
+            return
+        try:
+            page, cursor = await self.offload(lambda: list_page(self.listings.iter(full_path, pattern), **options))
+        except Exception as e:
+            log.warning("An error occurred: %s", e)
+            await session.send_msg(f"Error: Unable to display directory {full_path}: {e}")
+            return
+        await session.send_msg("success")
+        page = iter(page)
+        try:
+            while batch := await self.offload(take, page, LS_BATCH):
+                await session.send_msg(json.dumps(batch))
+        except OSError as e:
+            if isinstance(e, ConnectionError):
+                raise
+            log.warning("An error occurred: %s", e)
+            await session.send_msg(f"Error: Unable to display directory {full_path}")
+            return
+        await session.send_msg(json.dumps({"next": cursor}))
+
+    async def dir_change(self, session, content):
+        full_path = await self.__prep_path(session, content)
+        if full_path == "0":
+            return
+        elif full_path == session.current_dir:
+            full_path = self.serve_dir
+        if await self.offload(os.path.isdir, full_path):
+            session.current_dir = full_path
+            await session.send_msg(f"Changed server directory to {session.current_dir}")
+        else:
+            await session.send_msg(f"Error: Unable to change directory to {full_path}")
+
+    async def display_path(self, session, content):
+        await session.send_msg(session.current_dir)
+
+    async def make_dir(self, session, content):
+        full_path, error = await self.offload(self.check_path, session.current_dir, content, False)
+        if error:
+            await session.send_msg(error)
+            return
+        try:
+            await self.offload(makeDirectory, full_path)
+            await self.offload(self.changed, os.path.dirname(full_path))
+            await session.send_msg(f"Created directory here: {full_path}")
+        except Exception as e:
+            log.warning("An error occurred: %s", e)
+            await session.send_msg(f"Error: Unable to create directory {full_path}")
+
+    async def remove(self, session, content):
+        try:
+            recursive = is_recursive(content)
+            if len(content) < 2:
+                await session.send_msg("Error: No file name provided")
+                return
+            full_path = await self.__prep_path(session, content)
+            if full_path == "0":
+                return
+            is_dir = await self.offload(os.path.isdir, full_path)
+            if is_dir and recursive:
+                await self.run_job(session, f"rm -r {full_path}", lambda job: self.delete_tree(full_path, job),
+                                   [os.path.dirname(full_path)])
+                return
+            try:
+                if is_dir:
+                    if len(await self.offload(scan_entries, full_path)) == 0:
+                        await self.offload(os.rmdir, full_path)
+                        await session.send_msg(f"Deleted the directory {full_path}")
+                    else:
+                        await session.send_msg(f"Error: {full_path} has contents.")
+                else:
+                    await self.offload(os.remove, full_path)
+                    await session.send_msg("")
+            finally:
+                await self.offload(self.changed, os.path.dirname(full_path))
+        except Exception as e:
+            await session.send_msg(f"Error: {e}")
+
+    async def copy(self, session, content):
+        recursive = is_recursive(content)
+        source, target, error = await self.offload(self.resolve_pair, session.current_dir, content)
+        if error:
+            await session.send_msg(error)
+            return
+        await self.run_job(session, f"cp {source} {target}",
+                           lambda job: describe_copy(copy_path(source, target, recursive, job=job)),
+                           [os.path.dirname(target)])
+
+    async def move(self, session, content):
+        source, target, error = await self.offload(self.resolve_pair, session.current_dir, content)
+        if error:
+            await session.send_msg(error)
+            return
+        await self.run_job(session, f"mv {source} {target}", lambda job: self.move_tree(source, target, job),
+                           [os.path.dirname(source), os.path.dirname(target)])
+
+    async def run_job(self, session, description, work, changes=()):
+        job = self.submit_job(session, description, work, changes)
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), JOB_GRACE)
+        except asyncio.TimeoutError:
+            await session.send_msg(f"Started job {job.id}: {description}")
+            return
+        await session.send_msg(job.reply())
+
+    async def list_jobs(self, session, content):
+        await session.send_msg(describe_jobs(self.jobs.owned(session)))
+
+    async def wait_jobs(self, session, content):
+        jobs, error = self.job_ids(session, content)
+        if error:
+            await session.send_msg(error)
+            return
+        for job in jobs:
+            await asyncio.wrap_future(job.future)
+        await session.send_msg(report_jobs(jobs))
+
+    async def cancel_jobs(self, session, content):
+        await session.send_msg(self.cancel_message(session, content))
+
+    async def reindex(self, session, content):
+        spec, error = await self.offload(self.reindex_work, session.current_dir, content)
+        if error:
+            await session.send_msg(error)
+            return
+        await self.run_job(session, *spec)
+
+    async def hash_tree(self, session, content):
+        spec, error = await self.offload(self.hash_work, session, content)
+        if error:
+            await session.send_msg(error)
+            return
+        await self.run_job(session, *spec)
+
+    async def get_file(self, session, content):
+        recursive = is_recursive(content)
+        streams = pop_option(content, "-j")
+        resume = pop_flag(content, "--resume")
+        offset = int(pop_option(content, "--offset", 0))
+        length = pop_option(content, "--length")
+        if len(content) < 2:
+            await session.send_msg("e", "Error: No file name provided")
+            return
+        full_path = await self.__prep_path(session, content, True)
+        if full_path == "0":
+            return
+        if streams:
+            await self.__send_manifest(session, full_path, recursive)
+        elif await self.offload(os.path.isdir, full_path):
+            await self.__send_directory(session, full_path, recursive)
+        elif resume:
+            await self.__resume_file(session, full_path)
+        elif offset or length is not None or not await self.__send_hot(session, full_path):
+            await session.send_msg("f")
+            name = await self.__send_file(session, full_path, offset, None if length is None else int(length))
+            await session.send_msg(f"Successfully fetched {name or full_path}")
+
+    async def __send_hot(self, session, file_path):
+        if not self.files:
+            return False
+        entry, hit = await self.offload(self.files.fetch, file_path)
+        self.metrics.add("hot_hits" if hit else "hot_misses")
+        if entry is None:
+            return False
+        try:
+            if not await self.offload(self.files.servable, entry, session.codec, session.sparse):
+                return False
+            head = tag_reply(session, ("f", file_path, f"{entry.size}"))
+            conn = BlockingSession(session, asyncio.get_running_loop())
+            await self.offload(send_hot, conn, self.files, entry, head, (f"Successfully fetched {file_path}",))
+            return True
+        finally:
+            self.files.done(entry)
+
+    async def __resume_file(self, session, file_path):
+        file_size = await self.offload(os.path.getsize, file_path)
+        await session.send_msg("r", file_path, f"{file_size}")
+        offset, _, digest = (await session.recv_msg()).partition(" ")
+        start = await self.offload(resume_offset, file_path, int(offset), digest, file_size)
+        await session.send_msg(f"{start}")
+        await self.__send_encoded(session, file_path, file_size - start, start)
+        await session.send_msg(f"Successfully fetched {file_path} (resumed at byte {start})")
+
+    async def __send_file(self, session, file_path, offset=0, length=None):
+        try:
+            file_size = await self.offload(os.path.getsize, file_path)
+            name, offset, length = file_slice(file_path, file_size, offset, length)
+            await session.send_msg(name, f"{length}")
+            await self.__send_encoded(session, file_path, length, offset)
+            return name
+        except ConnectionError:
+            raise
+        except Exception as e:
+            log.warning("Error: %s", e)
+            await session.send_msg(f"Error: Unable to send file {file_path}")
+
+    async def __send_manifest(self, session, full_path, recursive):
+        try:
+            manifest = await self.offload(build_manifest, full_path, recursive)
+        except OSError as e:
+            log.warning("An error occurred: %s", e)
+            await session.send_msg("e", f"Error: Unable to send {full_path}")
+            return
+        base = os.path.relpath(os.path.dirname(full_path), self.serve_dir)
+        await session.send_msg("j", base, json.dumps(manifest), f"Successfully fetched {os.path.basename(full_path)}")
+
+    async def get_range(self, session, content):
+        offset, length, full_path, error = self.resolve_range(content)
+        if not error:
+            error = await self.offload(self.check_range, full_path, offset, length)
+        if error:
+            await session.send_msg(error)
+            return
+        await session.send_msg("ok")
+        await self.__send_digested(session, full_path, length, offset)
+
+    async def put_range(self, session, content):
+        offset, length, full_path, error = self.resolve_range(content)
+        if length is None or length < 0:
+            raise ConnectionError("Malformed pput, the body that follows cannot be skipped")
+        fd = None
+        if not error:
+            fd, error = await self.offload(self.open_range, full_path, offset, length)
+        if error:
+            await self.__discard(session, length)
+            await session.send_msg(error)
+            return
+        hasher = CHECKSUMS[session.checksum]() if session.checksum else None
+        start = offset
+        try:
+            remaining = length
+            while remaining:
+                chunk = await session.read_body(min(remaining, BUFFER_SIZE))
+                if not chunk:
+                    raise ConnectionError("Connection closed by peer")
+                remaining -= len(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                await self.offload(pwrite_all, fd, memoryview(chunk), offset)
+                offset += len(chunk)
+        except ConnectionError:
+            raise
+        except OSError as e:
+            await self.__discard(session, remaining)
+            await session.send_msg(f"Error: {e}")
+            return
+        finally:
+            await self.offload(os.close, fd)
+        if hasher and hasher.hexdigest() != await session.recv_msg():
+            await session.send_msg(f"Error: {full_path} at {start} failed its {session.checksum} check")
+            return
+        await session.send_msg("ok")
+
+    async def finish_parallel_put(self, session, content):
+        if not session.pending_put:
+            await session.send_msg("Error: No parallel upload in progress")
+            return
+        base_dir, manifest = session.pending_put
+        session.pending_put = None
+        commit = content[1:] != ["abort"]
+        full_path = os.path.join(base_dir, manifest[0][0])
+        try:
+            await self.offload(commit_partials, base_dir, manifest, commit)
+            await self.offload(self.changed, base_dir)
+        except (ValueError, OSError) as e:
+            await session.send_msg(f"Error: {e}")
+            return
+        if not commit:
+            await session.send_msg(f"Upload of {full_path} aborted")
+        elif manifest[0][1] == "d":
+            await session.send_msg(f"You placed {full_path} dir.")
+        else:
+            await session.send_msg(f"You placed {full_path} file")
+
+    async def __send_body(self, session, file_path, size, offset=0):
+        sent = 0
+        try:
+            file = await self.offload(open, file_path, "rb")
+        except OSError as e:
+            log.warning("%s", e)
+            file = None
+        if file:
+            try:
+                if size:
+                    sent = await session.sendfile(file, offset, size)
+            finally:
+                file.close()
+        while sent < size:     # a file that shrank meanwhile, padded like the fork engine does
+            padding = min(size - sent, BUFFER_SIZE)
+            session.writer.write(bytes(padding))
+            await session.writer.drain()
+            sent += padding
+
+    async def __send_digested(self, session, file_path, size, offset=0):
+        # an unannounced body, followed by its digest when the session has a checksum
+        if not session.checksum:
+            return await self.__send_body(session, file_path, size, offset)
+        conn = BlockingSession(session, asyncio.get_running_loop())
+        await self.offload(send_digested, conn, file_path, size, offset, self.hashes)
+
+    async def __send_encoded(self, session, file_path, size, offset=0):
+        if not session.codec and not session.checksum and not session.sparse:
+            return await self.__send_body(session, file_path, size, offset)
+        conn = BlockingSession(session, asyncio.get_running_loop())
+        await self.offload(send_body, conn, file_path, size, offset, self.hashes)
+
+    async def __send_directory(self, session, dir_path, recursive):
         dir_name = os.path.basename(dir_path)
-        dir_path = os.path.join(path, dir_name)
-        print(f"Making directory: {dir_path}")
-        os.mkdir(dir_path, 0o766)
-        num_items = int(really_recv(client, 4096).decode())
-        for _ in range(num_items):
-            key = really_recv(client, 4096).decode()
-            if key == 'f':
-                self.receive_file(client, dir_path)
-            elif key == 'd':
-                self.receive_dir(client, dir_path)
+        try:
+            manifest = await self.offload(build_manifest, dir_path, recursive)
+        except OSError as e:
+            log.warning("An error occurred: %s", e)
+            await session.send_msg("e", f"Error: Unable to send directory {dir_path}")
+            return
+        await session.send_msg("d", json.dumps(manifest))
+        base_dir = os.path.dirname(os.path.normpath(dir_path))
+        sock = session.writer.get_extra_info("socket")
+        cork = hasattr(socket, "TCP_CORK") and sock is not None
+        if cork:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            batch, batched = [], 0
+            for path, kind, size, _ in manifest:
+                if kind != "f" or (size == 0 and not session.checksum):
+                    continue
+                file_path = os.path.join(base_dir, path)
+                if size <= SMALL_FILE:
+                    batch.append((file_path, size))
+                    batched += size
+                    if batched >= BATCH_SIZE:
+                        await self.__send_batch(session, batch)
+                        batch, batched = [], 0
+                    continue
+                if batch:
+                    await self.__send_batch(session, batch)
+                    batch, batched = [], 0
+                await self.__send_digested(session, file_path, size)
+            if batch:
+                await self.__send_batch(session, batch)
+        finally:
+            if cork:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        if recursive:
+            await session.send_msg(f"You successfully fetched {dir_name}")
+        else:
+            await session.send_msg(f"Successfully fetched {dir_name}")
+
+    async def __send_batch(self, session, batch):
+        # small files are read together in one pool call and written as a single buffer
+        bodies = await self.offload(lambda: [read_exactly(path, size) for path, size in batch])
+        if session.checksum:    # each body followed by its digest frame
+            digests = await self.offload(lambda: [pack_frames(data_digest(session.checksum, body)) for body in bodies])
+            bodies = [part for pair in zip(bodies, digests) for part in pair]
+        await session.pace(sum(len(body) for body in bodies))
+        session.writer.writelines(bodies)
+        await session.writer.drain()
+
+    async def put_file(self, session, content):
+        pop_option(content, "-j")
+        pop_flag(content, "--resume")
+        i = min(len(content) - 1, 2)
+        if content[i][0] == "/":
+            content[i] = content[i].replace("/", "", 1)
+        full_path = os.path.abspath(os.path.join(session.current_dir, content[i]))
+        if not os.path.commonpath([full_path, self.serve_dir]) == self.serve_dir:
+            await session.send_msg("Error: Cannot affect directory above the serving directory")
+            return
+        key = await session.recv_msg()
+        if key == 'd':
+            try:
+                await self.receive_tree(session, session.current_dir)
+            finally:
+                await self.offload(self.changed, session.current_dir)
+                await session.send_msg(f"You placed {full_path} dir.")
+        elif key == 'f':
+            error = None
+            try:
+                error = await self.receive_file(session, session.current_dir)
+            finally:
+                await self.offload(self.changed, session.current_dir)
+                await session.send_msg(error or f"You placed {full_path} file")
+        elif key == 'r':
+            error = None
+            try:
+                error = await self.resume_file(session, session.current_dir)
+            finally:
+                await self.offload(self.changed, session.current_dir)
+                await session.send_msg(error or f"You placed {full_path} file")
+        elif key == 'j':
+            manifest = json.loads(await session.recv_msg())
+            if not manifest:
+                await session.send_msg("Error: Nothing to upload")
+                return
+            try:
+                await self.offload(create_partials, session.current_dir, manifest)
+            except (ValueError, OSError) as e:
+                await self.offload(commit_partials, session.current_dir, manifest, False)
+                await session.send_msg(f"Error: {e}")
+                return
+            session.pending_put = (session.current_dir, manifest)
+            await session.send_msg("ok", os.path.relpath(session.current_dir, self.serve_dir))
+
+    async def receive_file(self, session, path):
+        file_path = os.path.join(path, os.path.basename(await session.recv_msg()))
+        file_size = int(await session.recv_msg())
+        return await self.__receive_encoded(session, file_path, file_size)
+
+    async def resume_file(self, session, path):
+        file_path = os.path.join(path, os.path.basename(await session.recv_msg()))
+        file_size = int(await session.recv_msg())
+        offset = min(await self.offload(partial_size, file_path), file_size)
+        digest = await self.offload(tail_digest, partial_path(file_path), offset)
+        await session.send_msg(f"{offset} {digest}")
+        start = int(await session.recv_msg())
+        return await self.__receive_encoded(session, file_path, file_size, start)
+
+    async def __receive_body(self, session, file_path, size, offset=0):
+        remaining = size - offset
+        try:
+            fd = await self.offload(open_partial, file_path, size, offset)
+        except OSError as e:
+            log.warning("Error receiving file: %s", e)
+            fd = None
+        try:
+            while remaining:
+                chunk = await session.read_body(min(remaining, BUFFER_SIZE))
+                if not chunk:
+                    raise ConnectionError("Connection closed by peer")
+                remaining -= len(chunk)
+                if fd is not None:
+                    try:
+                        await self.offload(write_all, fd, memoryview(chunk))
+                    except OSError as e:
+                        # keep draining the body so the stream stays in sync
+                        log.warning("Error receiving file: %s", e)
+                        await self.offload(close_partial, fd, file_path, False)
+                        fd = None
+        except BaseException:
+            if fd is not None:
+                # interrupted: keep what arrived so the upload can be resumed
+                await self.offload(os.ftruncate, fd, size - remaining)
+                await self.offload(os.close, fd)
+            raise
+        if fd is not None:
+            await self.offload(close_partial, fd, file_path, True)
+        return fd is not None
+
+    async def __receive_checked(self, session, file_path, size):
+        # an unannounced body in a tree, dropped when its digest does not match
+        if not session.checksum:
+            return await self.__receive_body(session, file_path, size)
+        conn = BlockingSession(session, asyncio.get_running_loop())
+        try:
+            await self.offload(receive_to_file, conn, file_path, size, 0, session.checksum)
+        except ConnectionError:
+            raise
+        except (ValueError, OSError) as e:
+            log.warning("Error receiving file: %s", e)
+            return False
+        return True
+
+    async def __receive_encoded(self, session, file_path, size, offset=0):
+        # returns an error for the client, or None once the file is in place
+        if not session.codec and not session.checksum and not session.sparse:
+            if not await self.__receive_body(session, file_path, size, offset):
+                return f"Error: Unable to store {file_path}"
+            return None
+        conn = BlockingSession(session, asyncio.get_running_loop())
+        try:
+            await self.offload(receive_body, conn, file_path, size, offset)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            log.warning("Error receiving file: %s", e)
+            return f"Error: {e}"
+
+    async def __discard(self, session, size):
+        # a raw body and, when the session has a checksum, the digest after it
+        while size:
+            size -= len(await session.reader.readexactly(min(size, BUFFER_SIZE)))
+        if session.checksum:
+            await session.recv_frame()
+
+    async def receive_tree(self, session, path):
+        manifest = json.loads(await session.recv_msg())
+        dir_modes = []
+        for rel_path, kind, size, mode in manifest:
+            try:
+                target = safe_join(path, rel_path)
+                if kind == "d":
+                    await self.offload(lambda: os.makedirs(target, 0o766, exist_ok=True))
+                    dir_modes.append((target, mode))
+                    continue
+            except (ValueError, OSError) as e:
+                log.warning("%s", e)
+                if kind == "f":
+                    await self.__discard(session, size)
+                continue
+            if await self.__receive_checked(session, target, size):
+                await self.offload(os.chmod, target, mode & 0o777)
+        for target, mode in reversed(dir_modes):
+            await self.offload(os.chmod, target, mode & 0o777)
+
+    async def find(self, session, content):
+        try:
+            batches = await self.offload(self.index_find, session.current_dir, content)
+        except Exception as e:
+            await session.send_msg(f"Error: {e}")
+            return
+        await session.send_msg("success", *batches, json.dumps({"next": None}))
+
+    async def disk_usage(self, session, content):
+        try:
+            await session.send_msg(await self.offload(self.index_du, session.current_dir, content))
+        except Exception as e:
+            await session.send_msg(f"Error: {e}")
+
+    async def set_codec(self, session, content):
+        session.codec = negotiate(content[1], CODECS) if len(content) > 1 else None
+        await session.send_msg(session.codec or "none")
+
+    async def refresh_later(self):
+        try:
+            await asyncio.sleep(INDEX_DEBOUNCE)
+            await self.offload(self.refresh_index)
+        finally:
+            self.refresher = None
+
+    async def show_stats(self, session, content):
+        await session.send_msg(self.metrics.summary() + (f"\n{self.files.summary()}" if self.files else ""))
+
+    async def set_checksum(self, session, content):
+        session.checksum = negotiate(content[1], CHECKSUMS) if len(content) > 1 else None
+        await session.send_msg(session.checksum or "none")
+
+    async def set_priority(self, session, content):
+        await session.send_msg(self.priority_message(session, content))
+
+    async def set_sparse(self, session, content):
+        session.sparse = len(content) > 1 and content[1] == "on"
+        await session.send_msg("on" if session.sparse else "off")
+
+    async def sync_dir(self, session, content):
+        # the delta search is CPU bound, so the whole exchange runs on the pool
+        pull = pop_flag(content, "--pull")
+        if len(content) < 2:
+            await session.send_msg("Error: No directory name provided")
+            return
+        conn = BlockingSession(session, asyncio.get_running_loop())
+        if not pull:
+            await session.send_msg("ok")
+            await self.offload(sync_receive, conn, session.current_dir)
+            await self.offload(self.changed, session.current_dir)
+            return
+        full_path = await self.__prep_path(session, content)
+        if full_path == "0":
+            return
+        if not await self.offload(os.path.isdir, full_path):
+            await session.send_msg(f"Error: {content[1]} is not a directory")
+            return
+        await session.send_msg("ok")
+        await self.offload(sync_send, conn, full_path)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(add_help=True)
     parser.add_argument('-p', help='Port #', required=True)
     parser.add_argument('-d', help='Directory to serve from', required=True)
+    parser.add_argument('-m', type=int, help='Maximum number of concurrent clients (default 4, 1024 with asyncio)')
+    parser.add_argument('--engine', choices=['fork', 'asyncio'], default='fork', help='Server engine')
+    parser.add_argument('--threads', type=int, default=4, help='Disk worker threads for the asyncio engine')
+    parser.add_argument('--index', help='Metadata index file for find and du (default under ~/.cache/fileserver)')
+    parser.add_argument('--no-index', action='store_true', help='Do not build the metadata index')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on localhost at this port')
+    parser.add_argument('--trace', help='Append a JSON span per command to this file')
+    parser.add_argument('--tls-cert', help='Serve over TLS with this certificate chain (PEM)')
+    parser.add_argument('--tls-key', help='Private key for --tls-cert, if it is not in the same file')
+    parser.add_argument('--hot-cache', type=int, default=HOT_CACHE_BYTES >> 20,
+                        help='Megabytes of small hot files kept in memory per process, 0 disables (default %(default)s)')
+    parser.add_argument('--queue', type=int, default=ADMISSION_QUEUE,
+                        help='Connections that may wait for a free slot when the server is full (default %(default)s)')
+    parser.add_argument('--queue-wait', type=float, default=ADMISSION_WAIT,
+                        help='Seconds a connection waits for a slot before it is told to retry (default %(default)s)')
+    parser.add_argument('--rate', type=float, help='Cap on file transfer bandwidth, in MB/s, shared by all clients')
+    parser.add_argument('--client-weight', action='append', default=[], metavar='ADDRESS=WEIGHT',
+                        help="A client's share of --rate relative to the others (default 1), may be repeated")
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error', 'off'], default='info',
+                        help='Log verbosity; debug logs every command, off disables logging')
     return parser.parse_args()
 
 
+def open_index(serve_dir, db_path):
+    if sqlite3 is None:
+        log.warning("Index disabled: sqlite3 is not available")
+        return None
+    try:
+        return MetadataIndex(serve_dir, db_path)
+    except (OSError, sqlite3.Error) as e:
+        log.warning("Index disabled: %s", e)
+        return None
+
+
+def open_hashes(serve_dir):
+    # a file shared by all workers when possible, otherwise every process remembers its own digests
+    try:
+        return HashCache(index_location(serve_dir, "hashes"))
+    except Exception as e:
+        log.warning("Hash cache kept in memory: %s", e)
+        return HashCache()
+
+
+def configure_logging(level):
+    if level == "off":
+        logging.disable(logging.CRITICAL)
+        return
+    handler = logging.StreamHandler()
+    handler.addFilter(RateLimitFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(message)s"))
+    log.addHandler(handler)
+    log.setLevel(level.upper())
+
+
 def main():
     args = parse_args()
+    configure_logging(args.log_level)
     host = ""
     port = int(args.p)
     serve_dir = os.path.abspath(args.d)
+    index = None if args.no_index else open_index(serve_dir, args.index)
+    hashes = open_hashes(serve_dir)
     
-    server = FileServer(host, port, serve_dir)
+    if args.engine == "asyncio":
+        server = AsyncFileServer(host, port, serve_dir, args.m or 1024, args.threads, index, hashes)
+    else:
+        server = FileServer(host, port, serve_dir, args.m or 4, index, hashes)
+    server.metrics_port = args.metrics_port
+    server.files = FileCache(args.hot_cache << 20) if args.hot_cache else None
+    if args.tls_cert:
+        server.tls = server_tls(args.tls_cert, args.tls_key)
+    if args.trace:
+        server.trace = os.open(args.trace, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    server.queue_size = args.queue
+    server.queue_wait = args.queue_wait
+    if args.rate:
+        server.shaper = Shaper(args.rate * 1e6, server.max_clients + 1)
+    for weight in args.client_weight:
+        address, _, value = weight.partition("=")
+        server.weights[address] = float(value)
     server.run()
 
 
@@ -4,19 +4,2444 @@
 #Purpose: Contains a library of functions that can be used both for the client and the server, as well as testing functions for the functions. 
 
 import os
+import errno
+import json
+import logging
+import hashlib
+import heapq
+import base64
+import bisect
+import fnmatch
+import itertools
+import math
+import mmap
+import zlib
+import socket
+import shutil
+import stat
+import struct
+import fcntl
+import subprocess
+import threading
+import time
+import tracemalloc
+import filecmp
 import unittest
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+        import bz2
+except ImportError:
+        bz2 = None
+try:
+        import lzma
+except ImportError:
+        lzma = None
+try:
+        import sqlite3
+except ImportError:
+        sqlite3 = None
+try:
+        import xxhash
+except ImportError:
+        xxhash = None
+try:
+        import ssl
+except ImportError:
+        ssl = None
 
 testing = False
 homeDirectory = ""
+log = logging.getLogger("fileserver.library")  # the server's handler, level and rate limit apply
+
+# Every protocol message is a frame: a 4 byte big-endian length followed by the payload.
+# File bodies are the only thing sent raw, right after the frame announcing their size.
+HEADER = struct.Struct("!I")
+BUFFER_SIZE = 65536
+MAX_FRAME = 1 << 26
+SMALL_FILE = 65536
+STREAM_CHUNK = 8 << 20
+STREAM_BATCH = 64
+TAIL_SIZE = 65536
+SYNC_MIN_BLOCK = 2048
+SYNC_MAX_BLOCK = 1 << 17
+ADLER_MOD = 65521
+BATCH_SIZE = 1 << 20
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+SPLICE = hasattr(os, "splice")
+PIPE_SIZE = 1 << 20
+FICLONE = 0x40049409            # ioctl sharing a file's extents with another on btrfs, xfs and similar
+COPY_THREADS = 8
+JOB_WORKERS = 2
+JOB_HISTORY = 100       # finished jobs remembered for jobs and wait
+RING_VNODES = 64        # points per node on a HashRing, enough to even out the shards
+CLUSTER_THREADS = 16    # requests a ClusterClient has in flight across its nodes
+JOB_GRACE = 0.25        # seconds a command waits on its job before answering with the job id instead
+TLS_CHUNK = 1 << 18             # file reads per write when TLS has to encrypt in userspace
+
+# Stream codecs a session can negotiate, in order of preference: name -> (compressor, decompressor).
+CODECS = {"zlib": (lambda: zlib.compressobj(6), zlib.decompressobj)}
+if bz2:
+        CODECS["bz2"] = (bz2.BZ2Compressor, bz2.BZ2Decompressor)
+if lzma:
+        CODECS["lzma"] = (lambda: lzma.LZMACompressor(preset=1), lzma.LZMADecompressor)
+CODEC_CHUNK = 4 * BUFFER_SIZE
+
+# Checksums a session can negotiate for the digest trailer sent after each body: name -> hash constructor.
+CHECKSUMS = {"blake2b": lambda: hashlib.blake2b(digest_size=32), "sha256": hashlib.sha256}
+if xxhash:
+        CHECKSUMS["xxh3"] = xxhash.xxh3_128
+DEFAULT_CHECKSUM = "blake2b"
+HASH_CACHE_SIZE = 4096
+HOT_CACHE_BYTES = 64 << 20
+HOT_FILE_SIZE = 1 << 18         # contents are cached up to this size, larger files keep an open descriptor
+HOT_DESCRIPTORS = 256
+
+# Commands with their own metrics, anything else is counted as "other"; latency bucket bounds in seconds.
+METRIC_COMMANDS = ("cd", "ls", "pwd", "mkdir", "rm", "get", "put", "pget", "pput", "pdone", "sync",
+                   "codec", "checksum", "find", "du", "stats", "cp", "mv", "jobs", "wait", "cancel", "reindex",
+                   "hash", "priority", "sparse", "exit", "other")
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_TOTALS = ("bytes_in", "bytes_out", "sessions", "sessions_active", "hot_hits", "hot_misses", "sessions_queued",
+                 "sessions_turned_away")
+TCP_INFO_BYTES = struct.Struct("=QQ")   # tcpi_bytes_acked and tcpi_bytes_received, at offset 120 of tcp_info
+LOG_RATE = 50
+# Commands answered with exactly one frame, which a client may pipeline under a "#id" tag.
+PIPELINED_COMMANDS = {"cd", "pwd", "mkdir", "rm", "du", "stats", "jobs", "wait", "cancel", "priority"}
+PIPELINE_DEPTH = 128
+POOL_SIZE = 4
+POOL_IDLE = 30          # seconds a pooled connection may sit unused before it is checked on checkout
+ADMISSION_QUEUE = 16    # connections waiting for a free slot before new ones are turned away
+ADMISSION_WAIT = 10     # seconds a queued connection waits before it is told to retry later
+RETRY_MAX = 60
+BUSY_RETRIES = 3
+SHAPE_CHUNK = 1 << 16   # bytes per paced send, small enough for the bucket to interleave transfers
+SHAPE_BURST = 1 << 18
+SHAPE_IDLE = 0.5        # seconds without data after which a connection stops counting towards the split
+SHAPE_REFRESH = 0.05
+PRIORITIES = {"low": 0.25, "normal": 1.0}
+CODEC_MIN_SIZE = 4096
+CODEC_MIN_SAVING = 0.1
+SPARSE = hasattr(os, "SEEK_DATA")
+SPARSE_MIN_SIZE = 1 << 20
+SPARSE_MIN_SAVING = 0.1 # holes must make up this much of a body before only its data is sent
+SPARSE_MAX_EXTENTS = 100000
+LISTING_CACHE_SIZE = 256
+LISTING_TTL = 5.0
+LISTING_CACHE_ENTRIES = 10000
+LS_BATCH = 1000
+FIND_LIMIT = 1000
+INDEX_INTERVAL = 30
+INDEX_FULL_INTERVAL = 600
+INDEX_COMMIT_DIRS = 500
+INDEX_DEBOUNCE = 0.05
+RACY_WINDOW_NS = 1_000_000_000
+COMPRESSED_EXTENSIONS = {".gz", ".tgz", ".bz2", ".xz", ".txz", ".zst", ".lz4", ".zip", ".7z", ".rar",
+                         ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".webm",
+                         ".ogg", ".flac", ".pdf", ".docx", ".xlsx", ".jar", ".whl"}
+
+
+def pack_frames(*messages):
+        packet = bytearray()
+        for message in messages:
+                if isinstance(message, str):
+                        message = message.encode()
+                packet += HEADER.pack(len(message))
+                packet += message
+        return packet
+
+
+class FramedSocket:
+        def __init__(self, sock, buffer_size=BUFFER_SIZE):
+                self.sock = sock
+                self.codec = None
+                self.checksum = None
+                self.sparse = False     # both ends take bodies sent as an extent map and the data in it
+                self.zero_copy = SPLICE
+                self.splice_pipe = None
+                self.buffer = bytearray(buffer_size)
+                self.view = memoryview(self.buffer)
+                self.start = 0
+                self.end = 0
+                self.pacer = None       # Pacer holding body bytes to this connection's share of a Shaper
+
+        def fileno(self):
+                return self.sock.fileno()
+
+        def start_tls(self, context, **options):
+                # the handshake happens here, before any frame is read
+                self.sock = context.wrap_socket(self.sock, **options)
+
+        def encrypted(self):
+                return ssl is not None and isinstance(self.sock, ssl.SSLSocket)
+
+        def close(self):
+                self.drop_pipe()
+                self.sock.close()
+
+        def pending(self):
+                return self.end - self.start
+
+        def pipe(self):
+                # (read end, write end, size) for splicing off this socket; only plain blocking sockets qualify
+                if self.splice_pipe is None and self.zero_copy and type(self.sock) is socket.socket \
+                                and self.sock.gettimeout() is None:
+                        read_end, write_end = os.pipe()
+                        try:
+                                fcntl.fcntl(write_end, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_SIZE)
+                        except OSError:
+                                pass
+                        size = fcntl.fcntl(write_end, getattr(fcntl, "F_GETPIPE_SZ", 1032))
+                        self.splice_pipe = (read_end, write_end, size)
+                return self.splice_pipe
+
+        def drop_pipe(self):
+                # a pipe still holding bytes from a failed transfer must not leak them into the next one
+                if self.splice_pipe:
+                        os.close(self.splice_pipe[0])
+                        os.close(self.splice_pipe[1])
+                        self.splice_pipe = None
+
+        def pace(self, count):
+                if self.pacer:
+                        self.pacer.take(count)
+
+        def sendall(self, data):
+                self.pace(len(data))
+                self.sock.sendall(data)
+
+        def sendfile(self, file, offset=0, count=None):
+                # a paced connection goes in SHAPE_CHUNK pieces so its bucket can hold it back between them
+                if not self.pacer or not count:
+                        return self.__sendfile(file, offset, count)
+                sent = 0
+                while sent < count:
+                        piece = min(count - sent, SHAPE_CHUNK)
+                        self.pacer.take(piece)
+                        moved = self.__sendfile(file, offset + sent, piece)
+                        sent += moved
+                        if moved < piece:
+                                break
+                return sent
+
+        def __sendfile(self, file, offset, count):
+                # without kernel TLS the file has to pass through OpenSSL, in large pieces rather than
+                # the 8 KB sends SSLSocket.sendfile falls back to; straight to the socket, sendfile has paced them
+                if self.encrypted() and not kernel_tls(self.sock):
+                        return send_chunked(self.sock, file, offset, count)
+                return self.sock.sendfile(file, offset, count)
+
+        def send_buffers(self, buffers):
+                # scatter-gather write, looping over partial sends; TLS has no sendmsg, one write makes fewer records
+                self.pace(sum(len(buffer) for buffer in buffers))
+                if self.encrypted():
+                        self.sock.sendall(b"".join(buffers))
+                        return
+                views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+                while views:
+                        sent = self.sock.sendmsg(views[:IOV_MAX])
+                        while sent and sent >= len(views[0]):
+                                sent -= len(views.pop(0))
+                        if sent:
+                                views[0] = views[0][sent:]
+
+        def cork(self, enabled):
+                # hold back partial segments so many small writes leave as full packets
+                if hasattr(socket, "TCP_CORK"):
+                        try:
+                                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+                        except OSError:
+                                pass
+
+        def send_msg(self, *messages):
+                # several frames are coalesced into a single sendall
+                self.sock.sendall(pack_frames(*messages))
+
+        def __fill(self, length):
+                if self.end - self.start >= length:
+                        return
+                if self.start + length > len(self.buffer):
+                        remaining = self.end - self.start
+                        self.view[:remaining] = self.view[self.start:self.end]
+                        self.start, self.end = 0, remaining
+                while self.end - self.start < length:
+                        received = self.sock.recv_into(self.view[self.end:])
+                        if received == 0:
+                                raise ConnectionError("Connection closed by peer")
+                        self.end += received
+
+        def recv_frame(self):
+                self.__fill(HEADER.size)
+                (length,) = HEADER.unpack_from(self.buffer, self.start)
+                self.start += HEADER.size
+                if length > MAX_FRAME:
+                        raise ValueError(f"Frame of {length} bytes exceeds the limit")
+                if length > len(self.buffer):
+                        data = bytearray(length)
+                        self.recv_exact_into(memoryview(data))
+                        return bytes(data)
+                self.__fill(length)
+                data = bytes(self.view[self.start:self.start + length])
+                self.start += length
+                return data
+
+        def recv_msg(self):
+                return self.recv_frame().decode()
+
+        def read_into(self, view):
+                # returns as soon as some bytes are available, buffered bytes are handed out first
+                buffered = self.end - self.start
+                if buffered:
+                        length = min(buffered, len(view))
+                        view[:length] = self.view[self.start:self.start + length]
+                        self.start += length
+                        return length
+                received = self.sock.recv_into(view)
+                if received == 0:
+                        raise ConnectionError("Connection closed by peer")
+                self.pace(received)
+                return received
+
+        def recv_exact_into(self, view):
+                while len(view):
+                        view = view[self.read_into(view):]
+
+        def recv_exact(self, length):
+                data = bytearray(length)
+                self.recv_exact_into(memoryview(data))
+                return bytes(data)
+
+def kernel_tls(sock):
+        # newer Pythons report when OpenSSL has handed record encryption to the kernel, sendfile then stays zero-copy
+        check = getattr(getattr(sock, "_sslobj", None), "uses_ktls_for_send", None)
+        return bool(check and check())
+
+
+def send_chunked(conn, file, offset=0, count=None):
+        if count is None:
+                count = os.fstat(file.fileno()).st_size - offset
+        view = memoryview(bytearray(min(count, TLS_CHUNK) or 1))
+        sent = 0
+        while sent < count:
+                read = os.preadv(file.fileno(), [view[:min(count - sent, len(view))]], offset + sent)
+                if not read:
+                        break
+                conn.sendall(view[:read])
+                sent += read
+        return sent
+
+
+def server_tls(cert, key=None):
+        # one context for the life of the server, so its session tickets stay valid across workers
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
+        return context
+
+
+def client_tls(cafile=None):
+        context = ssl.create_default_context(cafile=cafile)
+        context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
+        return context
+
+
+def self_signed(cert_path, key_path, host="127.0.0.1"):
+        # a throwaway certificate for local testing, made with the openssl command line tool
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                        "-nodes", "-days", "30", "-subj", f"/CN={host}", "-keyout", key_path, "-out", cert_path,
+                        "-addext", f"subjectAltName={'IP' if host.replace('.', '').isdigit() else 'DNS'}:{host}"],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def partial_path(file_path):
+        head, tail = os.path.split(file_path)
+        return os.path.join(head, f".{tail}.part")
+
+
+def open_partial(file_path, file_size, offset=0):
+        # uploads land in a hidden temp file next to the target and are renamed into place when complete;
+        # a non-zero offset keeps the first bytes of a partial file left by an interrupted transfer
+        if offset:
+                fd = os.open(partial_path(file_path), os.O_WRONLY | os.O_CREAT, 0o666)
+                os.ftruncate(fd, offset)
+                os.lseek(fd, offset, os.SEEK_SET)
+        else:
+                fd = os.open(partial_path(file_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        if file_size > SMALL_FILE and hasattr(os, "posix_fallocate"):
+                try:
+                        os.posix_fallocate(fd, 0, file_size)
+                except OSError:
+                        pass
+        return fd
+
+
+def close_partial(fd, file_path, commit):
+        os.close(fd)
+        if commit:
+                os.replace(partial_path(file_path), file_path)
+        else:
+                os.unlink(partial_path(file_path))
+
+
+def write_all(fd, view):
+        while len(view):
+                view = view[os.write(fd, view):]
+
+
+def pwrite_all(fd, view, offset):
+        while len(view):
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+
+
+def discard(conn, length):
+        view = memoryview(bytearray(min(length, BUFFER_SIZE)))
+        while length:
+                length -= conn.read_into(view[:min(length, len(view))])
+
+
+class BodyReceiver:
+        # Copies a raw body off the connection into fd, counting what left the socket and what reached the file.
+        # Large bodies on Linux go socket -> pipe -> file with splice and never enter userspace.
+        def __init__(self, conn, fd, offset=None, hasher=None):
+                self.conn = conn
+                self.fd = fd
+                self.offset = offset
+                self.hasher = hasher
+                self.taken = 0
+                self.written = 0
+
+        def __position(self):
+                return None if self.offset is None else self.offset + self.written
+
+        def run(self, length):
+                # a body being hashed has to pass through userspace anyway
+                pipe = self.conn.pipe() if length >= SMALL_FILE and hasattr(self.conn, "pipe") and not self.hasher else None
+                view = None
+                try:
+                        while self.taken < length:
+                                want = length - self.taken
+                                if pipe and not self.conn.pending():
+                                        moved = os.splice(self.conn.fileno(), pipe[1], min(want, pipe[2]))
+                                        if moved == 0:
+                                                raise ConnectionError("Connection closed by peer")
+                                        self.conn.pace(moved)
+                                        self.taken += moved
+                                        while self.written < self.taken:
+                                                self.written += os.splice(pipe[0], self.fd, self.taken - self.written,
+                                                                          offset_dst=self.__position())
+                                        continue
+                                if view is None:
+                                        view = memoryview(bytearray(min(want, BUFFER_SIZE)))
+                                received = self.conn.read_into(view[:min(want, len(view))])
+                                self.taken += received
+                                if self.hasher:
+                                        self.hasher.update(view[:received])
+                                if self.offset is None:
+                                        write_all(self.fd, view[:received])
+                                else:
+                                        pwrite_all(self.fd, view[:received], self.__position())
+                                self.written += received
+                except BaseException:
+                        if pipe and self.written != self.taken:
+                                self.conn.drop_pipe()
+                        raise
+
+
+def check_trailer(conn, file_path, checksum, hasher):
+        # the digest frame after a body; a mismatch means the bytes were damaged on the way
+        expected = conn.recv_msg()
+        if hasher and hasher.hexdigest() != expected:
+                raise ValueError(f"{file_path} failed its {checksum} check and was dropped")
+
+
+def receive_to_file(conn, file_path, file_size, offset=0, checksum=None):
+        try:
+                fd = open_partial(file_path, file_size, offset)
+        except OSError:
+                discard(conn, file_size - offset)
+                if checksum:
+                        conn.recv_frame()
+                raise
+        body = BodyReceiver(conn, fd, hasher=CHECKSUMS[checksum]() if checksum else None)
+        try:
+                body.run(file_size - offset)
+        except BaseException as e:
+                if isinstance(e, OSError) and not isinstance(e, ConnectionError):
+                        close_partial(fd, file_path, False)
+                        discard(conn, file_size - offset - body.taken)  # keep the stream in sync after a disk error
+                        if checksum:
+                                conn.recv_frame()
+                else:
+                        # interrupted: keep what arrived so the transfer can be resumed
+                        os.ftruncate(fd, offset + body.written)
+                        os.close(fd)
+                raise
+        if checksum:
+                try:
+                        check_trailer(conn, file_path, checksum, body.hasher)
+                except ValueError:
+                        close_partial(fd, file_path, False)
+                        raise
+                except BaseException:
+                        os.close(fd)
+                        raise
+        close_partial(fd, file_path, True)
+
+
+def read_extents(conn, size):
+        # the map of a sparse body: ordered, non-overlapping extents inside it, or the stream cannot be trusted
+        extent_map = conn.recv_msg()
+        extents = json.loads(extent_map)
+        end = 0
+        for start, length in extents:
+                if start < end or length <= 0 or start + length > size:
+                        raise ConnectionError(f"Malformed extent map for a body of {size} bytes")
+                end = start + length
+        return extent_map, extents
+
+
+def receive_sparse(conn, file_path, file_size, offset=0, checksum=None):
+        # the extents are written where the map puts them, everything else stays a hole in the file
+        extent_map, extents = read_extents(conn, file_size - offset)
+        hasher = CHECKSUMS[checksum]() if checksum else None
+        if hasher:
+                hasher.update(extent_map.encode())
+        total = sum(length for _, length in extents)
+        try:
+                fd = open_partial(file_path, 0, offset)
+                os.ftruncate(fd, file_size)
+        except OSError:
+                discard(conn, total)
+                if checksum:
+                        conn.recv_frame()
+                raise
+        start, body, done = 0, None, 0
+        try:
+                for start, length in extents:
+                        body = BodyReceiver(conn, fd, offset + start, hasher)
+                        body.run(length)
+                        done += length
+        except BaseException as e:
+                taken, written = (body.taken, body.written) if body else (0, 0)
+                if isinstance(e, OSError) and not isinstance(e, ConnectionError):
+                        close_partial(fd, file_path, False)
+                        discard(conn, total - done - taken)
+                        if checksum:
+                                conn.recv_frame()
+                else:
+                        # a resume must not mistake the holes past what arrived for received data
+                        os.ftruncate(fd, offset + start + written)
+                        os.close(fd)
+                raise
+        if checksum:
+                try:
+                        check_trailer(conn, file_path, checksum, hasher)
+                except ValueError:
+                        close_partial(fd, file_path, False)
+                        raise
+                except BaseException:
+                        os.close(fd)
+                        raise
+        close_partial(fd, file_path, True)
+
+
+def partial_size(file_path):
+        try:
+                return os.path.getsize(partial_path(file_path))
+        except OSError:
+                return 0
+
+
+def tail_digest(file_path, offset):
+        # hash of the TAIL_SIZE bytes before offset, both ends compare it before resuming
+        start = max(0, offset - TAIL_SIZE)
+        try:
+                with open(file_path, "rb") as file:
+                        file.seek(start)
+                        data = file.read(offset - start)
+        except OSError:
+                return ""
+        if len(data) != offset - start:
+                return ""
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def resume_offset(file_path, offset, digest, file_size):
+        if 0 < offset <= file_size and digest == tail_digest(file_path, offset):
+                return offset
+        return 0
+
+
+def safe_join(base_dir, rel_path):
+        base_dir = os.path.abspath(base_dir)
+        target = os.path.abspath(os.path.join(base_dir, rel_path))
+        if os.path.isabs(rel_path) or target == base_dir or os.path.commonpath([target, base_dir]) != base_dir:
+                raise ValueError(f"Refusing to write outside of {base_dir}: {rel_path}")
+        return target
+
+
+def build_manifest(root, recursive=True):
+        # [relative path, 'd' or 'f', size, mode], parents always listed before their contents
+        root = os.path.normpath(root)
+        name = os.path.basename(root)
+        info = os.stat(root)
+        if not os.path.isdir(root):
+                return [[name, "f", info.st_size, info.st_mode & 0o7777]]
+        manifest = [[name, "d", 0, info.st_mode & 0o7777]]
+        stack = [(root, name)] if recursive else []
+        while stack:
+                dir_path, rel_path = stack.pop()
+                with os.scandir(dir_path) as entries:
+                        for entry in entries:
+                                entry_path = os.path.join(rel_path, entry.name)
+                                if entry.is_dir(follow_symlinks=False):
+                                        manifest.append([entry_path, "d", 0, entry.stat().st_mode & 0o7777])
+                                        stack.append((entry.path, entry_path))
+                                elif entry.is_file():
+                                        info = entry.stat()
+                                        manifest.append([entry_path, "f", info.st_size, info.st_mode & 0o7777])
+        return manifest
+
+
+def read_exactly(file_path, size):
+        # the manifest already announced `size`, so a file that changed since is padded or cut to match
+        try:
+                with open(file_path, "rb") as file:
+                        data = file.read(size)
+        except OSError as e:
+                log.warning("%s", e)
+                data = b""
+        return data + bytes(size - len(data))
+
+
+def send_file_body(conn, file_path, size, offset=0):
+        sent = 0
+        try:
+                with open(file_path, "rb") as file:
+                        if size:
+                                sent = conn.sendfile(file, offset, size)
+        except OSError as e:
+                if isinstance(e, ConnectionError):
+                        raise
+                log.warning("%s", e)
+        while sent < size:
+                padding = min(size - sent, BUFFER_SIZE)
+                conn.sendall(bytes(padding))
+                sent += padding
+
+
+def sparse_extents(file_path, size, offset=0):
+        # (start, length) of the data in the body, relative to offset, when holes make up enough of it
+        # to be worth skipping; None when they do not or the filesystem cannot tell
+        if not SPARSE or size < SPARSE_MIN_SIZE:
+                return None
+        try:
+                fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+                return None
+        extents = []
+        position, end = offset, offset + size
+        try:
+                while position < end:
+                        try:
+                                start = os.lseek(fd, position, os.SEEK_DATA)
+                        except OSError as e:
+                                if e.errno == errno.ENXIO:      # nothing but a hole up to the end of the file
+                                        break
+                                return None
+                        if start >= end:
+                                break
+                        stop = min(os.lseek(fd, start, os.SEEK_HOLE), end)
+                        extents.append((start - offset, stop - start))
+                        if len(extents) > SPARSE_MAX_EXTENTS:
+                                return None
+                        position = stop
+        except OSError:
+                return None
+        finally:
+                os.close(fd)
+        if sum(length for _, length in extents) > size * (1 - SPARSE_MIN_SAVING):
+                return None
+        return extents
+
+
+def send_region(conn, file, offset, length, hasher=None):
+        # one stretch of an open file, returns how much of it was sent; hashed bytes pass through userspace
+        if not hasher:
+                return conn.sendfile(file, offset, length)
+        view = memoryview(bytearray(min(length, CODEC_CHUNK) or 1))
+        sent = 0
+        while sent < length:
+                read = os.preadv(file.fileno(), [view[:min(length - sent, len(view))]], offset + sent)
+                if not read:
+                        break
+                hasher.update(view[:read])
+                conn.sendall(view[:read])
+                sent += read
+        return sent
+
+
+def send_sparse(conn, file_path, offset, extents):
+        # the extent map, then the data it lists back to back; the digest covers both, so the holes are checked
+        # through the map instead of being hashed as zeros. A short file is padded like send_file_body.
+        hasher = CHECKSUMS[conn.checksum]() if conn.checksum else None
+        extent_map = json.dumps(extents)
+        conn.send_msg(extent_map)
+        if hasher:
+                hasher.update(extent_map.encode())
+        try:
+                file = open(file_path, "rb", buffering=0)
+        except OSError as e:
+                log.warning("%s", e)
+                file = None
+        try:
+                for start, length in extents:
+                        sent = 0
+                        try:
+                                if file:
+                                        sent = send_region(conn, file, offset + start, length, hasher)
+                        except OSError as e:
+                                if isinstance(e, ConnectionError):
+                                        raise
+                                log.warning("%s", e)
+                        while sent < length:
+                                padding = bytes(min(length - sent, BUFFER_SIZE))
+                                if hasher:
+                                        hasher.update(padding)
+                                conn.sendall(padding)
+                                sent += len(padding)
+        finally:
+                if file:
+                        file.close()
+        if hasher:
+                conn.send_msg(hasher.hexdigest())
+
+
+def send_hashed(conn, file_path, size, offset, hasher):
+        # read, hash and send in one pass over the file; padded like send_file_body
+        view = memoryview(bytearray(min(size, CODEC_CHUNK) or 1))
+        sent = 0
+        try:
+                with open(file_path, "rb", buffering=0) as file:
+                        file.seek(offset)
+                        while sent < size:
+                                read = file.readinto(view[:min(size - sent, len(view))])
+                                if not read:
+                                        break
+                                hasher.update(view[:read])
+                                conn.sendall(view[:read])
+                                sent += read
+        except OSError as e:
+                if isinstance(e, ConnectionError):
+                        raise
+                log.warning("%s", e)
+        complete = sent == size
+        while sent < size:
+                padding = bytes(min(size - sent, BUFFER_SIZE))
+                hasher.update(padding)
+                conn.sendall(padding)
+                sent += len(padding)
+        return complete
+
+
+def negotiate(offered, table):
+        for name in offered.split(","):
+                if name in table:
+                        return name
+        return None
+
+
+def choose_codec(file_path, codec, size, offset=0):
+        # skip tiny bodies, formats that are already compressed and data whose sample barely shrinks
+        if codec not in CODECS or size < CODEC_MIN_SIZE:
+                return None
+        if os.path.splitext(file_path)[1].lower() in COMPRESSED_EXTENSIONS:
+                return None
+        with open(file_path, "rb") as file:
+                file.seek(offset)
+                sample = file.read(min(size, BUFFER_SIZE))
+        return codec if compresses(sample) else None
+
+
+def compresses(sample):
+        return len(zlib.compress(sample, 1)) <= len(sample) * (1 - CODEC_MIN_SAVING)
+
+
+def compressed_chunks(file_path, size, offset, codec, hasher=None):
+        # one frame per compressed chunk; short files are padded like send_file_body does
+        compressor = CODECS[codec][0]()
+        remaining = size
+        with open(file_path, "rb") as file:
+                file.seek(offset)
+                while remaining:
+                        chunk = file.read(min(remaining, CODEC_CHUNK)) or bytes(min(remaining, CODEC_CHUNK))
+                        remaining -= len(chunk)
+                        if hasher:
+                                hasher.update(chunk)
+                        data = compressor.compress(chunk)
+                        if data:
+                                yield data
+        data = compressor.flush()
+        if data:
+                yield data
+
+
+def inflate(decompressor, data, limit=CODEC_CHUNK):
+        # bounded output per call, so a small frame of zeros cannot balloon in memory
+        chunk = decompressor.decompress(data, limit)
+        while chunk:
+                yield chunk
+                if hasattr(decompressor, "unconsumed_tail"):
+                        pending = decompressor.unconsumed_tail
+                        chunk = decompressor.decompress(pending, limit) if pending else b""
+                elif decompressor.needs_input or decompressor.eof:
+                        chunk = b""
+                else:
+                        chunk = decompressor.decompress(b"", limit)
+
+
+def send_compressed(conn, file_path, size, offset, codec, hasher=None):
+        try:
+                for data in compressed_chunks(file_path, size, offset, codec, hasher):
+                        conn.send_msg(data)
+        except OSError as e:
+                if isinstance(e, ConnectionError):
+                        raise
+                log.warning("%s", e)    # the receiver sees a short body and drops the file
+                conn.send_msg(b"")
+                return False
+        conn.send_msg(b"")
+        return True
+
+
+def receive_compressed(conn, file_path, file_size, offset, codec, checksum=None):
+        try:
+                fd = open_partial(file_path, file_size, offset)
+        except OSError:
+                while conn.recv_frame():
+                        pass
+                if checksum:
+                        conn.recv_frame()
+                raise
+        decompressor = CODECS[codec][1]()
+        hasher = CHECKSUMS[checksum]() if checksum else None
+        written = offset
+        error = None
+        try:
+                while frame := conn.recv_frame():
+                        if error:
+                                continue
+                        try:
+                                for chunk in inflate(decompressor, frame):
+                                        if written + len(chunk) > file_size:
+                                                raise ValueError(f"{file_path} is larger than announced")
+                                        write_all(fd, memoryview(chunk))
+                                        written += len(chunk)
+                                        if hasher:
+                                                hasher.update(chunk)
+                        except Exception as e:
+                                error = e   # keep reading until the end marker so the stream stays in sync
+                if checksum:
+                        try:
+                                check_trailer(conn, file_path, checksum, None if error else hasher)
+                        except ValueError as e:
+                                error = error or e
+        except BaseException:
+                # interrupted: keep what arrived so the transfer can be resumed
+                os.ftruncate(fd, written)
+                os.close(fd)
+                raise
+        if error is None and written != file_size:
+                error = ValueError(f"{file_path} ended after {written} of {file_size} bytes")
+        close_partial(fd, file_path, error is None)
+        if error:
+                raise error
+
+
+def send_body(conn, file_path, size, offset=0, hashes=None):
+        # once a codec is negotiated every body is announced as raw or compressed, and once a checksum is,
+        # every body is followed by a digest of the bytes it stands for, taken while they are sent
+        extents = sparse_extents(file_path, size, offset) if conn.sparse else None
+        if extents is not None:
+                conn.send_msg("sparse")
+                send_sparse(conn, file_path, offset, extents)
+                return
+        codec = None
+        if conn.codec:
+                try:
+                        codec = choose_codec(file_path, conn.codec, size, offset)
+                except OSError:
+                        pass
+        if conn.codec or conn.sparse:
+                conn.send_msg(codec or "raw")
+        send_digested(conn, file_path, size, offset, hashes, codec)
+
+
+def send_digested(conn, file_path, size, offset=0, hashes=None, codec=None):
+        # a body that is not announced (in a tree, a range) or already was, then its digest once a checksum is negotiated
+        digest, info = hashes.lookup(file_path, size, offset, conn.checksum) if hashes and conn.checksum else (None, None)
+        hasher = CHECKSUMS[conn.checksum]() if conn.checksum and not digest else None
+        if codec:
+                complete = send_compressed(conn, file_path, size, offset, codec, hasher)
+        elif hasher:
+                complete = send_hashed(conn, file_path, size, offset, hasher)
+        else:
+                send_file_body(conn, file_path, size, offset)
+        if hasher:
+                digest = hasher.hexdigest()
+                if hashes and complete:
+                        hashes.store(file_path, info, conn.checksum, digest)
+        if conn.checksum:
+                conn.send_msg(digest)
+
+
+def data_digest(algorithm, data):
+        hasher = CHECKSUMS[algorithm]()
+        hasher.update(data)
+        return hasher.hexdigest()
+
+
+def receive_body(conn, file_path, file_size, offset=0):
+        codec = conn.recv_msg() if conn.codec or conn.sparse else "raw"
+        if codec == "raw":
+                receive_to_file(conn, file_path, file_size, offset, conn.checksum)
+        elif codec == "sparse":
+                receive_sparse(conn, file_path, file_size, offset, conn.checksum)
+        elif codec in CODECS:
+                receive_compressed(conn, file_path, file_size, offset, codec, conn.checksum)
+        else:
+                raise ConnectionError(f"Unknown body encoding {codec}")
+
+
+def body_chunks(conn, size, name="body"):
+        # a body handed over in pieces instead of written to a file, decoded and checked like receive_body;
+        # the connection is only usable again once the caller has read it to the end
+        codec = conn.recv_msg() if conn.codec or conn.sparse else "raw"
+        hasher = CHECKSUMS[conn.checksum]() if conn.checksum else None
+        received = 0
+        error = None
+        if codec == "raw":
+                while received < size:
+                        chunk = conn.recv_exact(min(size - received, CODEC_CHUNK))
+                        received += len(chunk)
+                        if hasher:
+                                hasher.update(chunk)
+                        yield chunk
+        elif codec == "sparse":
+                # holes come out as zeros, only the extents are read off the connection
+                extent_map, extents = read_extents(conn, size)
+                if hasher:
+                        hasher.update(extent_map.encode())
+                for start, length in [*extents, (size, 0)]:
+                        while received < start:
+                                hole = bytes(min(start - received, CODEC_CHUNK))
+                                received += len(hole)
+                                yield hole
+                        end = received + length
+                        while received < end:
+                                chunk = conn.recv_exact(min(end - received, CODEC_CHUNK))
+                                received += len(chunk)
+                                if hasher:
+                                        hasher.update(chunk)
+                                yield chunk
+        elif codec in CODECS:
+                decompressor = CODECS[codec][1]()
+                while frame := conn.recv_frame():
+                        chunks = inflate(decompressor, frame)
+                        while not error:    # keep reading until the end marker so the stream stays in sync
+                                try:
+                                        chunk = next(chunks, None)
+                                except Exception as e:
+                                        error = e
+                                        break
+                                if chunk is None:
+                                        break
+                                if received + len(chunk) > size:
+                                        error = ValueError(f"{name} is larger than announced")
+                                        break
+                                received += len(chunk)
+                                if hasher:
+                                        hasher.update(chunk)
+                                yield chunk
+        else:
+                raise ConnectionError(f"Unknown body encoding {codec}")
+        if conn.checksum:
+                check_trailer(conn, name, conn.checksum, None if error else hasher)
+        if error:
+                raise error
+        if received != size:
+                raise ValueError(f"{name} ended after {received} of {size} bytes")
+
+
+def send_chunks(conn, chunks, size):
+        # a body from memory or a generator, announced and digested like send_body; a source that does not
+        # come to size is cut or padded and followed by a digest that cannot match, so the receiver drops it
+        if conn.codec or conn.sparse:
+                conn.send_msg("raw")
+        hasher = CHECKSUMS[conn.checksum]() if conn.checksum else None
+        sent = 0
+        complete = True
+        for chunk in chunks:
+                chunk = memoryview(chunk).cast("B")
+                if sent + len(chunk) > size:
+                        chunk = chunk[:size - sent]
+                        complete = False
+                if hasher:
+                        hasher.update(chunk)
+                conn.sendall(chunk)
+                sent += len(chunk)
+                if not complete:
+                        break
+        if sent < size:
+                complete = False
+        while sent < size:
+                padding = bytes(min(size - sent, BUFFER_SIZE))
+                conn.sendall(padding)
+                sent += len(padding)
+        if conn.checksum:
+                conn.send_msg(hasher.hexdigest() if complete else "")
+        return complete
+
 
-def really_recv(client, length):
-        data = bytearray()
-        while len(data) < length:
-                chunk = client.recv(1)
-                if not chunk or chunk == b'~':
+def send_bodies(conn, root, manifest, coalesce=True, hashes=None):
+        # file bodies follow the manifest back to back, each with its digest when a checksum is negotiated;
+        # small files are gathered into one sendmsg
+        base_dir = os.path.dirname(os.path.normpath(root))
+        batch, batched = [], 0
+        if coalesce:
+                conn.cork(True)
+        try:
+                for path, kind, size, _ in manifest:
+                        if kind != "f" or (size == 0 and not conn.checksum):
+                                continue
+                        file_path = os.path.join(base_dir, path)
+                        if coalesce and size <= SMALL_FILE:
+                                batch.append(read_exactly(file_path, size))
+                                if conn.checksum:
+                                        batch.append(pack_frames(data_digest(conn.checksum, batch[-1])))
+                                batched += size
+                                if batched >= BATCH_SIZE or len(batch) >= IOV_MAX:
+                                        conn.send_buffers(batch)
+                                        batch, batched = [], 0
+                                continue
+                        if batch:
+                                conn.send_buffers(batch)
+                                batch, batched = [], 0
+                        send_digested(conn, file_path, size, 0, hashes)
+                if batch:
+                        conn.send_buffers(batch)
+        finally:
+                if coalesce:
+                        conn.cork(False)
+
+
+def receive_tree(conn, base_dir):
+        manifest = json.loads(conn.recv_msg())
+        dir_modes = []
+        for path, kind, size, mode in manifest:
+                try:
+                        target = safe_join(base_dir, path)
+                except ValueError as e:
+                        log.warning("%s", e)
+                        if kind == "f":
+                                discard(conn, size)
+                                if conn.checksum:
+                                        conn.recv_frame()
+                        continue
+                try:
+                        if kind == "d":
+                                os.makedirs(target, 0o766, exist_ok=True)
+                                dir_modes.append((target, mode))
+                        else:
+                                # drains the body even on disk errors, and drops a file that fails its check
+                                receive_to_file(conn, target, size, 0, conn.checksum)
+                                os.chmod(target, mode & 0o777)
+                except ConnectionError:
+                        raise
+                except (ValueError, OSError) as e:
+                        log.warning("%s", e)
+        for target, mode in reversed(dir_modes):
+                os.chmod(target, mode & 0o777)
+        return manifest
+
+
+def split_ranges(manifest):
+        # large files are cut into STREAM_CHUNK ranges so several streams can share them
+        ranges = []
+        for path, kind, size, _ in manifest:
+                if kind == "f":
+                        for offset in range(0, size, STREAM_CHUNK):
+                                ranges.append((path, offset, min(STREAM_CHUNK, size - offset)))
+        return ranges
+
+
+def receive_range(conn, fd, offset, length, name="range"):
+        # a ValueError when the range fails its check; the file is only put in place once every range arrived
+        body = BodyReceiver(conn, fd, offset, CHECKSUMS[conn.checksum]() if conn.checksum else None)
+        try:
+                body.run(length)
+        except OSError as e:
+                if not isinstance(e, ConnectionError):
+                        discard(conn, length - body.taken)
+                        if conn.checksum:
+                                conn.recv_frame()
+                raise
+        if conn.checksum:
+                check_trailer(conn, name, conn.checksum, body.hasher)
+
+
+def create_partials(base_dir, manifest):
+        for path, kind, size, _ in manifest:
+                target = safe_join(base_dir, path)
+                if kind == "d":
+                        os.makedirs(target, 0o766, exist_ok=True)
+                else:
+                        fd = open_partial(target, size)
+                        os.ftruncate(fd, size)  # pput ranges are checked against it
+                        os.close(fd)
+
+
+def commit_partials(base_dir, manifest, commit):
+        for path, kind, _, mode in manifest:
+                if kind != "f":
+                        continue
+                if commit:
+                        target = safe_join(base_dir, path)
+                        os.replace(partial_path(target), target)
+                        os.chmod(target, mode & 0o777)
+                else:
+                        try:
+                                os.unlink(partial_path(safe_join(base_dir, path)))
+                        except (ValueError, OSError):
+                                pass
+
+
+def file_digest(file_path):
+        with open(file_path, "rb") as file:
+                return hashlib.file_digest(file, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+
+def sync_manifest(root):
+        # build_manifest entries extended with the mtime and a whole-file hash
+        manifest = build_manifest(root)
+        base_dir = os.path.dirname(os.path.normpath(root))
+        for entry in manifest:
+                path = os.path.join(base_dir, entry[0])
+                entry.append(os.stat(path).st_mtime_ns)
+                entry.append(file_digest(path) if entry[1] == "f" else "")
+        return manifest
+
+
+def sync_block_size(size):
+        return max(SYNC_MIN_BLOCK, min(SYNC_MAX_BLOCK, 1 << (size.bit_length() // 2)))
+
+
+def block_signatures(file_path, block_size):
+        # a weak adler32 that can be rolled byte by byte, and a short strong hash to confirm matches
+        signatures = []
+        with open(file_path, "rb") as file:
+                while block := file.read(block_size):
+                        signatures.append([zlib.adler32(block), hashlib.blake2b(block, digest_size=8).hexdigest()])
+        return signatures
+
+
+def delta_ops(file_path, block_size, basis_size, signatures):
+        # yields ("C", index) for blocks the receiver already has and ("D", data) for everything else
+        size = os.path.getsize(file_path)
+        if size == 0:
+                return
+        with open(file_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if not signatures:
+                        for start in range(0, size, BUFFER_SIZE):
+                                yield "D", data[start:start + BUFFER_SIZE]
+                        return
+                full_blocks = basis_size // block_size
+                table = {}
+                for index, (weak, strong) in enumerate(signatures[:full_blocks]):
+                        table.setdefault(weak, []).append((index, strong))
+                pos = literal = 0
+                weak = None
+                while pos + block_size <= size:
+                        if weak is None:
+                                weak = zlib.adler32(data[pos:pos + block_size])
+                        if weak in table:
+                                strong = hashlib.blake2b(data[pos:pos + block_size], digest_size=8).hexdigest()
+                                index = next((i for i, s in table[weak] if s == strong), None)
+                                if index is not None:
+                                        if literal < pos:
+                                                yield "D", data[literal:pos]
+                                        yield "C", index
+                                        pos += block_size
+                                        literal = pos
+                                        weak = None
+                                        continue
+                        if pos + block_size < size:
+                                out, new = data[pos], data[pos + block_size]
+                                a = ((weak & 0xffff) - out + new) % ADLER_MOD
+                                b = ((weak >> 16) - block_size * out + a - 1) % ADLER_MOD
+                                weak = (b << 16) | a
+                        pos += 1
+                        if pos - literal >= BUFFER_SIZE:
+                                yield "D", data[literal:pos]
+                                literal = pos
+                tail = size - pos
+                last = len(signatures) - 1
+                if tail and last == full_blocks and tail == basis_size - last * block_size \
+                                and hashlib.blake2b(data[pos:size], digest_size=8).hexdigest() == signatures[last][1]:
+                        if literal < pos:
+                                yield "D", data[literal:pos]
+                        yield "C", last
+                elif literal < size:
+                        for start in range(literal, size, BUFFER_SIZE):
+                                yield "D", data[start:min(size, start + BUFFER_SIZE)]
+
+
+def send_delta(conn, ops):
+        # copy instructions are tiny, so frames are packed together before each sendall
+        packet = bytearray()
+        try:
+                for op, value in ops:
+                        if op == "C":
+                                packet += pack_frames(b"C" + HEADER.pack(value))
+                        else:
+                                packet += pack_frames(b"D" + value)
+                        if len(packet) >= BUFFER_SIZE:
+                                conn.sendall(packet)
+                                packet = bytearray()
+        except (OSError, ValueError) as e:
+                if isinstance(e, ConnectionError):
+                        raise
+                log.warning("%s", e)    # the receiver notices the hash mismatch and drops the file
+        packet += pack_frames(b"E")
+        conn.sendall(packet)
+
+
+def apply_delta(conn, basis_path, file_path, size, block_size, digest):
+        fd = open_partial(file_path, size)
+        hasher = hashlib.blake2b(digest_size=16)
+        literal = 0
+        error = None
+        basis = None
+        try:
+                if basis_path:
+                        try:
+                                basis = open(basis_path, "rb")
+                        except OSError as e:
+                                error = e   # the delta is still read to its end marker
+                while True:
+                        frame = conn.recv_frame()
+                        if frame[:1] == b"E":
+                                break
+                        if error:
+                                continue
+                        try:
+                                if frame[:1] == b"C":
+                                        (index,) = HEADER.unpack_from(frame, 1)
+                                        basis.seek(index * block_size)
+                                        chunk = basis.read(block_size)
+                                else:
+                                        chunk = memoryview(frame)[1:]
+                                        literal += len(chunk)
+                                hasher.update(chunk)
+                                write_all(fd, memoryview(chunk))
+                        except (OSError, AttributeError) as e:
+                                error = e   # keep reading until the end marker so the stream stays in sync
+        except BaseException:
+                close_partial(fd, file_path, False)
+                raise
+        finally:
+                if basis:
+                        basis.close()
+        if error is None and hasher.hexdigest() != digest:
+                error = ValueError(f"Checksum mismatch for {file_path}")
+        close_partial(fd, file_path, error is None)
+        if error:
+                raise error
+        return literal
+
+
+def sync_send(conn, root):
+        manifest = sync_manifest(root)
+        conn.send_msg(json.dumps(manifest))
+        needs = json.loads(conn.recv_msg())
+        base_dir = os.path.dirname(os.path.normpath(root))
+        for index, block_size, basis_size, signatures in needs:
+                file_path = os.path.join(base_dir, manifest[index][0])
+                send_delta(conn, delta_ops(file_path, block_size, basis_size, signatures))
+        return json.loads(conn.recv_msg())
+
+
+def sync_receive(conn, base_dir):
+        # skip files whose size and mtime or hash already match, send block signatures for the rest
+        manifest = json.loads(conn.recv_msg())
+        needs = []
+        stats = {"files": 0, "changed": 0, "failed": 0, "sent": 0, "total": 0}
+        for index, (path, kind, size, _, mtime, digest) in enumerate(manifest):
+                try:
+                        target = safe_join(base_dir, path)
+                        if kind == "d":
+                                os.makedirs(target, 0o766, exist_ok=True)
+                                continue
+                        stats["files"] += 1
+                        stats["total"] += size
+                        if not os.path.isfile(target):
+                                needs.append([index, 0, 0, []])
+                                continue
+                        info = os.stat(target)
+                        if info.st_size == size and (info.st_mtime_ns == mtime or file_digest(target) == digest):
+                                os.utime(target, ns=(info.st_atime_ns, mtime))
+                                continue
+                        block_size = sync_block_size(info.st_size)
+                        needs.append([index, block_size, info.st_size, block_signatures(target, block_size)])
+                except (ValueError, OSError) as e:
+                        log.warning("%s", e)
+        conn.send_msg(json.dumps(needs))
+        for index, block_size, basis_size, signatures in needs:
+                path, _, size, mode, mtime, digest = manifest[index]
+                target = safe_join(base_dir, path)
+                stats["changed"] += 1
+                try:
+                        stats["sent"] += apply_delta(conn, target if signatures else None, target, size, block_size, digest)
+                        os.chmod(target, mode & 0o777)
+                        os.utime(target, ns=(mtime, mtime))
+                except (ValueError, OSError) as e:
+                        if isinstance(e, ConnectionError):
+                                raise
+                        log.warning("%s", e)
+                        stats["failed"] += 1
+        conn.send_msg(json.dumps(stats))
+        return stats
+
+
+def describe_sync(stats):
+        saved = stats["total"] - stats["sent"]
+        return (f"Synced {stats['files']} files, {stats['changed']} changed, {stats['failed']} failed: "
+                f"sent {stats['sent']} of {stats['total']} bytes ({saved} bytes saved)")
+
+
+def copy_fd(fd_in, fd_out, size):
+        # a reflink when the filesystem can share extents, otherwise copy_file_range so the bytes never leave
+        # the kernel, and sendfile where even that is not supported; returns which one did it
+        try:
+                fcntl.ioctl(fd_out, FICLONE, fd_in)
+                return "cloned"
+        except OSError:
+                pass
+        copied = 0
+        method = "copied" if hasattr(os, "copy_file_range") else "sent"
+        while copied < size:
+                if method == "copied":
+                        try:
+                                moved = os.copy_file_range(fd_in, fd_out, size - copied, copied, copied)
+                        except OSError as e:
+                                if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                                        raise
+                                method = "sent"
+                                continue
+                else:
+                        moved = os.sendfile(fd_out, fd_in, copied, size - copied)
+                if not moved:
                         break
-                data.extend(chunk)
-        return bytes(data)
+                copied += moved
+        return method
+
+
+def copy_file(src, dst):
+        # written to a hidden partial next to dst and renamed into place, like an upload
+        fd_in = os.open(src, os.O_RDONLY)
+        try:
+                info = os.fstat(fd_in)
+                fd = os.open(partial_path(dst), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(info.st_mode))
+                try:
+                        method = copy_fd(fd_in, fd, info.st_size)
+                except BaseException:
+                        close_partial(fd, dst, False)
+                        raise
+                close_partial(fd, dst, True)
+        finally:
+                os.close(fd_in)
+        return method, info.st_size
+
+
+def copy_path(src, dst, recursive=False, threads=COPY_THREADS, job=None):
+        # directories and links are made in walk order, then the files are copied in parallel
+        stats = {"files": 0, "bytes": 0, "cloned": 0}
+        if os.path.isdir(src) and not os.path.islink(src):
+                if not recursive:
+                        raise ValueError(f"{src} is a directory, use cp -r")
+                pairs = []
+                for root, dirs, files in os.walk(src):
+                        target = os.path.join(dst, os.path.relpath(root, src))
+                        os.makedirs(target, exist_ok=True)
+                        shutil.copymode(root, target)
+                        for name in dirs:   # links to directories are listed here but not walked
+                                if os.path.islink(os.path.join(root, name)):
+                                        os.symlink(os.readlink(os.path.join(root, name)), os.path.join(target, name))
+                        for name in files:
+                                if os.path.islink(os.path.join(root, name)):
+                                        os.symlink(os.readlink(os.path.join(root, name)), os.path.join(target, name))
+                                else:
+                                        pairs.append((os.path.join(root, name), os.path.join(target, name)))
+        else:
+                pairs = [(src, dst)]
+        if job:
+                job.total = len(pairs)
+
+        def copy_one(pair):
+                if job:
+                        job.check()
+                method, size = copy_file(*pair)
+                if job:
+                        job.advance(1, size)
+                return method, size
+
+        with ThreadPoolExecutor(max_workers=min(threads, len(pairs)) or 1) as pool:
+                results = list(pool.map(copy_one, pairs))
+        for method, size in results:
+                stats["files"] += 1
+                stats["bytes"] += size
+                stats["cloned"] += method == "cloned"
+        return stats
+
+
+def describe_copy(stats):
+        return f"Copied {stats['files']} files, {stats['bytes']} bytes ({stats['cloned']} cloned)"
+
+
+def move_path(src, dst, job=None):
+        # a rename within one filesystem, a copy and delete across two
+        try:
+                os.rename(src, dst)
+                return
+        except OSError as e:
+                if e.errno != errno.EXDEV:
+                        raise
+        copy_path(src, dst, recursive=True, job=job)
+        if os.path.isdir(src) and not os.path.islink(src):
+                remove_tree(src, job)
+        else:
+                os.remove(src)
+
+
+def remove_tree(path, job=None):
+        # bottom up, one entry at a time, so progress shows and a cancel leaves a smaller tree rather than a broken one
+        for root, dirs, files in os.walk(path, topdown=False):
+                for name in files:
+                        if job:
+                                job.check()
+                        os.unlink(os.path.join(root, name))
+                        if job:
+                                job.advance()
+                for name in dirs:   # already emptied, or links to directories that were not walked
+                        if job:
+                                job.check()
+                        entry = os.path.join(root, name)
+                        if os.path.islink(entry):
+                                os.unlink(entry)
+                        else:
+                                os.rmdir(entry)
+                        if job:
+                                job.advance()
+        os.rmdir(path)
+
+
+def tree_digest(root, algorithm, hashes=None, job=None):
+        # one digest over the sorted relative paths and their file digests, so two trees compare by a line each
+        if os.path.isdir(root):
+                base = root
+                paths = sorted(os.path.relpath(os.path.join(dir_path, name), root)
+                               for dir_path, _, files in os.walk(root) for name in files)
+        else:
+                base, name = os.path.split(root)
+                paths = [name]
+        if job:
+                job.total = len(paths)
+        outer = CHECKSUMS[algorithm]()
+        total = 0
+        for rel_path in paths:
+                if job:
+                        job.check()
+                file_path = os.path.join(base, rel_path)
+                size = os.path.getsize(file_path)
+                digest, info = hashes.lookup(file_path, size, 0, algorithm) if hashes else (None, None)
+                if digest is None:
+                        with open(file_path, "rb") as file:
+                                digest = hashlib.file_digest(file, CHECKSUMS[algorithm]).hexdigest()
+                        if hashes:
+                                hashes.store(file_path, info, algorithm, digest)
+                outer.update(f"{rel_path}\0{digest}\n".encode())
+                total += size
+                if job:
+                        job.advance(1, size)
+        return f"{algorithm} {outer.hexdigest()} over {len(paths)} files, {total} bytes"
+
+
+def entry_info(entry):
+        # (name, kind, size, mtime_ns); kind is "d", "f", or "o" for anything else
+        try:
+                info = entry.stat()
+                kind = "d" if entry.is_dir() else "f" if entry.is_file() else "o"
+        except OSError:
+                info = entry.stat(follow_symlinks=False)
+                kind = "o"
+        return (entry.name, kind, info.st_size, info.st_mtime_ns)
+
+
+def iter_listing(dir_path, pattern=None):
+        # names are matched before the stat, so a glob over a huge directory stays cheap
+        with os.scandir(dir_path) as entries:
+                for entry in entries:
+                        if pattern is None or fnmatch.fnmatchcase(entry.name, pattern):
+                                yield entry_info(entry)
+
+
+class ListingCache:
+        # LRU of scandir results, trusted while the directory's mtime is unchanged and the entry is young
+        def __init__(self, capacity=LISTING_CACHE_SIZE, ttl=LISTING_TTL, max_entries=LISTING_CACHE_ENTRIES):
+                self.entries = OrderedDict()
+                self.capacity = capacity
+                self.ttl = ttl
+                self.max_entries = max_entries
+                self.lock = threading.Lock()
+                self.hits = 0
+                self.misses = 0
+
+        def lookup(self, dir_path, mtime):
+                with self.lock:
+                        cached = self.entries.get(dir_path)
+                        if cached and cached[0] == mtime and time.monotonic() - cached[1] < self.ttl:
+                                self.entries.move_to_end(dir_path)
+                                self.hits += 1
+                                return cached[2]
+                        self.misses += 1
+                return None
+
+        def store(self, dir_path, mtime, listing):
+                # a change in the same timestamp tick as the scan would leave the mtime unchanged
+                if time.time_ns() - mtime <= RACY_WINDOW_NS or len(listing) > self.max_entries:
+                        return
+                with self.lock:
+                        self.entries[dir_path] = (mtime, time.monotonic(), listing)
+                        self.entries.move_to_end(dir_path)
+                        if len(self.entries) > self.capacity:
+                                self.entries.popitem(last=False)
+
+        def iter(self, dir_path, pattern=None):
+                # the cached listing when there is one, otherwise a streaming scan remembered if it is small
+                mtime = os.stat(dir_path).st_mtime_ns
+                listing = self.lookup(dir_path, mtime)
+                if listing is not None:
+                        return (entry for entry in listing if pattern is None or fnmatch.fnmatchcase(entry[0], pattern))
+                if pattern is not None:
+                        return iter_listing(dir_path, pattern)
+                return self.__record(dir_path, mtime)
+
+        def __record(self, dir_path, mtime):
+                seen = []
+                for entry in iter_listing(dir_path):
+                        if seen is not None:
+                                seen.append(entry)
+                                if len(seen) > self.max_entries:
+                                        seen = None
+                        yield entry
+                if seen is not None:
+                        self.store(dir_path, mtime, seen)
+
+        def invalidate(self, path):
+                # drops the directory and everything cached below it
+                path = os.path.abspath(path)
+                with self.lock:
+                        for key in [key for key in self.entries if key == path or key.startswith(path + os.sep)]:
+                                del self.entries[key]
+
+
+SORT_KEYS = {
+        "name": lambda entry: (entry[0],),
+        "size": lambda entry: (entry[2], entry[0]),
+        "mtime": lambda entry: (entry[3], entry[0]),
+}
+
+
+def encode_cursor(key):
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+        try:
+                return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+        except (ValueError, TypeError):
+                raise ValueError(f"Invalid cursor {cursor}")
+
+
+def list_page(entries, sort=None, reverse=False, limit=None, cursor=None):
+        # scandir order streams in constant memory; paging needs a stable order, so it defaults to name
+        if not (sort or limit or cursor):
+                return entries, None
+        key = SORT_KEYS[sort or "name"]
+        if cursor:
+                after = decode_cursor(cursor)
+                if len(after) != len(key(("", "", 0, 0))) or not isinstance(after[-1], str):
+                        raise ValueError(f"Cursor {cursor} does not match the sort order")
+                entries = (entry for entry in entries if (key(entry) < after if reverse else key(entry) > after))
+        if not limit:
+                return sorted(entries, key=key, reverse=reverse), None
+        page = (heapq.nlargest if reverse else heapq.nsmallest)(limit, entries, key=key)
+        return page, encode_cursor(key(page[-1])) if len(page) == limit else None
+
+
+def take(entries, count):
+        return list(itertools.islice(entries, count))
+
+
+def index_location(serve_dir, kind="index"):
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        name = hashlib.blake2b(serve_dir.encode(), digest_size=8).hexdigest()
+        return os.path.join(cache_dir, "fileserver", f"{kind}-{name}.sqlite")
+
+
+def thread_db(local, db_path):
+        # one connection per thread, and a fresh one in a forked child
+        if getattr(local, "pid", None) != os.getpid():
+                db = sqlite3.connect(db_path, timeout=5)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                local.db = db
+                local.pid = os.getpid()
+        return local.db
+
+
+def subtree(rel_path):
+        # WHERE clause for a path and everything below it, as a range on the primary key
+        if not rel_path:
+                return "1", ()
+        return "(path = ? OR (path >= ? AND path < ?))", (rel_path, rel_path + "/", rel_path + "0")
+
+
+class MetadataIndex:
+        # Paths relative to the serving directory with their type, size and mtime, kept in SQLite.
+        # A directory is rescanned when its mtime moves; a full pass also picks up files rewritten in place.
+        def __init__(self, root, db_path=None):
+                self.root = root
+                self.db_path = db_path or index_location(root)
+                self.local = threading.local()
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                # closed straight away: a connection must never be carried across a fork
+                db = sqlite3.connect(self.db_path, timeout=5)
+                try:
+                        db.executescript("""
+                                CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, parent TEXT, name TEXT,
+                                                                    kind TEXT, size INTEGER, mtime INTEGER);
+                                CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+                                CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+                                CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER,
+                                                                 files INTEGER, bytes INTEGER);
+                        """)
+                finally:
+                        db.close()
+
+        def db(self):
+                return thread_db(self.local, self.db_path)
+
+        def relative(self, path):
+                rel_path = os.path.relpath(os.path.abspath(path), self.root)
+                if rel_path == os.curdir:
+                        return ""
+                if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+                        raise ValueError(f"{path} is outside the index")
+                return rel_path
+
+        def __drop(self, db, rel_path):
+                where, args = subtree(rel_path)
+                db.execute(f"DELETE FROM entries WHERE {where}", args)
+                db.execute(f"DELETE FROM dirs WHERE {where}", args)
+
+        def __scan(self, db, rel_dir, mtime):
+                rows = []
+                with os.scandir(os.path.join(self.root, rel_dir)) as entries:
+                        for entry in entries:
+                                try:
+                                        info = entry.stat(follow_symlinks=False)
+                                except OSError:
+                                        continue
+                                kind = "d" if entry.is_dir(follow_symlinks=False) else "f" if entry.is_file(follow_symlinks=False) else "o"
+                                path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                                rows.append((path, rel_dir, entry.name, kind, info.st_size, info.st_mtime_ns))
+                subdirs = [row[0] for row in rows if row[3] == "d"]
+                known = db.execute("SELECT path FROM entries WHERE parent = ? AND kind = 'd'", (rel_dir,)).fetchall()
+                for (gone,) in set(known) - {(path,) for path in subdirs}:
+                        self.__drop(db, gone)
+                db.execute("DELETE FROM entries WHERE parent = ?", (rel_dir,))
+                db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+                # a change in the same timestamp tick would not move the mtime, so recent scans are redone
+                if time.time_ns() - mtime <= RACY_WINDOW_NS:
+                        mtime = -1
+                # per directory totals of its own files, so du sums directories instead of every file
+                sizes = [row[4] for row in rows if row[3] == "f"]
+                db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", (rel_dir, mtime, len(sizes), sum(sizes)))
+                return subdirs
+
+        def update(self, rel_dir="", full=False, job=None):
+                db = self.db()
+                stack = [rel_dir]
+                scanned = 0
+                try:
+                        while stack:
+                                rel_path = stack.pop()
+                                if job:
+                                        job.check()
+                                        job.advance()
+                                try:
+                                        mtime = os.stat(os.path.join(self.root, rel_path), follow_symlinks=False).st_mtime_ns
+                                        known = db.execute("SELECT mtime FROM dirs WHERE path = ?", (rel_path,)).fetchone()
+                                        if full or rel_path == rel_dir or known is None or known[0] != mtime:
+                                                stack.extend(self.__scan(db, rel_path, mtime))
+                                                scanned += 1
+                                        else:
+                                                stack.extend(path for (path,) in db.execute(
+                                                        "SELECT path FROM entries WHERE parent = ? AND kind = 'd'", (rel_path,)))
+                                except (FileNotFoundError, NotADirectoryError):
+                                        self.__drop(db, rel_path)
+                                except PermissionError as e:
+                                        log.warning("Indexing skipped: %s", e)
+                                if scanned >= INDEX_COMMIT_DIRS:
+                                        db.commit()     # short write transactions, so refreshes from handlers are not starved
+                                        scanned = 0
+                        db.commit()
+                except BaseException:
+                        db.rollback()
+                        raise
+
+        def refresh(self, dir_path):
+                # called by the server's own handlers after they change a directory
+                try:
+                        self.update(self.relative(dir_path))
+                except (ValueError, OSError, sqlite3.Error) as e:
+                        log.warning("Index refresh failed: %s", e)
+
+        def ready(self):
+                return self.db().execute("SELECT 1 FROM dirs WHERE path = ''").fetchone() is not None
+
+        def run_forever(self, interval=INDEX_INTERVAL, full_interval=INDEX_FULL_INTERVAL):
+                last_full = 0
+                while True:
+                        full = time.monotonic() - last_full >= full_interval
+                        try:
+                                self.update(full=full)
+                                if full:
+                                        last_full = time.monotonic()
+                        except (OSError, sqlite3.Error) as e:
+                                log.warning("Indexing failed: %s", e)
+                        time.sleep(interval)
+
+        def find(self, pattern, rel_dir="", limit=FIND_LIMIT):
+                # the pattern matches names, or whole relative paths when it contains a /
+                where, args = subtree(rel_dir)
+                column = "path" if "/" in pattern else "name"
+                return self.db().execute(f"SELECT path, kind, size, mtime FROM entries WHERE {column} GLOB ? AND {where} "
+                                         f"AND path != ? ORDER BY path LIMIT ?", (pattern, *args, rel_dir, limit)).fetchall()
+
+        def du(self, rel_path=""):
+                where, args = subtree(rel_path)
+                dirs, files, size = self.db().execute(f"SELECT COUNT(*), COALESCE(SUM(files), 0), COALESCE(SUM(bytes), 0) "
+                                                      f"FROM dirs WHERE {where}", args).fetchone()
+                if dirs:
+                        return {"files": files, "dirs": dirs - 1, "bytes": size}
+                row = self.db().execute("SELECT size FROM entries WHERE path = ? AND kind = 'f'", (rel_path,)).fetchone()
+                return {"files": 1 if row else 0, "dirs": 0, "bytes": row[0] if row else 0}
+
+
+class HashCache:
+        # Whole-file digests keyed on device, inode, size and mtime, so an unchanged file is only hashed once.
+        # Kept in SQLite when available so every forked worker sees what the others computed.
+        def __init__(self, db_path=None, capacity=HASH_CACHE_SIZE):
+                self.memory = OrderedDict()
+                self.capacity = capacity
+                self.lock = threading.Lock()
+                self.db_path = db_path if sqlite3 else None
+                self.local = threading.local()
+                if self.db_path:
+                        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                        db = sqlite3.connect(self.db_path, timeout=5)
+                        try:
+                                db.execute("""CREATE TABLE IF NOT EXISTS digests (dev INTEGER, ino INTEGER, algorithm TEXT,
+                                              size INTEGER, mtime INTEGER, digest TEXT, PRIMARY KEY (dev, ino, algorithm))""")
+                        finally:
+                                db.close()
+
+        def __remember(self, key, digest):
+                with self.lock:
+                        self.memory[key] = digest
+                        self.memory.move_to_end(key)
+                        while len(self.memory) > self.capacity:
+                                self.memory.popitem(last=False)
+
+        def lookup(self, file_path, size, offset, algorithm):
+                # (cached digest or None, the stat a fresh digest is stored under, or None if the body is not the whole file)
+                try:
+                        info = os.stat(file_path)
+                except OSError:
+                        return None, None
+                if offset or info.st_size != size:
+                        return None, None
+                key = (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns, algorithm)
+                with self.lock:
+                        digest = self.memory.get(key)
+                if digest is None and self.db_path:
+                        try:
+                                row = thread_db(self.local, self.db_path).execute(
+                                        "SELECT digest FROM digests WHERE dev = ? AND ino = ? AND algorithm = ? AND size = ? "
+                                        "AND mtime = ?", (info.st_dev, info.st_ino, algorithm, info.st_size, info.st_mtime_ns)).fetchone()
+                        except sqlite3.Error as e:
+                                log.warning("Hash cache lookup failed: %s", e)
+                                row = None
+                        if row:
+                                digest = row[0]
+                                self.__remember(key, digest)
+                return digest, info
+
+        def store(self, file_path, info, algorithm, digest):
+                # a write in the same mtime tick would go unnoticed, and a file that moved while it was read
+                # does not match the digest; neither is worth remembering
+                if info is None or time.time_ns() - info.st_mtime_ns <= RACY_WINDOW_NS:
+                        return
+                try:
+                        now = os.stat(file_path)
+                except OSError:
+                        return
+                if (now.st_dev, now.st_ino, now.st_size, now.st_mtime_ns) != (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns):
+                        return
+                self.__remember((info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns, algorithm), digest)
+                if self.db_path:
+                        try:
+                                db = thread_db(self.local, self.db_path)
+                                with db:
+                                        db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                                                   (info.st_dev, info.st_ino, algorithm, info.st_size, info.st_mtime_ns, digest))
+                        except sqlite3.Error as e:
+                                log.warning("Hash cache update failed: %s", e)
+
+
+def stat_key(info):
+        return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+class HotFile:
+        # a cached file: its contents when small, otherwise an open descriptor, and what was derived from it
+        def __init__(self, path, info, data=None, file=None):
+                self.path = path
+                self.key = stat_key(info)
+                self.size = info.st_size
+                self.data = data
+                self.file = file
+                self.derived = {}       # ("digest", algorithm) -> hex digest, ("codec", codec) -> (codec, frames)
+                self.weight = 0 if data is None else len(data)
+                self.holes = info.st_blocks * 512 < info.st_size
+                self.users = 0
+                self.evicted = False
+
+        def close(self):
+                if self.file:
+                        self.file.close()
+
+
+class FileCache:
+        # Hot files by path, trusted while a fresh stat still matches. Small files are held in memory under a
+        # byte cap, larger ones as open descriptors so a get skips the open; the least recently used go first.
+        def __init__(self, capacity=HOT_CACHE_BYTES, small=HOT_FILE_SIZE, descriptors=HOT_DESCRIPTORS):
+                self.entries = OrderedDict()
+                self.capacity = capacity
+                self.small = small
+                self.descriptors = descriptors
+                self.used = 0
+                self.opened = 0
+                self.lock = threading.Lock()
+                self.hits = 0
+                self.misses = 0
+                self.evictions = 0
+
+        def fetch(self, file_path):
+                # (entry or None, whether it was a hit); every entry handed out must be given back with done()
+                try:
+                        info = os.stat(file_path)
+                except OSError:
+                        info = None
+                with self.lock:
+                        entry = self.entries.get(file_path)
+                        if entry and info and entry.key == stat_key(info):
+                                self.entries.move_to_end(file_path)
+                                entry.users += 1
+                                self.hits += 1
+                                return entry, True
+                        self.misses += 1
+                        if entry:
+                                self.__drop(file_path)
+                if info is None or not stat.S_ISREG(info.st_mode):
+                        return None, False
+                entry = self.__load(file_path, info)
+                if entry is None:
+                        return None, False
+                with self.lock:
+                        if file_path in self.entries:
+                                self.__drop(file_path)
+                        self.entries[file_path] = entry
+                        self.used += entry.weight
+                        self.opened += entry.file is not None
+                        entry.users += 1
+                        self.__trim()
+                return entry, False
+
+        def __load(self, file_path, info):
+                # a write in the same mtime tick would go unnoticed, and a file replaced or changed while it is
+                # opened and read is not the one that was stat'ed
+                if time.time_ns() - info.st_mtime_ns <= RACY_WINDOW_NS or info.st_size > self.small and not self.descriptors:
+                        return None
+                try:
+                        file = open(file_path, "rb", buffering=0)
+                except OSError:
+                        return None
+                try:
+                        data = file.read() if info.st_size <= self.small else None
+                        if stat_key(os.fstat(file.fileno())) != stat_key(info) or data is not None and len(data) != info.st_size:
+                                file.close()
+                                return None
+                except OSError:
+                        file.close()
+                        return None
+                if data is not None:
+                        file.close()
+                        return HotFile(file_path, info, data=data)
+                return HotFile(file_path, info, file=file)
+
+        def __drop(self, file_path):
+                entry = self.entries.pop(file_path)
+                self.used -= entry.weight
+                self.opened -= entry.file is not None
+                entry.evicted = True
+                if not entry.users:
+                        entry.close()
+
+        def __trim(self):
+                while self.entries and (self.used > self.capacity or self.opened > self.descriptors):
+                        self.__drop(next(iter(self.entries)))
+                        self.evictions += 1
+
+        def done(self, entry):
+                with self.lock:
+                        entry.users -= 1
+                        if entry.evicted and not entry.users:
+                                entry.close()
+
+        def digest(self, entry, algorithm):
+                key = ("digest", algorithm)
+                if key not in entry.derived:
+                        hasher = CHECKSUMS[algorithm]()
+                        if entry.data is not None:
+                                hasher.update(entry.data)
+                        else:
+                                view = memoryview(bytearray(CODEC_CHUNK))
+                                offset = 0
+                                while offset < entry.size:
+                                        read = os.preadv(entry.file.fileno(), [view[:min(entry.size - offset, len(view))]], offset)
+                                        if not read:
+                                                break
+                                        hasher.update(view[:read])
+                                        offset += read
+                                # changed in place while it was read: the digest is still sent, and the receiver drops the body
+                                if stat_key(os.fstat(entry.file.fileno())) != entry.key:
+                                        return hasher.hexdigest()
+                        entry.derived[key] = hasher.hexdigest()
+                return entry.derived[key]
+
+        def encoding(self, entry, codec):
+                # (codec or None, compressed frames of an in-memory body); larger bodies are never compressed here
+                key = ("codec", codec)
+                if key not in entry.derived:
+                        if entry.data is None:
+                                try:
+                                        encoded = (choose_codec(entry.path, codec, entry.size), None)
+                                except OSError:
+                                        encoded = (None, None)
+                        elif codec not in CODECS or entry.size < CODEC_MIN_SIZE or \
+                                        os.path.splitext(entry.path)[1].lower() in COMPRESSED_EXTENSIONS or \
+                                        not compresses(entry.data[:BUFFER_SIZE]):
+                                encoded = (None, None)
+                        else:
+                                compressor = CODECS[codec][0]()
+                                encoded = (codec, pack_frames(compressor.compress(entry.data) + compressor.flush(), b""))
+                        with self.lock:
+                                entry.derived[key] = encoded
+                                if encoded[1] and not entry.evicted:
+                                        entry.weight += len(encoded[1])
+                                        self.used += len(encoded[1])
+                                        self.__trim()
+                return entry.derived[key]
+
+        def servable(self, entry, codec, sparse=False):
+                # a larger file that should be compressed, or that has holes to skip, is left to the streaming path
+                if entry.data is None and sparse and entry.holes:
+                        return False
+                return not codec or entry.data is not None or not self.encoding(entry, codec)[0]
+
+        def summary(self):
+                return (f"hot files: {len(self.entries)} cached, {self.used} of {self.capacity} bytes, {self.opened} open; "
+                        f"{self.hits} hits, {self.misses} misses, {self.evictions} evicted")
+
+
+def send_hot(conn, files, entry, head, tail):
+        # the head frames, the body with its announcement and digest, then the tail frames;
+        # a body held in memory makes it all a single write
+        codec, encoded = files.encoding(entry, conn.codec) if conn.codec else (None, None)
+        head = [*head, codec or "raw"] if conn.codec or conn.sparse else list(head)
+        trailer = [files.digest(entry, conn.checksum)] if conn.checksum else []
+        if entry.data is not None:
+                conn.send_buffers([pack_frames(*head), encoded or entry.data, pack_frames(*trailer, *tail)])
+                return
+        conn.send_msg(*head)
+        sent = 0
+        try:
+                if entry.size:
+                        sent = conn.sendfile(entry.file, 0, entry.size)
+        except OSError as e:
+                if isinstance(e, ConnectionError):
+                        raise
+                log.warning("%s", e)
+        while sent < entry.size:
+                padding = min(entry.size - sent, BUFFER_SIZE)
+                conn.sendall(bytes(padding))
+                sent += padding
+        conn.send_msg(*trailer, *tail)
+
+
+class JobCancelled(Exception):
+        pass
+
+
+class Job:
+        # One background operation. Its work reports through advance() and calls check() between steps,
+        # which is where a cancel takes effect.
+        def __init__(self, job_id, description, work, owner=None):
+                self.id = job_id
+                self.description = description
+                self.work = work
+                self.owner = owner
+                self.state = "queued"       # then running, and finally done, failed or cancelled
+                self.done = 0
+                self.total = None
+                self.bytes = 0
+                self.result = None
+                self.cancelled = False
+                self.reported = False       # the outcome has been sent to the owner
+                self.started = None
+                self.finished = None
+                self.future = None
+
+        def check(self):
+                if self.cancelled:
+                        raise JobCancelled()
+
+        def cancel(self):
+                self.cancelled = True
+
+        def advance(self, count=1, size=0):
+                self.done += count
+                self.bytes += size
+
+        def progress(self):
+                counted = f"{self.done}/{self.total}" if self.total is not None else f"{self.done}"
+                return f"{counted} steps" + (f", {self.bytes} bytes" if self.bytes else "")
+
+        def elapsed(self):
+                if self.started is None:
+                        return 0.0
+                return (self.finished or time.monotonic()) - self.started
+
+        def describe(self):
+                return f"{self.id:>5}  {self.state:<9}  {self.progress():<36}  {self.elapsed():8.1f}s  {self.description}"
+
+        def outcome(self):
+                self.reported = True
+                if self.state == "done":
+                        return f"Job {self.id} done in {self.elapsed():.1f}s: {self.result}"
+                if self.state == "failed":
+                        return f"Error: job {self.id} failed: {self.result}"
+                return f"Error: job {self.id} was cancelled after {self.progress()}"
+
+        def reply(self):
+                # what the command would have answered had it run inline
+                self.reported = True
+                if self.state == "done":
+                        return str(self.result)
+                return self.outcome()
+
+
+class JobManager:
+        # A bounded pool of worker threads for operations that outlive the command that started them.
+        # Jobs are only visible to their owner, the session that submitted them.
+        def __init__(self, workers=JOB_WORKERS, history=JOB_HISTORY):
+                self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+                self.jobs = OrderedDict()
+                self.history = history
+                self.next_id = 1
+                self.lock = threading.Lock()
+
+        def submit(self, description, work, owner=None):
+                with self.lock:
+                        job = Job(self.next_id, description, work, owner)
+                        self.next_id += 1
+                        self.jobs[job.id] = job
+                        finished = [old for old in self.jobs.values() if old.finished]
+                        for old in finished[:max(0, len(finished) - self.history)]:
+                                del self.jobs[old.id]
+                job.future = self.pool.submit(self.__run, job)
+                return job
+
+        def __run(self, job):
+                job.started = time.monotonic()
+                try:
+                        job.check()
+                        job.state = "running"
+                        job.result = job.work(job)
+                        job.state = "done"
+                except JobCancelled:
+                        job.state = "cancelled"
+                except Exception as e:
+                        job.result = e
+                        job.state = "failed"
+                finally:
+                        job.finished = time.monotonic()
+                return job
+
+        def find(self, job_id, owner=None):
+                with self.lock:
+                        job = self.jobs.get(job_id)
+                return job if job and job.owner is owner else None
+
+        def owned(self, owner=None):
+                with self.lock:
+                        return [job for job in self.jobs.values() if job.owner is owner]
+
+        def cancel_all(self):
+                with self.lock:
+                        jobs = list(self.jobs.values())
+                for job in jobs:
+                        job.cancel()
+
+        def shutdown(self, wait=True):
+                self.pool.shutdown(wait=wait)
+
+
+def describe_jobs(jobs):
+        if not jobs:
+                return "No jobs"
+        return "\n".join([f"{'id':>5}  {'state':<9}  {'progress':<36}  {'elapsed':>9}  job"] + [job.describe() for job in jobs])
+
+
+def report_jobs(jobs):
+        # one line per job; a failure anywhere makes the whole reply an error
+        if not jobs:
+                return "No jobs to wait for"
+        if len(jobs) == 1:
+                return jobs[0].outcome()
+        lines = [job.outcome() for job in jobs]
+        failed = sum(job.state != "done" for job in jobs)
+        if failed:
+                lines.insert(0, f"Error: {failed} of {len(jobs)} jobs did not finish")
+        return "\n".join(lines)
+
+
+def ring_hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+        # Consistent hashing: every node sits at vnodes points on a ring and a key belongs to the nodes
+        # clockwise from it, so adding or removing a node only moves the keys next to its points.
+        def __init__(self, nodes=(), vnodes=RING_VNODES):
+                self.vnodes = vnodes
+                self.nodes = []
+                self.points = []        # sorted (hash, node)
+                for node in nodes:
+                        self.add(node)
+
+        def add(self, node):
+                if node in self.nodes:
+                        return
+                self.nodes.append(node)
+                for i in range(self.vnodes):
+                        bisect.insort(self.points, (ring_hash(f"{node}#{i}"), node))
+
+        def remove(self, node):
+                self.nodes.remove(node)
+                self.points = [point for point in self.points if point[1] != node]
+
+        def owners(self, key, count=1):
+                # the first count distinct nodes from the key's position; the first one is the primary
+                if not self.points:
+                        raise ValueError("The ring has no nodes")
+                count = min(count, len(self.nodes))
+                owners = []
+                start = bisect.bisect(self.points, (ring_hash(key),))
+                for i in range(len(self.points)):
+                        node = self.points[(start + i) % len(self.points)][1]
+                        if node not in owners:
+                                owners.append(node)
+                                if len(owners) == count:
+                                        break
+                return owners
+
+
+class TokenBucket:
+        # rate bytes a second with up to burst saved; going over is paid back by waiting
+        def __init__(self, rate, burst=SHAPE_BURST):
+                self.rate = rate
+                self.burst = burst
+                self.tokens = burst
+                self.last = time.monotonic()
+
+        def delay(self, count):
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                self.tokens -= count
+                return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Shaper:
+        # One bandwidth cap for every transfer, split between the connections moving data in proportion to
+        # their weights. Each connection owns a slot in shared memory with its weight and when it last moved
+        # bytes, so forked workers see each other without locks; idle connections drop out of the split.
+        def __init__(self, rate, slots=1):
+                self.rate = rate
+                self.map = mmap.mmap(-1, slots * 16)
+                self.slots = memoryview(self.map).cast("d")
+                self.count = slots
+                self.free = list(range(slots - 1, 0, -1))
+                self.lock = threading.Lock()
+
+        def claim(self):
+                # slot 0 is shared, like a Metrics shard, only once all the others are taken
+                with self.lock:
+                        return self.free.pop() if self.free else 0
+
+        def release(self, slot):
+                self.slots[2 * slot] = 0.0
+                if slot:
+                        with self.lock:
+                                self.free.append(slot)
+
+        def share(self, slot, weight):
+                now = time.monotonic()
+                self.slots[2 * slot] = weight
+                self.slots[2 * slot + 1] = now
+                values = self.slots.tolist()
+                total = sum(values[i] for i in range(0, len(values), 2) if now - values[i + 1] < SHAPE_IDLE)
+                return self.rate * weight / max(total, weight)
+
+
+class Pacer:
+        # a connection's token bucket, refilled at its current share of the Shaper
+        def __init__(self, shaper, slot, weight=1.0):
+                self.shaper = shaper
+                self.slot = slot
+                self.weight = weight
+                self.priority = PRIORITIES["normal"]
+                self.bucket = TokenBucket(shaper.rate)
+                self.checked = 0.0
+
+        def delay(self, count):
+                now = time.monotonic()
+                if now - self.checked >= SHAPE_REFRESH:
+                        self.bucket.rate = self.shaper.share(self.slot, self.weight * self.priority)
+                        self.checked = now
+                return self.bucket.delay(count)
+
+        def take(self, count):
+                wait = self.delay(count)
+                if wait:
+                        time.sleep(wait)
+
+
+class ServerBusy(ConnectionError):
+        def __init__(self, message, retry_after):
+                super().__init__(message)
+                self.retry_after = retry_after
+
+
+def busy_message(retry_after):
+        return f"Error: Server busy, retry after {retry_after} seconds"
+
+
+def busy_retry(message):
+        # the seconds a busy reply asks for, None for any other message
+        if not message.startswith("Error: Server busy"):
+                return None
+        words = message.split()
+        return int(words[-2]) if len(words) > 2 and words[-2].isdigit() else 1
+
+
+def retry_hint(session_seconds, queued, slots):
+        # about how long until the queue ahead has drained, from how long sessions have been lasting
+        return max(1, min(RETRY_MAX, math.ceil(session_seconds * (queued + 1) / max(slots, 1))))
+
+
+def tcp_bytes(sock):
+        # (bytes out, bytes in) as counted by the kernel, so the transfer paths carry no bookkeeping
+        try:
+                info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 136)
+        except (OSError, AttributeError):
+                return 0, 0
+        if len(info) < 136:
+                return 0, 0
+        return TCP_INFO_BYTES.unpack_from(info, 120)
+
+
+class Metrics:
+        # Counters in an anonymous shared mapping made before the server forks. Every process writes to its
+        # own shard, so no update takes a lock; a worker's shard is folded into the parent's when it is reaped.
+        def __init__(self, shards=1):
+                self.stride = len(LATENCY_BUCKETS) + 3     # bucket counts, +Inf, microseconds, errors
+                self.width = len(METRIC_COMMANDS) * self.stride + len(METRIC_TOTALS)
+                self.map = mmap.mmap(-1, shards * self.width * 8)
+                self.values = memoryview(self.map).cast("q")
+                self.shards = shards
+                self.shard = 0
+                self.free = list(range(shards - 1, 0, -1))
+
+        def claim(self):
+                # called by the parent before forking; shard 0 is shared, and racy, only if all are taken
+                return self.free.pop() if self.free else 0
+
+        def release(self, shard):
+                if not shard:
+                        return
+                start = shard * self.width
+                for i in range(self.width):
+                        self.values[i] += self.values[start + i]
+                        self.values[start + i] = 0
+                self.free.append(shard)
+
+        def record(self, command, seconds, failed=False, bytes_out=0, bytes_in=0):
+                base = self.shard * self.width
+                slot = base + self.stride * (METRIC_COMMANDS.index(command) if command in METRIC_COMMANDS else len(METRIC_COMMANDS) - 1)
+                bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+                self.values[slot + bucket] += 1
+                self.values[slot + len(LATENCY_BUCKETS) + 1] += int(seconds * 1e6)
+                if failed:
+                        self.values[slot + len(LATENCY_BUCKETS) + 2] += 1
+                totals = base + len(METRIC_COMMANDS) * self.stride
+                self.values[totals] += bytes_in
+                self.values[totals + 1] += bytes_out
+
+        def add(self, total, value=1):
+                self.values[self.shard * self.width + len(METRIC_COMMANDS) * self.stride + METRIC_TOTALS.index(total)] += value
+
+        def snapshot(self):
+                summed = [0] * self.width
+                for shard in range(self.shards):
+                        start = shard * self.width
+                        for i, value in enumerate(self.values[start:start + self.width]):
+                                summed[i] += value
+                commands = {}
+                for i, command in enumerate(METRIC_COMMANDS):
+                        row = summed[i * self.stride:(i + 1) * self.stride]
+                        if sum(row[:len(LATENCY_BUCKETS) + 1]):
+                                commands[command] = {"buckets": row[:len(LATENCY_BUCKETS) + 1],
+                                                     "seconds": row[-2] / 1e6, "errors": row[-1]}
+                totals = dict(zip(METRIC_TOTALS, summed[len(METRIC_COMMANDS) * self.stride:]))
+                return commands, totals
+
+        def render(self):
+                # Prometheus text exposition format
+                commands, totals = self.snapshot()
+                lines = ["# TYPE fileserver_command_seconds histogram"]
+                for command, data in commands.items():
+                        cumulative = 0
+                        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), data["buckets"]):
+                                cumulative += count
+                                lines.append(f'fileserver_command_seconds_bucket{{command="{command}",le="{bound}"}} {cumulative}')
+                        lines.append(f'fileserver_command_seconds_sum{{command="{command}"}} {data["seconds"]}')
+                        lines.append(f'fileserver_command_seconds_count{{command="{command}"}} {cumulative}')
+                lines.append("# TYPE fileserver_command_errors_total counter")
+                lines += [f'fileserver_command_errors_total{{command="{command}"}} {data["errors"]}' for command, data in commands.items()]
+                lines += ["# TYPE fileserver_received_bytes_total counter", f"fileserver_received_bytes_total {totals['bytes_in']}",
+                          "# TYPE fileserver_sent_bytes_total counter", f"fileserver_sent_bytes_total {totals['bytes_out']}",
+                          "# TYPE fileserver_sessions_total counter", f"fileserver_sessions_total {totals['sessions']}",
+                          "# TYPE fileserver_sessions_active gauge", f"fileserver_sessions_active {totals['sessions_active']}",
+                          "# TYPE fileserver_sessions_queued_total counter", f"fileserver_sessions_queued_total {totals['sessions_queued']}",
+                          "# TYPE fileserver_sessions_turned_away_total counter",
+                          f"fileserver_sessions_turned_away_total {totals['sessions_turned_away']}",
+                          "# TYPE fileserver_hot_file_hits_total counter", f"fileserver_hot_file_hits_total {totals['hot_hits']}",
+                          "# TYPE fileserver_hot_file_misses_total counter", f"fileserver_hot_file_misses_total {totals['hot_misses']}"]
+                return "\n".join(lines) + "\n"
+
+        def summary(self):
+                # the text behind the stats command
+                commands, totals = self.snapshot()
+                lines = [f"{'command':<9}{'count':>9}{'errors':>8}{'avg ms':>10}{'p99 ms':>10}"]
+                for command, data in commands.items():
+                        count = sum(data["buckets"])
+                        lines.append(f"{command:<9}{count:>9}{data['errors']:>8}{data['seconds'] * 1000 / count:>10.2f}"
+                                     f"{histogram_quantile(data['buckets'], 0.99) * 1000:>10.1f}")
+                lines.append(f"sessions {totals['sessions_active']} active, {totals['sessions']} total, "
+                             f"{totals['sessions_queued']} queued, {totals['sessions_turned_away']} turned away; "
+                             f"{totals['bytes_in']} bytes in, {totals['bytes_out']} bytes out; "
+                             f"hot file cache {totals['hot_hits']} hits, {totals['hot_misses']} misses")
+                return "\n".join(lines)
+
+
+def histogram_quantile(buckets, quantile):
+        # upper bound of the bucket holding the quantile, like Prometheus without the interpolation
+        target = quantile * sum(buckets)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                cumulative += count
+                if cumulative >= target:
+                        return bound
+        return float("inf")
+
+
+class RateLimitFilter(logging.Filter):
+        # at most `rate` records a second get through; the next one that does says how many were dropped
+        def __init__(self, rate=LOG_RATE):
+                super().__init__()
+                self.rate = rate
+                self.window = 0
+                self.count = 0
+                self.suppressed = 0
+
+        def filter(self, record):
+                now = int(time.monotonic())
+                if now != self.window:
+                        self.window, self.count = now, 0
+                self.count += 1
+                if self.count > self.rate:
+                        self.suppressed += 1
+                        return False
+                if self.suppressed:
+                        record.msg = f"{record.msg} ({self.suppressed} messages suppressed)"
+                        self.suppressed = 0
+                return True
+
+
+def pop_option(content, flag, default=None):
+        if flag in content:
+                i = content.index(flag)
+                if i + 1 < len(content):
+                        value = content[i + 1]
+                        del content[i:i + 2]
+                        return value
+        return default
+
+
+def pop_flag(content, flag):
+        if flag in content:
+                content.remove(flag)
+                return True
+        return False
+
 
 def is_recursive(content):
         if '-r' in content:
@@ -129,7 +2554,587 @@ class TestLibrary(unittest.TestCase):
 
         def testPWD(self):
                 pass
-                
+
+        def testFraming(self):
+                a, b = socket.socketpair()
+                sender, receiver = FramedSocket(a), FramedSocket(b, buffer_size=64)
+                big = os.urandom(1000)
+                sender.send_msg("ls", "name~with~tildes", "", big)
+                sender.sendall(b"raw body")
+                self.assertEqual(receiver.recv_msg(), "ls")
+                self.assertEqual(receiver.recv_msg(), "name~with~tildes")
+                self.assertEqual(receiver.recv_msg(), "")
+                self.assertEqual(receiver.recv_frame(), big)
+                self.assertEqual(receiver.recv_exact(8), b"raw body")
+                sender.close()
+                with self.assertRaises(ConnectionError):
+                        receiver.recv_frame()
+                receiver.close()
+
+        def testStreamingReceive(self):
+                memory_limit = 1 << 20
+                with open("testsource.bin", "wb") as file:
+                        for _ in range(8):
+                                file.write(os.urandom(memory_limit))
+                a, b = socket.socketpair()
+                with open("testsource.bin", "rb") as file:
+                        sender = threading.Thread(target=a.sendfile, args=(file,))
+                        tracemalloc.start()
+                        sender.start()
+                        receive_to_file(FramedSocket(b), "testdest.bin", 8 * memory_limit)
+                        _, peak = tracemalloc.get_traced_memory()
+                        tracemalloc.stop()
+                        sender.join()
+                a.close()
+                b.close()
+                self.assertLess(peak, memory_limit)
+                self.assertTrue(filecmp.cmp("testsource.bin", "testdest.bin", shallow=False))
+                self.assertFalse(os.path.exists(partial_path("testdest.bin")))
+                os.remove("testsource.bin")
+                os.remove("testdest.bin")
+
+        def testSpliceReceive(self):
+                if not SPLICE:
+                        self.skipTest("splice is Linux only")
+                data = os.urandom(4 * SMALL_FILE + 123)
+                splice, calls = os.splice, []
+                os.splice = lambda *args, **kwargs: calls.append(args) or splice(*args, **kwargs)
+                try:
+                        for zero_copy in (True, False):
+                                a, b = socket.socketpair()
+                                receiver = FramedSocket(b)
+                                receiver.zero_copy = zero_copy
+                                sender = threading.Thread(target=a.sendall, args=(HEADER.pack(3) + b"hey" + data,))
+                                sender.start()
+                                self.assertEqual(receiver.recv_msg(), "hey")
+                                receive_to_file(receiver, "testdest.bin", len(data))
+                                sender.join()
+                                a.sendall(data[:SMALL_FILE + 7])
+                                a.close()
+                                with self.assertRaises(ConnectionError):
+                                        receive_to_file(receiver, "testcut.bin", len(data))
+                                receiver.close()
+                                self.assertEqual(bool(calls), zero_copy)
+                                with open("testdest.bin", "rb") as file:
+                                        self.assertEqual(file.read(), data)
+                                self.assertEqual(partial_size("testcut.bin"), SMALL_FILE + 7)
+                                os.remove("testdest.bin")
+                                os.remove(partial_path("testcut.bin"))
+                                calls.clear()
+                finally:
+                        os.splice = splice
+
+        def testResume(self):
+                data = os.urandom(5 * TAIL_SIZE)
+                with open("testsource.bin", "wb") as file:
+                        file.write(data)
+                a, b = socket.socketpair()
+                a.sendall(data[:2 * TAIL_SIZE + 100])
+                a.close()
+                with self.assertRaises(ConnectionError):
+                        receive_to_file(FramedSocket(b), "testdest.bin", len(data))
+                b.close()
+                offset = partial_size("testdest.bin")
+                self.assertEqual(offset, 2 * TAIL_SIZE + 100)
+                start = resume_offset("testsource.bin", offset, tail_digest(partial_path("testdest.bin"), offset), len(data))
+                self.assertEqual(start, offset)
+                self.assertEqual(resume_offset("testsource.bin", offset, "mismatch", len(data)), 0)
+                a, b = socket.socketpair()
+                sender = threading.Thread(target=send_file_body, args=(FramedSocket(a), "testsource.bin", len(data) - start, start))
+                sender.start()
+                receive_to_file(FramedSocket(b), "testdest.bin", len(data), start)
+                sender.join()
+                a.close()
+                b.close()
+                self.assertTrue(filecmp.cmp("testsource.bin", "testdest.bin", shallow=False))
+                os.remove("testsource.bin")
+                os.remove("testdest.bin")
+
+        def testTreeTransfer(self):
+                os.makedirs("./testtree/inner")
+                with open("./testtree/inner/small.txt", "w") as file:
+                        file.write("Hello World")
+                with open("./testtree/large.bin", "wb") as file:
+                        file.write(os.urandom(3 * SMALL_FILE))
+                open("./testtree/empty.txt", "w").close()
+                manifest = build_manifest("./testtree")
+                self.assertEqual(manifest[0][:2], ["testtree", "d"])
+                makeDirectory("./testcopy")
+                for checksum in (None, DEFAULT_CHECKSUM):
+                        a, b = socket.socketpair()
+                        sender, receiver = FramedSocket(a), FramedSocket(b)
+                        sender.checksum = receiver.checksum = checksum
+                        thread = threading.Thread(target=send_bodies, args=(sender, "./testtree", manifest))
+                        sender.send_msg(json.dumps(manifest))
+                        thread.start()
+                        receive_tree(receiver, "./testcopy")
+                        thread.join()
+                        a.close()
+                        b.close()
+                        self.assertTrue(filecmp.cmp("./testtree/large.bin", "./testcopy/testtree/large.bin", shallow=False))
+                        self.assertTrue(filecmp.cmp("./testtree/inner/small.txt", "./testcopy/testtree/inner/small.txt", shallow=False))
+                        self.assertTrue(os.path.exists("./testcopy/testtree/empty.txt"))
+                        shutil.rmtree("./testcopy/testtree")
+                # a body damaged on the way is dropped, the rest of the tree still arrives
+                a, b = socket.socketpair()
+                receiver = FramedSocket(b)
+                receiver.checksum = DEFAULT_CHECKSUM
+                tree = [["testtree", "d", 0, 0o755], ["testtree/bad.txt", "f", 5, 0o644], ["testtree/good.txt", "f", 5, 0o644]]
+                a.sendall(pack_frames(json.dumps(tree)) + b"hellX" + pack_frames(data_digest(DEFAULT_CHECKSUM, b"hello"))
+                          + b"hello" + pack_frames(data_digest(DEFAULT_CHECKSUM, b"hello")))
+                receive_tree(receiver, "./testcopy")
+                self.assertFalse(os.path.exists("./testcopy/testtree/bad.txt"))
+                with open("./testcopy/testtree/good.txt", "rb") as file:
+                        self.assertEqual(file.read(), b"hello")
+                fd = os.open("./testcopy/range.bin", os.O_WRONLY | os.O_CREAT)
+                a.sendall(b"hellX" + pack_frames(data_digest(DEFAULT_CHECKSUM, b"hello")) + b"ok")
+                with self.assertRaises(ValueError):
+                        receive_range(receiver, fd, 0, 5)
+                self.assertEqual(receiver.recv_exact(2), b"ok")
+                os.close(fd)
+                a.close()
+                b.close()
+                with self.assertRaises(ValueError):
+                        safe_join("./testcopy", "../escaped")
+                shutil.rmtree("./testtree")
+                shutil.rmtree("./testcopy")
+
+        def testCompression(self):
+                with open("testsource.log", "w") as file:
+                        for i in range(20000):
+                                file.write(f"2024-01-01 12:00:{i % 60:02} INFO request {i} served\n")
+                size = os.path.getsize("testsource.log")
+                for codec in CODECS:
+                        a, b = socket.socketpair()
+                        sender, receiver = FramedSocket(a), FramedSocket(b)
+                        sender.codec = receiver.codec = codec
+                        thread = threading.Thread(target=send_body, args=(sender, "testsource.log", size))
+                        thread.start()
+                        receive_body(receiver, "testdest.log", size)
+                        thread.join()
+                        a.close()
+                        b.close()
+                        self.assertTrue(filecmp.cmp("testsource.log", "testdest.log", shallow=False))
+                        os.remove("testdest.log")
+                with open("testsource.bin", "wb") as file:
+                        file.write(os.urandom(SMALL_FILE))
+                self.assertIsNone(choose_codec("testsource.bin", "zlib", SMALL_FILE))
+                self.assertEqual(choose_codec("testsource.log", "zlib", size), "zlib")
+                self.assertEqual(negotiate("brotli,zlib", CODECS), "zlib")
+                os.remove("testsource.log")
+                os.remove("testsource.bin")
+
+        def testChecksum(self):
+                data = os.urandom(4 * SMALL_FILE)
+                with open("testsource.bin", "wb") as file:
+                        file.write(data)
+                os.utime("testsource.bin", ns=(time.time_ns() - 2 * RACY_WINDOW_NS,) * 2)
+                hashes = HashCache()
+                for codec in (None, "zlib"):
+                        for _ in range(2):     # hashed while sending, then served from the cache
+                                a, b = socket.socketpair()
+                                sender, receiver = FramedSocket(a), FramedSocket(b)
+                                sender.codec = receiver.codec = codec
+                                sender.checksum = receiver.checksum = DEFAULT_CHECKSUM
+                                thread = threading.Thread(target=send_body, args=(sender, "testsource.bin", len(data), 0, hashes))
+                                thread.start()
+                                receive_body(receiver, "testdest.bin", len(data))
+                                thread.join()
+                                a.close()
+                                b.close()
+                                self.assertTrue(filecmp.cmp("testsource.bin", "testdest.bin", shallow=False))
+                                os.remove("testdest.bin")
+                digest, _ = hashes.lookup("testsource.bin", len(data), 0, DEFAULT_CHECKSUM)
+                hasher = CHECKSUMS[DEFAULT_CHECKSUM]()
+                hasher.update(data)
+                self.assertEqual(digest, hasher.hexdigest())
+                a, b = socket.socketpair()
+                receiver = FramedSocket(b)
+                receiver.checksum = DEFAULT_CHECKSUM
+                thread = threading.Thread(target=lambda: a.sendall(data[:-1] + b"x" + pack_frames(digest)))
+                thread.start()
+                with self.assertRaises(ValueError):
+                        receive_body(receiver, "testdest.bin", len(data))
+                thread.join()
+                a.close()
+                b.close()
+                self.assertFalse(os.path.exists("testdest.bin") or os.path.exists(partial_path("testdest.bin")))
+                os.remove("testsource.bin")
+
+        def testStreamedBodies(self):
+                data = os.urandom(SMALL_FILE) + bytes(3 * SMALL_FILE)
+                with open("testsource.bin", "wb") as file:
+                        file.write(data)
+                for codec in (None, "zlib"):
+                        a, b = socket.socketpair()
+                        sender, receiver = FramedSocket(a), FramedSocket(b)
+                        sender.codec = receiver.codec = codec
+                        sender.checksum = receiver.checksum = DEFAULT_CHECKSUM
+                        thread = threading.Thread(target=send_body, args=(sender, "testsource.bin", len(data)))
+                        thread.start()
+                        self.assertEqual(b"".join(body_chunks(receiver, len(data))), data)
+                        thread.join()
+                        # and back from memory, a source that comes up short is dropped by the receiver
+                        pieces = [data[:1000], data[1000:]]
+                        thread = threading.Thread(target=send_chunks, args=(sender, pieces, len(data)))
+                        thread.start()
+                        receive_body(receiver, "testdest.bin", len(data))
+                        thread.join()
+                        self.assertTrue(filecmp.cmp("testsource.bin", "testdest.bin", shallow=False))
+                        os.remove("testdest.bin")
+                        thread = threading.Thread(target=send_chunks, args=(sender, pieces[:1], len(data)))
+                        thread.start()
+                        with self.assertRaises(ValueError):
+                                receive_body(receiver, "testdest.bin", len(data))
+                        thread.join()
+                        self.assertFalse(os.path.exists("testdest.bin"))
+                        a.close()
+                        b.close()
+                os.remove("testsource.bin")
+
+        def testSparse(self):
+                size = 4 * SPARSE_MIN_SIZE
+                data = os.urandom(SMALL_FILE)
+                with open("testsource.bin", "wb") as file:
+                        file.truncate(size)
+                        for start in (0, 2 * SPARSE_MIN_SIZE):
+                                file.seek(start)
+                                file.write(data)
+                extents = sparse_extents("testsource.bin", size)
+                if extents is None:
+                        os.remove("testsource.bin")
+                        self.skipTest("filesystem does not report holes")
+                self.assertLess(sum(length for _, length in extents), size // 2)
+                self.assertIsNone(sparse_extents("testsource.bin", SPARSE_MIN_SIZE // 2, size - SPARSE_MIN_SIZE // 2))
+                with open("testsource.bin", "rb") as file:
+                        expected = file.read()
+                for checksum in (DEFAULT_CHECKSUM, None):
+                        a, b = socket.socketpair()
+                        sender, receiver = FramedSocket(a), FramedSocket(b)
+                        sender.sparse = receiver.sparse = True
+                        sender.checksum = receiver.checksum = checksum
+                        thread = threading.Thread(target=send_body, args=(sender, "testsource.bin", size))
+                        thread.start()
+                        receive_body(receiver, "testdest.bin", size)
+                        thread.join()
+                        self.assertTrue(filecmp.cmp("testsource.bin", "testdest.bin", shallow=False))
+                        self.assertLess(os.stat("testdest.bin").st_blocks * 512, size // 2)
+                        os.remove("testdest.bin")
+                        thread = threading.Thread(target=send_body, args=(sender, "testsource.bin", size))
+                        thread.start()
+                        self.assertEqual(b"".join(body_chunks(receiver, size)), expected)
+                        thread.join()
+                        a.close()
+                        b.close()
+                # a map reaching past the body or going backwards is refused before anything is written
+                for bad in ([[0, size + 1]], [[100, 10], [50, 10]], [[0, 10], [5, 10]]):
+                        a, b = socket.socketpair()
+                        receiver = FramedSocket(b)
+                        receiver.sparse = True
+                        a.sendall(pack_frames("sparse", json.dumps(bad)))
+                        with self.assertRaises(ConnectionError):
+                                receive_body(receiver, "testdest.bin", size)
+                        a.close()
+                        b.close()
+                        self.assertFalse(os.path.exists(partial_path("testdest.bin")))
+                os.remove("testsource.bin")
+
+        def testHotFiles(self):
+                past = time.time_ns() - 2 * RACY_WINDOW_NS
+                for name, size in (("testhot1.txt", 5000), ("testhot2.txt", 5000), ("testhot3.bin", 3 * SMALL_FILE)):
+                        with open(name, "wb") as file:
+                                file.write(b"hot line\n" * (size // 9))
+                        os.utime(name, ns=(past, past))
+                files = FileCache(capacity=8000, small=SMALL_FILE)
+                for expected in (False, True):
+                        entry, hit = files.fetch("testhot1.txt")
+                        self.assertEqual(hit, expected)
+                        files.done(entry)
+                entry, _ = files.fetch("testhot2.txt")      # over the byte cap, the older file is evicted
+                files.done(entry)
+                self.assertEqual(list(files.entries), ["testhot2.txt"])
+                os.utime("testhot2.txt", ns=(past + 1, past + 1))
+                self.assertFalse(files.fetch("testhot2.txt")[1])
+                files.done(files.entries["testhot2.txt"])
+                for name in ("testhot2.txt", "testhot3.bin"):
+                        for codec in (None, "zlib"):
+                                a, b = socket.socketpair()
+                                sender, receiver = FramedSocket(a), FramedSocket(b)
+                                sender.codec = receiver.codec = codec
+                                sender.checksum = receiver.checksum = DEFAULT_CHECKSUM
+                                entry, _ = files.fetch(name)
+                                if files.servable(entry, codec):
+                                        thread = threading.Thread(target=send_hot, args=(sender, files, entry, ["f"], ["done"]))
+                                        thread.start()
+                                        self.assertEqual(receiver.recv_msg(), "f")
+                                        receive_body(receiver, "testdest.bin", entry.size)
+                                        self.assertEqual(receiver.recv_msg(), "done")
+                                        thread.join()
+                                        self.assertTrue(filecmp.cmp(name, "testdest.bin", shallow=False))
+                                        os.remove("testdest.bin")
+                                files.done(entry)
+                                a.close()
+                                b.close()
+                self.assertIsNotNone(files.entries["testhot3.bin"].file)
+                files.entries["testhot3.bin"].close()
+                for name in ("testhot1.txt", "testhot2.txt", "testhot3.bin"):
+                        os.remove(name)
+
+        def testTLS(self):
+                if ssl is None or not shutil.which("openssl"):
+                        self.skipTest("needs the ssl module and the openssl tool")
+                self_signed("testcert.pem", "testkey.pem")
+                server, client = server_tls("testcert.pem", "testkey.pem"), client_tls("testcert.pem")
+                data = os.urandom(3 * SMALL_FILE)
+                with open("testsource.bin", "wb") as file:
+                        file.write(data)
+                session = None
+                for resumed in (False, True):
+                        a, b = socket.socketpair()
+                        sender, receiver = FramedSocket(a), FramedSocket(b)
+                        thread = threading.Thread(target=sender.start_tls, args=(server,), kwargs={"server_side": True})
+                        thread.start()
+                        receiver.start_tls(client, server_hostname="127.0.0.1", session=session)
+                        thread.join()
+                        self.assertIsNone(sender.pipe())
+                        # a bucket too deep to run dry, what it lost is what the pacing charged
+                        sender.pacer = Pacer(Shaper(1), 0)
+                        sender.pacer.bucket = TokenBucket(1, burst=1 << 30)
+                        thread = threading.Thread(target=lambda: (send_file_body(sender, "testsource.bin", len(data)),
+                                                                  sender.send_buffers([b"ab", b"", b"cd"])))
+                        thread.start()
+                        self.assertEqual(receiver.recv_exact(len(data)), data)
+                        self.assertEqual(receiver.recv_exact(4), b"abcd")
+                        thread.join()
+                        self.assertAlmostEqual((1 << 30) - sender.pacer.bucket.tokens, len(data) + 4, delta=100)
+                        self.assertEqual(receiver.sock.session_reused, resumed)
+                        session = receiver.sock.session
+                        sender.close()
+                        receiver.close()
+                for name in ("testcert.pem", "testkey.pem", "testsource.bin"):
+                        os.remove(name)
+
+        def testMetrics(self):
+                metrics = Metrics(2)
+                shard = metrics.claim()
+                pid = os.fork()
+                if pid == 0:
+                        metrics.shard = shard     # a forked worker writes into shared memory
+                        metrics.record("get", 0.003, bytes_out=100, bytes_in=10)
+                        metrics.record("bogus", 20, failed=True)
+                        os._exit(0)
+                os.waitpid(pid, 0)
+                metrics.release(shard)
+                metrics.record("get", 0.0001)
+                commands, totals = metrics.snapshot()
+                self.assertEqual(sum(commands["get"]["buckets"]), 2)
+                self.assertEqual(commands["other"]["errors"], 1)
+                self.assertEqual((totals["bytes_out"], totals["bytes_in"]), (100, 10))
+                self.assertEqual(histogram_quantile(commands["get"]["buckets"], 0.99), 0.005)
+                self.assertIn('fileserver_command_seconds_count{command="get"} 2', metrics.render())
+                self.assertEqual(metrics.claim(), shard)
+                limit = RateLimitFilter(rate=2)
+                records = [logging.LogRecord("test", logging.INFO, "", 0, "message", None, None) for _ in range(4)]
+                self.assertEqual([limit.filter(record) for record in records[:3]], [True, True, False])
+                limit.window -= 1
+                self.assertTrue(limit.filter(records[3]))
+                self.assertIn("1 messages suppressed", records[3].getMessage())
+
+        def testCopy(self):
+                os.makedirs("testcopy/a/b")
+                for i in range(20):
+                        with open(f"testcopy/a/f{i}", "wb") as file:
+                                file.write(os.urandom(i * 1000))
+                os.chmod("testcopy/a/f1", 0o600)
+                os.symlink("f1", "testcopy/a/link")
+                with self.assertRaises(ValueError):
+                        copy_path("testcopy/a", "testcopy/c")
+                stats = copy_path("testcopy/a", "testcopy/c", recursive=True)
+                self.assertEqual((stats["files"], stats["bytes"]), (20, sum(i * 1000 for i in range(20))))
+                compared = filecmp.dircmp("testcopy/a", "testcopy/c")
+                self.assertEqual((compared.left_only, compared.right_only, compared.diff_files), ([], [], []))
+                self.assertEqual(os.readlink("testcopy/c/link"), "f1")
+                self.assertEqual(stat.S_IMODE(os.stat("testcopy/c/f1").st_mode), 0o600)
+                move_path("testcopy/c", "testcopy/d")
+                self.assertFalse(os.path.exists("testcopy/c"))
+                self.assertTrue(filecmp.cmp("testcopy/a/f19", "testcopy/d/f19", shallow=False))
+                shutil.rmtree("testcopy")
+
+        def testJobs(self):
+                os.makedirs("testjobs/a/b")
+                for i in range(10):
+                        with open(f"testjobs/a/b/f{i}", "wb") as file:
+                                file.write(os.urandom(1000))
+                jobs = JobManager(workers=1)
+                digest = jobs.submit("hash", lambda job: tree_digest("testjobs/a", "sha256", job=job), owner=self)
+                copy = jobs.submit("cp", lambda job: copy_path("testjobs/a", "testjobs/c", True, job=job), owner=self)
+                copy.future.result()
+                self.assertEqual((copy.state, copy.done, copy.total, copy.bytes), ("done", 10, 10, 10000))
+                self.assertEqual(digest.result, tree_digest("testjobs/c", "sha256"))
+                self.assertIsNone(jobs.find(digest.id, owner=None))
+                blocker = threading.Event()
+                jobs.submit("block", lambda job: blocker.wait(5))
+                queued = jobs.submit("rm", lambda job: remove_tree("testjobs/c", job), owner=self)
+                queued.cancel()
+                blocker.set()
+                self.assertEqual(queued.future.result().state, "cancelled")
+                self.assertTrue(os.path.exists("testjobs/c/b/f0"))
+                self.assertIn("cancelled", report_jobs([queued]))
+                removed = jobs.submit("rm", lambda job: remove_tree("testjobs/c", job))
+                failed = jobs.submit("rm", lambda job: remove_tree("testjobs/missing", job))
+                jobs.shutdown()
+                self.assertEqual((removed.state, removed.done, failed.state), ("done", 11, "failed"))
+                self.assertFalse(os.path.exists("testjobs/c"))
+                self.assertTrue(report_jobs([removed, failed]).startswith("Error: 1 of 2"))
+                shutil.rmtree("testjobs")
+
+        def testHashRing(self):
+                ring = HashRing(["a:1", "b:1", "c:1"])
+                keys = [f"dir{i % 10}/file{i}" for i in range(3000)]
+                before = {key: ring.owners(key)[0] for key in keys}
+                shares = [list(before.values()).count(node) for node in ring.nodes]
+                self.assertTrue(all(share > 600 for share in shares))
+                ring.add("d:1")
+                after = {key: ring.owners(key)[0] for key in keys}
+                moved = [key for key in keys if before[key] != after[key]]
+                self.assertTrue(all(after[key] == "d:1" for key in moved))
+                self.assertLess(len(moved), 1200)
+                self.assertEqual(len(set(ring.owners("x", 3))), 3)
+                self.assertEqual(len(ring.owners("x", 9)), 4)
+                ring.remove("d:1")
+                self.assertEqual({key: ring.owners(key)[0] for key in keys}, before)
+
+        def testShaping(self):
+                bucket = TokenBucket(1000, burst=500)
+                self.assertEqual(bucket.delay(500), 0.0)
+                self.assertAlmostEqual(bucket.delay(1000), 1.0, places=2)
+                shaper = Shaper(3000, slots=4)
+                first, second = shaper.claim(), shaper.claim()
+                self.assertEqual(shaper.share(first, 1.0), 3000)
+                self.assertAlmostEqual(shaper.share(second, 2.0), 2000)
+                self.assertAlmostEqual(shaper.share(first, 1.0), 1000)
+                shaper.release(second)
+                self.assertEqual(shaper.share(first, 1.0), 3000)
+                left, right = socket.socketpair()
+                with left, right:
+                        sender, receiver = FramedSocket(left), FramedSocket(right)
+                        sender.pacer = Pacer(Shaper(4 << 20), 0)
+                        began = time.monotonic()
+                        writer = threading.Thread(target=sender.sendall, args=(bytes(1 << 20),))
+                        writer.start()
+                        self.assertEqual(len(receiver.recv_exact(1 << 20)), 1 << 20)
+                        writer.join()
+                        self.assertGreater(time.monotonic() - began, 0.15)
+                self.assertEqual(busy_retry(busy_message(7)), 7)
+                self.assertIsNone(busy_retry("Created directory here: x"))
+                self.assertEqual(retry_hint(2.0, 7, 4), 4)
+
+        def testListingCache(self):
+                makeDirectory("./testlisting")
+                makeDirectory("./testlisting/inner")
+                with open("./testlisting/file.txt", "w") as file:
+                        file.write("Hello World")
+                os.utime("./testlisting", ns=(0, 0))
+                cache = ListingCache(capacity=1)
+                path = os.path.abspath("./testlisting")
+                listing = sorted(cache.iter(path))
+                self.assertEqual([entry[:2] for entry in listing], [("file.txt", "f"), ("inner", "d")])
+                self.assertEqual(listing[0][2], 11)
+                self.assertEqual(list(cache.iter(path, "*.txt")), [listing[0]])
+                self.assertEqual(cache.hits, 1)
+                with open("./testlisting/new.txt", "w") as file:
+                        file.write("")
+                self.assertEqual(len(list(cache.iter(path))), 3)
+                os.utime("./testlisting", ns=(0, 0))
+                list(cache.iter(path))
+                cache.invalidate(os.path.abspath("./testlisting/inner/.."))
+                self.assertEqual(len(cache.entries), 0)
+                shutil.rmtree("./testlisting")
+
+        def testListingPages(self):
+                entries = [(f"file{i:02}", "f", i % 7, 0) for i in range(25)]
+                for sort, reverse in (("name", False), ("size", False), ("size", True)):
+                        seen, cursor = [], None
+                        while True:
+                                page, cursor = list_page(iter(entries), sort, reverse, 10, cursor)
+                                seen += page
+                                if cursor is None:
+                                        break
+                        self.assertEqual(seen, sorted(entries, key=SORT_KEYS[sort], reverse=reverse))
+                self.assertEqual(list_page(iter(entries))[0].__class__.__name__, "list_iterator")
+                with self.assertRaises(ValueError):
+                        list_page(iter(entries), "size", False, 10, encode_cursor(["file01"]))
+
+        def testMetadataIndex(self):
+                os.makedirs("./testindex/logs/old")
+                for name, size in (("logs/a.log", 100), ("logs/old/b.log", 50), ("notes.txt", 7)):
+                        with open(f"./testindex/{name}", "wb") as file:
+                                file.write(bytes(size))
+                index = MetadataIndex(os.path.abspath("./testindex"), os.path.abspath("./testindex.sqlite"))
+                self.assertFalse(index.ready())
+                index.update(full=True)
+                self.assertTrue(index.ready())
+                self.assertEqual([row[0] for row in index.find("*.log")], ["logs/a.log", "logs/old/b.log"])
+                self.assertEqual([row[0] for row in index.find("*.log", "logs/old")], ["logs/old/b.log"])
+                self.assertEqual(index.find("logs/*.log")[0][0], "logs/a.log")
+                self.assertEqual(index.du(), {"files": 3, "dirs": 2, "bytes": 157})
+                self.assertEqual(index.du("logs"), {"files": 2, "dirs": 1, "bytes": 150})
+                self.assertEqual(index.du("notes.txt"), {"files": 1, "dirs": 0, "bytes": 7})
+                shutil.rmtree("./testindex/logs/old")
+                with open("./testindex/logs/c.log", "wb") as file:
+                        file.write(bytes(10))
+                index.refresh("./testindex/logs")
+                self.assertEqual(index.du("logs"), {"files": 2, "dirs": 0, "bytes": 110})
+                with self.assertRaises(ValueError):
+                        index.relative("./testindex/..")
+                shutil.rmtree("./testindex")
+                for suffix in ("", "-wal", "-shm"):
+                        if os.path.exists("./testindex.sqlite" + suffix):
+                                os.remove("./testindex.sqlite" + suffix)
+
+        def testSync(self):
+                data = os.urandom(300000)
+                os.makedirs("./testtree")
+                os.makedirs("./testcopy/testtree")
+                with open("./testcopy/testtree/data.bin", "wb") as file:
+                        file.write(data)
+                with open("./testtree/data.bin", "wb") as file:
+                        file.write(data[:100000] + b"inserted" + data[100000:290000] + b"changed" + data[290007:])
+                with open("./testtree/new.txt", "w") as file:
+                        file.write("Hello World")
+                a, b = socket.socketpair()
+                result = []
+                sender = threading.Thread(target=lambda: result.append(sync_send(FramedSocket(a), "./testtree")))
+                sender.start()
+                stats = sync_receive(FramedSocket(b), "./testcopy")
+                sender.join()
+                a.close()
+                b.close()
+                self.assertEqual(result[0], stats)
+                self.assertEqual((stats["files"], stats["changed"], stats["failed"]), (2, 2, 0))
+                self.assertLess(stats["sent"], 20000)
+                self.assertTrue(filecmp.cmp("./testtree/data.bin", "./testcopy/testtree/data.bin", shallow=False))
+                self.assertTrue(filecmp.cmp("./testtree/new.txt", "./testcopy/testtree/new.txt", shallow=False))
+                a, b = socket.socketpair()
+                sender = threading.Thread(target=sync_send, args=(FramedSocket(a), "./testtree"))
+                sender.start()
+                self.assertEqual(sync_receive(FramedSocket(b), "./testcopy")["changed"], 0)
+                sender.join()
+                a.close()
+                b.close()
+                # a basis that cannot be opened drops the output, and the delta is still read to its end
+                a, b = socket.socketpair()
+                a.sendall(pack_frames(b"C" + HEADER.pack(0), b"E", "next"))
+                receiver = FramedSocket(b)
+                with self.assertRaises(FileNotFoundError):
+                        apply_delta(receiver, "./testtree/missing.bin", "./testcopy/out.bin", 10, 1024, "")
+                self.assertEqual(receiver.recv_msg(), "next")
+                self.assertFalse(os.path.exists(partial_path("./testcopy/out.bin")))
+                a.close()
+                b.close()
+                shutil.rmtree("./testtree")
+                shutil.rmtree("./testcopy")
+
 
 if __name__ == '__main__':
         testing = True